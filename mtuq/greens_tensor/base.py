@@ -1,13 +1,15 @@
 
+import sys
 import numpy as np
 
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 from obspy.core import Stream, Trace
 from scipy.signal import fftconvolve
 from mtuq.dataset.base import Dataset
 from mtuq.util.geodetics import distance_azimuth
 from mtuq.util.signal import check_time_sampling, convolve
-from mtuq.util.util import iterable
+from mtuq.util.util import iterable, warn
 
 
 class GreensTensor(Stream):
@@ -42,6 +44,14 @@ class GreensTensor(Stream):
         raise NotImplementedError("Must be implemented by subclass")
 
 
+    def get_synthetics_batch(self, mt_block, out=None):
+        """
+        Generates synthetics for a block of moment tensors at once, 
+        optionally writing them to preallocated arrays
+        """
+        raise NotImplementedError("Must be implemented by subclass")
+
+
     def _precompute_weights(self):
         """
         Calculates weights used in linear combination of Green's functions
@@ -61,11 +71,27 @@ class GreensTensor(Stream):
                 'npts': self[0].stats.npts,
                 'channel': channel,
                 })
-            self._synthetics += Trace(np.zeros(meta.npts), meta)
+            self._synthetics += Trace(
+                np.zeros(meta.npts, dtype=self._get_dtype()), meta)
 
         self._synthetics.id = self.id
 
 
+    def _get_dtype(self):
+        """
+        Floating-point type used for precomputed arrays and synthetics
+
+        Single precision is used if all time series are single precision 
+        (see the dtype parameter of mtuq.process_data.cap.ProcessData), 
+        double precision otherwise, including if there are none
+        """
+        if len(self) > 0 and\
+           all([trace.data.dtype==np.float32 for trace in self]):
+            return np.float32
+        else:
+            return np.float64
+
+
     def apply(self, function, *args, **kwargs):
         """
         Applies a function to all time series
@@ -89,6 +115,21 @@ class GreensTensor(Stream):
         raise NotImplementedError("Must be implemented by subclass")
 
 
+    def get_time_shift_batch(self, data, mt_block, group, time_shift_max):
+        """ 
+        Finds optimal time-shift corrections for a block of moment tensors
+        """
+        raise NotImplementedError("Must be implemented by subclass")
+
+
+    def get_squared_residuals_batch(self, data, mt_block, component, lags,
+                                    time_shift_max):
+        """
+        Sums of squared residuals for a block of moment tensors
+        """
+        raise NotImplementedError("Must be implemented by subclass")
+
+
     def _precompute_time_shifts(self, data, max_time_shift):
         """
         Enables fast time-shift calculations by computing cross-correlations
@@ -134,6 +175,10 @@ class GreensTensorList(object):
         self.id = id
         self.__list__ = []
 
+        # stations for which Green's tensors could not be read, as
+        # (station index, id, exception) tuples (see GreensTensorFactory.__call__)
+        self.failures = []
+
         if not greens_tensors:
             # return an empty container, GreensTensors can be added later
             return
@@ -286,23 +331,86 @@ class GreensTensorFactory(object):
         raise NotImplementedError("Must be implemented by subclass")
 
 
-    def __call__(self, stations, origin, verbose=False):
+    def __call__(self, stations, origin, verbose=False, nthreads=1,
+                 on_error='raise'):
         """
         Reads Green's tensors corresponding to given stations and origin
+
+        With nthreads > 1, Green's tensors for different stations are read
+        concurrently by a pool of threads, which pays off when reading from
+        disk, extracting from a database or downloading is the bottleneck.
+        Either way, Green's tensors are returned in station order
+
+        If reading fails for some stations, the remaining stations are still
+        read. Then, with on_error='raise', the exception raised for the first
+        failed station is raised again, with its original type and traceback,
+        after a warning listing all failed stations. With on_error='warn', a
+        warning is issued and failed stations are left out of the
+        GreensTensorList, their indices, ids and exceptions being recorded in
+        its failures attribute. The list then no longer lines up with the
+        stations, so the corresponding data streams should be removed as well:
+
+            for _, id, _ in greens.failures:
+                data.remove(id)
+
+        Misfit refuses data and Green's tensors of different lengths
         """
+        if on_error not in ['raise', 'warn']:
+            raise ValueError('Bad parameter: on_error')
+
+        stations = iterable(stations)
+
+        if nthreads > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                results = pool.map(
+                    lambda station: self._try_greens_tensor(station, origin),
+                    stations)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._try_greens_tensor(station, origin)
+                for station in stations]
+
         greens_tensors = GreensTensorList()
+        exc_info = None
+        for _i, (station, (greens_tensor, error)) in enumerate(
+                zip(stations, results)):
+            if error is None:
+                greens_tensors += greens_tensor
+            else:
+                greens_tensors.failures += [(_i, station.id, error[1])]
+                if exc_info is None:
+                    exc_info = error
+
+        if greens_tensors.failures:
+            warn("Could not read Green's tensors for %d of %d stations: %s" %
+                (len(greens_tensors.failures), len(stations),
+                ', '.join([str(id) for _, id, _ in greens_tensors.failures])))
+
+        if exc_info is not None and on_error=='raise':
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return greens_tensors
+
 
-        for station in iterable(stations):
+    def _try_greens_tensor(self, station, origin):
+        """
+        Returns the Green's tensor for one station, or the exception info
+        from sys.exc_info if reading it failed
+        """
+        try:
             # if hypocenter is an inversion parameter, then the values 
             # calculated below will in general differ from catalog_distance and
             # catalog_azimuth
             station.distance, station.azimuth = distance_azimuth(
                 station, origin)
 
-            greens_tensors += self.get_greens_tensor(
-                station, origin)
+            return self.get_greens_tensor(station, origin), None
 
-        return greens_tensors
+        except Exception:
+            return None, sys.exc_info()
 
 
     def get_greens_tensor(self, station, origin):
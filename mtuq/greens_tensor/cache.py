@@ -0,0 +1,193 @@
+
+import hashlib
+import importlib
+import numpy as np
+
+from obspy.core import Trace, UTCDateTime
+from mtuq.greens_tensor.base import GreensTensorList
+from mtuq.util.cache import DiskCache
+from mtuq.util.geodetics import distance_azimuth
+from mtuq.util.util import iterable
+
+
+# entries written under a different version are never read back; increment
+# whenever the file layout or the meaning of a key changes
+VERSION = 1
+
+
+class GreensTensorCache(object):
+    """
+    Persistent on-disk cache of processed Green's tensors
+
+    Reading, resampling, convolving and processing Green's tensors is
+    repeated in full every time an inversion is rerun. Instead, the cache
+    stores processed time series, one entry per station, under a key derived
+    from
+
+        - the factory class, path and model
+        - the origin location and time
+        - the station id and time sampling
+        - the class and parameters of the processing function, including any
+          picks or windows it holds for the station
+        - the class and parameters of the source wavelet
+
+    so that repeat runs, or parameter sweeps over the same event, read
+    entries back instead of recomputing them. Changing any of the above
+    gives a different key, so stale entries are never returned.
+
+    Time series are stored in .npy files and memory-mapped copy-on-write when
+    read back. If max_bytes is given, least recently used entries are 
+    deleted whenever the total size of the cache exceeds it. The cache can
+    be shared between processes (see mtuq.util.cache.DiskCache)
+
+
+    EXAMPLE
+
+        cache = GreensTensorCache('greens_cache', max_bytes=10**10)
+        greens = cache(factory, stations, origin, process_bw, wavelet)
+
+    """
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._store = DiskCache(path, max_bytes)
+
+
+    def __call__(self, factory, stations, origin, process=None, wavelet=None):
+        """
+        Returns a GreensTensorList for the given stations and origin, reading
+        cached entries where possible and otherwise creating Green's tensors
+        with factory, convolving them with wavelet, processing them with
+        process and caching the result
+        """
+        stations = iterable(stations)
+
+        keys = []
+        greens_tensors = []
+        missing = []
+        for _i, station in enumerate(stations):
+            station.distance, station.azimuth = distance_azimuth(
+                station, origin)
+
+            key = self.get_key(factory, station, origin, process, wavelet)
+            keys += [key]
+            greens_tensors += [self._load(key, station, origin)]
+
+            if greens_tensors[_i] is None:
+                missing += [_i]
+
+        if missing:
+            created = factory([stations[_i] for _i in missing], origin)
+
+            for _i, greens_tensor in zip(missing, created):
+                if wavelet is not None:
+                    greens_tensor = greens_tensor.convolve(wavelet)
+                if process is not None:
+                    greens_tensor = greens_tensor.apply(process)
+
+                self._save(keys[_i], greens_tensor)
+                greens_tensors[_i] = greens_tensor
+
+        return GreensTensorList(greens_tensors)
+
+
+    def get_key(self, factory, station, origin, process=None, wavelet=None):
+        """
+        Returns the key under which a processed Green's tensor is stored
+        """
+        items = [
+            VERSION,
+            type(factory).__name__,
+            getattr(factory, 'path', None),
+            getattr(factory, 'model', None),
+            float(origin.latitude),
+            float(origin.longitude),
+            float(origin.depth),
+            float(origin.time),
+            station.id,
+            _float(getattr(station, 'starttime', None)),
+            _float(getattr(station, 'endtime', None)),
+            _float(getattr(station, 'delta', None)),
+            _fingerprint(process, station.id),
+            _fingerprint(wavelet, station.id),
+            ]
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+    def clear(self):
+        """
+        Deletes all entries
+        """
+        self._store.clear()
+
+
+    def _load(self, key, station, origin):
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        array, header = entry
+
+        module, name = header['class'].rsplit('.', 1)
+        cls = getattr(importlib.import_module(module), name)
+
+        traces = []
+        for channel, data in zip(header['channels'], array):
+            traces += [Trace(data, header={
+                'channel': str(channel),
+                'starttime': UTCDateTime(header['starttime']),
+                'delta': header['delta'],
+                })]
+
+        return cls(traces, station, origin)
+
+
+    def _save(self, key, greens_tensor):
+        cls = type(greens_tensor)
+
+        self._store.put(key, np.array([trace.data for trace in greens_tensor]),
+            {'class': '%s.%s' % (cls.__module__, cls.__name__),
+             'channels': [trace.stats.channel for trace in greens_tensor],
+             'starttime': float(greens_tensor[0].stats.starttime),
+             'delta': float(greens_tensor[0].stats.delta),
+             })
+
+
+
+def _fingerprint(obj, id=None):
+    """
+    Returns a string determined by the class and attributes of obj
+
+    Private dictionaries, which processing functions use to hold per-station
+    state such as picks and windows, contribute only their entry for the
+    given station id
+    """
+    if obj is None:
+        return 'None'
+
+    items = []
+    for name, value in sorted(vars(obj).items()):
+        if name.startswith('_') and isinstance(value, dict):
+            value = value.get(id)
+        items += [(name, _repr(value))]
+
+    return '%s%s' % (type(obj).__name__, items)
+
+
+def _repr(value):
+    if isinstance(value, np.ndarray):
+        return 'array:%s' % hashlib.sha1(
+            np.ascontiguousarray(value).tobytes()).hexdigest()
+    elif isinstance(value, dict):
+        return repr([(key, _repr(value[key])) for key in sorted(value)])
+    elif isinstance(value, (list, tuple)):
+        return repr([_repr(item) for item in value])
+    else:
+        return repr(value)
+
+
+def _float(value):
+    if value is None:
+        return None
+    return float(value)
+
@@ -9,9 +9,11 @@ import mtuq.greens_tensor.instaseis
 from collections import defaultdict
 from copy import deepcopy
 from math import ceil
-from os.path import basename, exists
+from glob import glob
+from os.path import basename, exists, isfile, join
 
 from obspy.core import Stream
+from mtuq.util.cache import LRUCache
 from mtuq.util.signal import resample
 from mtuq.util.moment_tensor.change_basis import change_basis
 
@@ -39,6 +41,21 @@ ErrorMessage =("A list of 10 traces must be provided, each representing an"
 DEG2RAD = np.pi/180.
 
 
+# See cap/fk documentation for indexing scheme details; here we try to follow
+# as closely as possible the cap way of doing things
+CHANNELS = [
+    'TSS', 'TDS',
+    'REP', 'RSS', 'RDS', 'RDD',
+    'ZEP', 'ZSS', 'ZDS', 'ZDD',
+    ]
+
+EXTENSIONS = [
+    '8','5',           # t
+    'b','7','4','1',   # r
+    'a','6','3','0',   # z
+    ]
+
+
 
 class GreensTensor(mtuq.greens_tensor.instaseis.GreensTensor):
     """
@@ -95,6 +112,23 @@ class GreensTensor(mtuq.greens_tensor.instaseis.GreensTensor):
         return self._synthetics
 
 
+    def _get_coefficients(self, mt_block):
+        """
+        Returns an array of shape (nmt, 6) whose rows are the weights applied
+        to the columns of the weighted tensor to generate synthetics
+        """
+        mt_block = np.atleast_2d(mt_block)
+
+        # see comments about moment tensor convention in get_synthetics method
+        return np.column_stack([
+             mt_block[:,1],
+             mt_block[:,2],
+             mt_block[:,0],
+             mt_block[:,5],
+            -mt_block[:,3],
+             mt_block[:,4]])
+
+
 
 class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
     """ 
@@ -109,28 +143,43 @@ class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
 
     In the first step, the user supplies the path to an fk directory tree and 
     the name of the  layered Earth model that was used to generate Green's
-    tensors contained in the tree.
+    tensors contained in the tree.  Raw Green's functions are kept in memory,
+    up to cache_bytes, so that stations and origins mapping to the same 
+    depth and distance do not read the same files again.
 
     In the second step, the user supplies a list of stations and the origin
     location and time of an event. GreensTensors are then created for all the
     corresponding station-event pairs.
     """
-    def __init__(self, path=None, model=None):
+    def __init__(self, path=None, model=None, cache_bytes=2**28):
         if not path:
             raise Exception
 
         if not exists(path):
             raise Exception
 
-        if not model:
+        # fk directory tree or single file written by pack_database?
+        if isfile(path):
+            self._database = open_database(path)
+        else:
+            self._database = None
+
+        if not model and self._database:
+            model = self._database.model
+        elif not model:
             model = basename(path)
 
-        # path to fk directory tree
+        # path to fk directory tree or packed database
         self.path = path
 
         # model from which fk Green's functions were computed
         self.model = model
 
+        # stations at similar distances, and origins at the same depth,
+        # share Green's function files, so raw traces are kept in memory
+        self._cache = LRUCache(cache_bytes,
+            sizeof=lambda trace: trace.data.nbytes)
+
 
     def get_greens_tensor(self, station, origin):
         """ 
@@ -148,27 +197,10 @@ class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
         #dst = str(int(round(station.distance)))
         dst = str(int(ceil(station.distance)))
 
-        # See cap/fk documentation for indexing scheme details;
-        # here we try to follow as closely as possible the cap way of
-        # doing things
-        channels = [
-            'TSS', 'TDS',
-            'REP', 'RSS', 'RDS', 'RDD',
-            'ZEP', 'ZSS', 'ZDS', 'ZDD',
-            ]
-
-        extensions = [
-            '8','5',           # t
-            'b','7','4','1',   # r
-            'a','6','3','0',   # z
-            ]
-
-        for _i, ext in enumerate(extensions):
-            trace = obspy.read('%s/%s_%s/%s.grn.%s' %
-                (self.path, self.model, dep, dst, ext),
-                format='sac')[0]
+        for _i, ext in enumerate(EXTENSIONS):
+            trace = self._read(dep, dst, ext)
 
-            trace.stats.channel = channels[_i]
+            trace.stats.channel = CHANNELS[_i]
 
             # what are the start and end times of the Green's function?
             t1_old = float(origin.time)+float(trace.stats.starttime)
@@ -193,3 +225,219 @@ class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
         traces = [trace for trace in stream]
         return GreensTensor(traces, station, origin)
 
+
+    def _read(self, dep, dst, ext):
+        """
+        Reads a single Green's function from the fk directory tree or packed
+        database, or from the cache of raw traces
+
+        Returns a new trace whose data array is shared with the cache and 
+        cannot be written to
+        """
+        raw = self._cache.get((self.model, dep, dst, ext),
+            lambda: self._read_raw(dep, dst, ext))
+
+        return obspy.Trace(raw.data, header=deepcopy(raw.stats))
+
+
+    def _read_raw(self, dep, dst, ext):
+        if self._database:
+            trace = self._database.get_trace(dep, dst, ext)
+        else:
+            trace = obspy.read('%s/%s_%s/%s.grn.%s' %
+                (self.path, self.model, dep, dst, ext),
+                format='sac')[0]
+
+        trace.data.flags.writeable = False
+        return trace
+
+
+
+def pack_database(path, filename, model=None):
+    """
+    Packs an fk directory tree into a single HDF5 file
+
+    fk directory trees hold one small SAC file per depth, distance and
+    Green's tensor element, organized as <model>_<depth>/<distance>.grn.<ext>.
+    Opening them one at a time is slow on parallel filesystems, where
+    metadata operations dominate. The packed file instead holds
+
+        depths, distances: integer depths (km) and distances (km) from the
+          directory and file names
+        greens: array of shape (ndepth, ndistance, 10, npts), with elements
+          in the order of EXTENSIONS and zero padding beyond each trace's
+          length
+        npts, starttime, delta, t1, t2: tables of shape (ndepth, ndistance)
+          holding trace lengths, start times, sampling intervals and the
+          t1 and t2 (P and S pick) SAC headers, with npts=0 and NaN
+          elsewhere for missing depth-distance pairs
+
+    The greens array is stored contiguously and uncompressed, so that it can
+    be memory-mapped, and the Green's tensor for one depth and distance is a
+    single contiguous slice
+    """
+    import h5py
+
+    if not model:
+        model = basename(path.rstrip('/'))
+
+    # which depths and distances are present?
+    depths = []
+    for dirname in glob(join(path, '%s_*' % model)):
+        depths += [int(basename(dirname)[len(model)+1:])]
+    depths = sorted(depths)
+
+    distances = set()
+    for depth in depths:
+        for name in glob(join(path, '%s_%d' % (model, depth), '*.grn.0')):
+            distances.add(int(basename(name).split('.')[0]))
+    distances = sorted(distances)
+
+    shape = (len(depths), len(distances))
+    npts = np.zeros(shape, dtype=int)
+    starttime = np.nan*np.ones(shape)
+    delta = np.nan*np.ones(shape)
+    t1 = np.nan*np.ones(shape)
+    t2 = np.nan*np.ones(shape)
+
+    # first pass reads headers only, to determine array size
+    for _i, depth in enumerate(depths):
+        for _j, distance in enumerate(distances):
+            name = '%s/%s_%d/%d.grn.0' % (path, model, depth, distance)
+            if not exists(name):
+                continue
+            stats = obspy.read(name, format='sac', headonly=True)[0].stats
+            npts[_i,_j] = stats.npts
+            starttime[_i,_j] = float(stats.starttime)
+            delta[_i,_j] = stats.delta
+            t1[_i,_j] = stats.sac.get('t1', np.nan)
+            t2[_i,_j] = stats.sac.get('t2', np.nan)
+
+    with h5py.File(filename, 'w') as hf:
+        hf.attrs['model'] = model
+        hf.create_dataset('depths', data=np.array(depths, dtype=int))
+        hf.create_dataset('distances', data=np.array(distances, dtype=int))
+        hf.create_dataset('npts', data=npts)
+        hf.create_dataset('starttime', data=starttime)
+        hf.create_dataset('delta', data=delta)
+        hf.create_dataset('t1', data=t1)
+        hf.create_dataset('t2', data=t2)
+
+        greens = hf.create_dataset('greens',
+            shape=shape+(len(EXTENSIONS), max(npts.max(), 1)),
+            dtype=np.float32, fillvalue=0.)
+
+        # second pass reads time series, one Green's tensor at a time
+        for _i, depth in enumerate(depths):
+            for _j, distance in enumerate(distances):
+                if npts[_i,_j] == 0:
+                    continue
+                array = np.zeros(greens.shape[2:], dtype=np.float32)
+                for _k, ext in enumerate(EXTENSIONS):
+                    array[_k,:npts[_i,_j]] = obspy.read(
+                        '%s/%s_%d/%d.grn.%s' % (path, model, depth, distance,
+                        ext), format='sac')[0].data
+                greens[_i,_j] = array
+
+
+class PackedDatabase(object):
+    """
+    Reads fk Green's functions from a file written by pack_database
+
+    Index tables are read once when the file is opened. Time series are
+    memory-mapped, so reading the Green's tensor for one depth and distance
+    touches only the corresponding slice of the file
+    """
+    def __init__(self, filename):
+        import h5py
+
+        self.filename = filename
+
+        with h5py.File(filename, 'r') as hf:
+            self.model = str(hf.attrs['model'])
+            self.depths = hf['depths'][...]
+            self.distances = hf['distances'][...]
+            self.npts = hf['npts'][...]
+            self.starttime = hf['starttime'][...]
+            self.delta = hf['delta'][...]
+            self.t1 = hf['t1'][...]
+            self.t2 = hf['t2'][...]
+
+            dataset = hf['greens']
+            offset = dataset.id.get_offset()
+            if offset is not None:
+                self._greens = np.memmap(filename, mode='r', offset=offset,
+                    dtype=dataset.dtype, shape=dataset.shape)
+            else:
+                # not yet written, or not stored contiguously
+                self._greens = None
+
+        self._depth_index = dict([(depth, _i)
+            for _i, depth in enumerate(self.depths)])
+        self._distance_index = dict([(distance, _j)
+            for _j, distance in enumerate(self.distances)])
+
+
+    def get_trace(self, depth, distance, ext):
+        """
+        Returns the Green's function for the given depth (km), distance (km)
+        and fk file extension as an obspy trace, with t1 and t2 SAC headers
+        """
+        _i, _j = self._get_index(depth, distance)
+        _k = EXTENSIONS.index(ext)
+        npts = self.npts[_i,_j]
+
+        if self._greens is not None:
+            data = np.array(self._greens[_i,_j,_k,:npts])
+        else:
+            import h5py
+            with h5py.File(self.filename, 'r') as hf:
+                data = hf['greens'][_i,_j,_k,:npts]
+
+        trace = obspy.Trace(data, header={
+            'starttime': obspy.UTCDateTime(self.starttime[_i,_j]),
+            'delta': self.delta[_i,_j],
+            })
+        trace.stats.sac = obspy.core.AttribDict({
+            't1': self.t1[_i,_j],
+            't2': self.t2[_i,_j],
+            })
+        return trace
+
+
+    def get_picks(self, depth, distance):
+        """
+        Returns t1 and t2 (P and S pick) SAC headers for the given depth (km)
+        and distance (km)
+        """
+        _i, _j = self._get_index(depth, distance)
+        return self.t1[_i,_j], self.t2[_i,_j]
+
+
+    def _get_index(self, depth, distance):
+        try:
+            _i = self._depth_index[int(depth)]
+            _j = self._distance_index[int(distance)]
+        except KeyError:
+            _i, _j = None, None
+
+        if _i is None or self.npts[_i,_j] == 0:
+            raise IOError("No Green's functions for depth %s and distance %s "
+                "in %s" % (depth, distance, self.filename))
+
+        return _i, _j
+
+
+# packed databases already opened, by file name
+_databases = {}
+
+
+def open_database(filename):
+    """
+    Returns a PackedDatabase for the given file, opening it only once per
+    process
+    """
+    if filename not in _databases:
+        _databases[filename] = PackedDatabase(filename)
+    return _databases[filename]
+
@@ -1,13 +1,16 @@
+from __future__ import absolute_import
 
 import instaseis
 import obspy
 import numpy as np
+import threading
 import mtuq.greens_tensor.base
 
 from collections import defaultdict
 from copy import deepcopy
 from os.path import basename, exists
 from scipy.signal import fftconvolve
+from mtuq.util.cache import LRUCache
 from mtuq.util.geodetics import km2deg
 from mtuq.util.signal import resample
 
@@ -71,9 +74,10 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
         ZEP = self.select(channel="ZEP")[0].data
         REP = self.select(channel="REP")[0].data
 
-        GZ = np.ones((npts, 6))
-        GR = np.ones((npts, 6))
-        GT = np.ones((npts, 6))
+        dtype = self._get_dtype()
+        GZ = np.ones((npts, 6), dtype=dtype)
+        GR = np.ones((npts, 6), dtype=dtype)
+        GT = np.ones((npts, 6), dtype=dtype)
 
         GZ[:, 0] =  ZSS/2. * np.cos(2*az) - ZDD/6. + ZEP/3.
         GZ[:, 1] = -ZSS/2. * np.cos(2*az) - ZDD/6. + ZEP/3.
@@ -96,10 +100,17 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
         GT[:, 4] = TDS * np.sin(az)
         GT[:, 5] = -TDS * np.cos(az)
 
-        self._weighted_tensor = []
-        self._weighted_tensor += [GZ]
-        self._weighted_tensor += [GR]
-        self._weighted_tensor += [GT]
+        # assigned last, since other threads check for this attribute to
+        # decide whether the weights are ready
+        self._weighted_tensor = self._apply_signs([GZ, GR, GT])
+
+
+    def _apply_signs(self, weighted_tensor):
+        """
+        Applies sign conventions to the weighted Green's functions, which
+        differ from one source of Green's functions to another
+        """
+        return weighted_tensor
 
 
     def get_synthetics(self, mt):
@@ -147,6 +158,109 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
         return self._synthetics
 
 
+    def get_synthetics_batch(self, mt_block, out=None):
+        """
+        Generates synthetics for a block of moment tensors at once
+
+        Given an array of shape (nmt, 6), returns a list with one array per 
+        component, each of shape (npts, nmt), whose columns are the synthetics
+        corresponding to the rows of mt_block
+
+        If out is given, it must be a list of C-contiguous arrays of that 
+        shape and of the same dtype as the Green's functions, one per
+        component, into which synthetics are written
+        """
+        if not hasattr(self, '_weighted_tensor'):
+            self._precompute_weights()
+
+        # avoids promoting single-precision Green's functions
+        M = self._get_coefficients(mt_block).astype(
+            self._weighted_tensor[0].dtype)
+
+        synthetics = []
+        for _i, component in enumerate(self.components):
+            # which Green's functions correspond to given component?
+            if component=='Z':
+                _j=0
+            elif component=='R':
+                _j=1
+            elif component=='T':
+                _j=2
+            G = self._weighted_tensor[_j]
+
+            # one matrix-matrix product per component, rather than six vector
+            # updates per moment tensor
+            if out is None:
+                synthetics += [np.dot(G, M.T)]
+            else:
+                synthetics += [np.dot(G, M.T, out=out[_i])]
+
+        return synthetics
+
+
+    def get_squared_residuals_batch(self, data, mt_block, component, lags,
+                                    time_shift_max):
+        """
+        Sums of squared residuals between data and time-shifted synthetics for
+        a block of moment tensors, without generating synthetics
+
+        Expanding |s - d|**2 = m.(G^T G)m - 2 m.(G^T d) + d.d, where G^T d is
+        the cross-correlation already used to find time shifts, reduces the
+        cost per moment tensor to a 6x6 quadratic form, independent of trace
+        length. lags are indices into the cross-correlation, one per moment 
+        tensor, as given by the argmax of get_time_shift
+        """
+        if not hasattr(self, '_weighted_tensor'):
+            self._precompute_weights()
+
+        if not hasattr(self, '_cross_correlation'):
+            self._precompute_time_shifts(data, time_shift_max)
+
+        if not hasattr(self, '_autocorrelation'):
+            self._precompute_autocorrelations(data, time_shift_max)
+
+        # which Green's functions correspond to given component?
+        if component=='Z':
+            _j=0
+            CC = self._CCZ
+        elif component=='R':
+            _j=1
+            CC = self._CCR
+        elif component=='T':
+            _j=2
+            CC = self._CCT
+
+        # all three terms in double precision, since their sum is prone to
+        # cancellation
+        if self._cross_correlation64[_j] is not None:
+            CC = self._cross_correlation64[_j]
+
+        M = self._get_coefficients(mt_block).astype(np.float64)
+        GG = self._autocorrelation[_j][lags]
+
+        return np.maximum(
+            np.einsum('ki,kij,kj->k', M, GG, M) -
+            2.*np.sum(M*CC[lags], axis=1) +
+            self._data_energy[_j], 0.)
+
+
+    def _get_coefficients(self, mt_block):
+        """
+        Returns an array of shape (nmt, 6) whose rows are the weights applied
+        to the columns of the weighted tensor to generate synthetics
+        """
+        mt_block = np.atleast_2d(mt_block)
+
+        # see comments about moment tensor convention in get_synthetics method
+        return np.column_stack([
+             mt_block[:,1],
+             mt_block[:,2],
+             mt_block[:,0],
+            -mt_block[:,5],
+            -mt_block[:,3],
+             mt_block[:,4]])
+
+
     def get_time_shift(self, data, mt, group, time_shift_max):
         """ 
         Finds optimal time-shift correction between synthetics and
@@ -158,45 +272,59 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
         cc = self._cross_correlation
         cc[:] = 0.
 
-        # see comments about moment tensor convention in get_synthetics method
-        Mxx =  mt[1]
-        Myy =  mt[2]
-        Mzz =  mt[0]
-        Mxy = -mt[5]
-        Mxz = -mt[3]
-        Myz =  mt[4]
+        # cross-correlations have one column per column of the weighted
+        # tensor, which subclasses may lay out differently
+        M = self._get_coefficients(mt)[0].astype(cc.dtype)
 
         if 'Z' in group:
-            CC = self._CCZ
-            cc += Mxx*CC[:,0]
-            cc += Myy*CC[:,1]
-            cc += Mzz*CC[:,2]
-            cc += Mxy*CC[:,3]
-            cc += Mxz*CC[:,4]
-            cc += Myz*CC[:,5]
+            cc += np.dot(self._CCZ, M)
 
         if 'R' in group:
-            CC = self._CCR
-            cc += Mxx*CC[:,0]
-            cc += Myy*CC[:,1]
-            cc += Mzz*CC[:,2]
-            cc += Mxy*CC[:,3]
-            cc += Mxz*CC[:,4]
-            cc += Myz*CC[:,5]
+            cc += np.dot(self._CCR, M)
 
         if 'T' in group:
-            CC = self._CCT
-            cc += Mxx*CC[:,0]
-            cc += Myy*CC[:,1]
-            cc += Mzz*CC[:,2]
-            cc += Mxy*CC[:,3]
-            cc += Mxz*CC[:,4]
-            cc += Myz*CC[:,5]
+            cc += np.dot(self._CCT, M)
 
         return self._cross_correlation
 
 
 
+    def get_time_shift_batch(self, data, mt_block, group, time_shift_max):
+        """
+        Finds optimal time-shift corrections for a block of moment tensors at
+        once
+
+        Given an array of shape (nmt, 6), forms the (nlag, nmt) matrix of
+        cross-correlations between data and synthetics through one 
+        matrix-matrix product and returns the index of the maximum and the 
+        maximum value for each moment tensor
+        """
+        if not hasattr(self, '_weighted_tensor'):
+            self._precompute_weights()
+
+        if not hasattr(self, '_cross_correlation'):
+            self._precompute_time_shifts(data, time_shift_max)
+
+        mt_block = np.atleast_2d(mt_block)
+
+        # cross-correlations have one column per column of the weighted
+        # tensor, which subclasses may lay out differently
+        M = self._get_coefficients(mt_block)
+
+        CC = np.zeros((self._cross_correlation.size, 6),
+            dtype=self._cross_correlation.dtype)
+        if 'Z' in group:
+            CC += self._CCZ
+        if 'R' in group:
+            CC += self._CCR
+        if 'T' in group:
+            CC += self._CCT
+
+        cc = np.dot(CC, M.T.astype(CC.dtype))
+        lags = cc.argmax(axis=0)
+        return lags, cc[lags, np.arange(mt_block.shape[0])]
+
+
     def _precompute_time_shifts(self, data, max_time_shift):
         """
         Enables fast time-shift calculations by precomputing cross-correlations
@@ -206,27 +334,28 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
         npts_padding = int(max_time_shift/self[0].meta['delta'])
 
         self._npts_padding = npts_padding
-        self._cross_correlation = np.zeros(2*npts_padding+1)
+
+        dtype = self._weighted_tensor[0].dtype
 
         if 'Z' in self.components:
             DZ = data.select(component='Z')[0].data
             #DZ = np.pad(DZ, npts_padding, 'constant')
 
-            CCZ = np.zeros((2*npts_padding+1, 6))
+            CCZ = np.zeros((2*npts_padding+1, 6), dtype=dtype)
             GZ = self._weighted_tensor[0]
 
         if 'R' in self.components:
             DR = data.select(component='R')[0].data
             #DR = np.pad(DR, npts_padding, 'constant')
 
-            CCR = np.zeros((2*npts_padding+1, 6))
+            CCR = np.zeros((2*npts_padding+1, 6), dtype=dtype)
             GR = self._weighted_tensor[1]
 
         if 'T' in self.components:
             DT = data.select(component='T')[0].data
             #DT = np.pad(DT, npts_padding, 'constant')
 
-            CCT = np.zeros((2*npts_padding+1, 6))
+            CCT = np.zeros((2*npts_padding+1, 6), dtype=dtype)
             GT = self._weighted_tensor[2]
 
         # for long traces or long lag times, frequency-domain
@@ -294,48 +423,181 @@ class GreensTensor(mtuq.greens_tensor.base.GreensTensor):
             CCT[:,5] = np.correlate(DT, GT[:,5], 'valid')
             self._CCT = CCT
 
+        # assigned last, as in _precompute_weights
+        self._cross_correlation = np.zeros(2*npts_padding+1, dtype=dtype)
+
+
+
+    def _precompute_autocorrelations(self, data, max_time_shift):
+        """
+        Enables misfit evaluation without synthetics by precomputing, for
+        each allowed time shift, the 6x6 matrix G^T G over the data window,
+        along with the data energy d.d
+
+        These are always computed in double precision, since the expansion 
+        of the misfit is prone to cancellation. For the same reason, if the
+        cross-correlations used to find time shifts are in single precision,
+        they are computed again in double precision
+        """
+        npts_padding = int(max_time_shift/self[0].meta['delta'])
+
+        autocorrelation = [None, None, None]
+        cross_correlation64 = [None, None, None]
+        data_energy = [0., 0., 0.]
+
+        for _j, component in enumerate(['Z','R','T']):
+            if component not in self.components:
+                continue
+
+            D = data.select(component=component)[0].data.astype(np.float64)
+            G = self._weighted_tensor[_j].astype(np.float64)
+            npts = D.size
+
+            # prefix sums of outer products of rows of G, so that each 
+            # window sum is a difference of two terms
+            GG = np.zeros((G.shape[0]+1, 6, 6))
+            GG[1:] = np.cumsum(G[:,:,np.newaxis]*G[:,np.newaxis,:], axis=0)
+
+            # same lag ordering as cross-correlations
+            start = 2*npts_padding - np.arange(2*npts_padding+1)
+            autocorrelation[_j] = GG[start+npts] - GG[start]
+            data_energy[_j] = np.dot(D, D)
+
+            # same method as in _precompute_time_shifts
+            if getattr(self, '_CC'+component).dtype != np.float64:
+                CC = np.zeros((2*npts_padding+1, 6))
+                for _i in range(6):
+                    if npts > 2000 or npts_padding > 200:
+                        CC[:,_i] = fftconvolve(D, G[::-1,_i], 'valid')
+                    else:
+                        CC[:,_i] = np.correlate(D, G[:,_i], 'valid')
+                cross_correlation64[_j] = CC
+
+        self._cross_correlation64 = cross_correlation64
+        self._data_energy = data_energy
+
+        # likewise assigned last
+        self._autocorrelation = autocorrelation
+
 
 
 
 class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
-    def __init__(self, path, kernelwidth=12):
-        try:
-            db = instaseis.open_db(path)
-        except:
-            Exception
-        self.db = db
-        self.kernelwidth=12
+    """
+    Creates a GreensTensorList by extracting Green's functions from an
+    instaseis database
+
+    Green's functions for a 1-D model depend only on source depth and 
+    epicentral distance, not on azimuth, which enters only through the
+    weights computed by GreensTensor._precompute_weights. Distances are
+    therefore rounded to the nearest multiple of distance_tolerance (km),
+    and Green's functions are extracted once per rounded distance and depth
+    and shared by all stations that map to them, up to cache_bytes of
+    them being kept in memory. With distance_tolerance=0., only stations at
+    exactly the same distance share Green's functions. Since they are
+    extracted relative to a fixed reference time and shifted to the origin
+    time afterward, they are also shared between events at the same depth.
+
+    The database is opened once per process, path and buffer size, and
+    stays open, with its buffers, across factories and events. Database
+    handles are not thread-safe, so with nthreads > 1 (see
+    mtuq.greens_tensor.base.GreensTensorFactory.__call__), extraction is
+    serialized, while resampling and everything else run concurrently
+    """
+    def __init__(self, path, kernelwidth=12, distance_tolerance=0.,
+                 buffer_size_in_mb=100, cache_bytes=2**28):
+        self.path = path
+        self.db = open_db(path, buffer_size_in_mb)
+        self._lock = _database_locks[path, buffer_size_in_mb]
+        self.kernelwidth = kernelwidth
+        self.distance_tolerance = distance_tolerance
+
+        self._cache = LRUCache(cache_bytes, sizeof=lambda stream:
+            sum([trace.data.nbytes for trace in stream]))
 
 
     def get_greens_tensor(self, station, origin):
-        stream = self.db.get_greens_function(
-            epicentral_distance_in_degree=km2deg(station.distance),
-            source_depth_in_m=station.depth, 
-            origin_time=origin.time,
-            kind='displacement',
-            kernelwidth=self.kernelwidth,
-            definition=u'seiscomp')
-        stream.id = station.id
+        raw = self._get_greens_function(station.distance, origin)
 
         # what are the start and end times of the data?
         t1_new = float(station.starttime)
         t2_new = float(station.endtime)
         dt_new = float(station.delta)
 
-        # what are the start and end times of the Green's function?
-        t1_old = float(origin.time)+float(trace.stats.starttime)
-        t2_old = float(origin.time)+float(trace.stats.endtime)
-        dt_old = float(trace.stats.delta)
-
-        for trace in stream:
-            # resample Green's functions
-            data_old = trace.data
-            data_new = resample(data_old, t1_old, t2_old, dt_old, 
-                                          t1_new, t2_new, dt_new)
-            trace.data = data_new
+        # what are the start and end times of the Green's function, which
+        # was extracted relative to the reference time?
+        t1_old = float(raw[0].stats.starttime) + float(origin.time) -\
+            float(_REFERENCE_TIME)
+        t2_old = float(raw[0].stats.endtime) + float(origin.time) -\
+            float(_REFERENCE_TIME)
+        dt_old = float(raw[0].stats.delta)
+
+        traces = []
+        for trace in raw:
+            # resample Green's functions, leaving the shared traces as they 
+            # are
+            trace = obspy.Trace(resample(trace.data, t1_old, t2_old, dt_old,
+                t1_new, t2_new, dt_new), header=deepcopy(trace.stats))
             trace.stats.starttime = t1_new
             trace.stats.delta = dt_new
+            traces += [trace]
+
+        return GreensTensor(traces, station, origin)
+
+
+    def _get_greens_function(self, distance, origin):
+        """
+        Extracts Green's functions for the given distance (km), rounded as
+        described above, or returns those already extracted
 
-        traces = [trace for trace in stream]
-        return GreensTensor(stream, station, origin)
+        Green's functions do not depend on origin time, so they are
+        extracted for _REFERENCE_TIME and cached by distance and depth only
+        """
+        if self.distance_tolerance > 0.:
+            distance = self.distance_tolerance *\
+                round(distance/self.distance_tolerance)
+
+        def extract():
+            with self._lock:
+                stream = self.db.get_greens_function(
+                    epicentral_distance_in_degree=km2deg(distance),
+                    source_depth_in_m=origin.depth,
+                    origin_time=_REFERENCE_TIME,
+                    kind='displacement',
+                    kernelwidth=self.kernelwidth,
+                    definition=u'seiscomp')
+            for trace in stream:
+                trace.data.flags.writeable = False
+            return stream
+
+        return self._cache.get((distance, float(origin.depth)), extract)
+
+
+
+# origin time for which Green's functions are extracted
+_REFERENCE_TIME = obspy.UTCDateTime(0.)
+
+
+# instaseis databases already opened, by path and buffer size, and locks 
+# serializing reads from them
+_databases = {}
+_database_locks = {}
+_databases_lock = threading.Lock()
+
+
+def open_db(path, buffer_size_in_mb=100):
+    """
+    Returns an instaseis database handle for the given path and buffer size,
+    opening it only once per process
+
+    Handles are shared, so reads from more than one thread must hold the
+    corresponding lock in _database_locks
+    """
+    key = (path, buffer_size_in_mb)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = instaseis.open_db(path,
+                buffer_size_in_mb=buffer_size_in_mb)
+            _database_locks[key] = threading.Lock()
+    return _databases[key]
 
@@ -2,17 +2,23 @@
 import instaseis
 import obspy
 import numpy as np
+import io
+import os
 import re
+import threading
+import zipfile
 import mtuq.greens_tensor.base
 import mtuq.greens_tensor.instaseis
 
 from collections import defaultdict
 from copy import deepcopy
+from multiprocessing.pool import ThreadPool
 from os.path import basename, exists
-from obspy.core import Stream, Trace
-from mtuq.util.geodetics import km2deg
+from obspy.core import Stream, Trace, UTCDateTime
+from mtuq.util.cache import DiskCache
+from mtuq.util.geodetics import distance_azimuth, km2deg
 from mtuq.util.signal import resample
-from mtuq.util.util import path_mtuq, unzip, url2uuid, urlopen_with_retry
+from mtuq.util.util import iterable, path_mtuq, unzip, url2uuid
 
 
 # syngine is an webservice that provides Green's functions and synthetic
@@ -24,6 +30,9 @@ from mtuq.util.util import path_mtuq, unzip, url2uuid, urlopen_with_retry
 # mtuq.greens_tensor.instaseis
 
 
+BASE_URL = 'http://service.iris.edu/irisws/syngine/1/query'
+
+
 GREENS_TENSOR_FILENAMES = [
     'greensfunction_XX.GF001..ZSS.sac',
     'greensfunction_XX.GF001..ZDS.sac',
@@ -45,12 +54,11 @@ SYNTHETICS_FILENAMES = [
 
 
 class GreensTensor(mtuq.greens_tensor.instaseis.GreensTensor):
-    def _precompute_weights(self):
-        super(GreensTensor, self)._precompute_weights()
-
+    def _apply_signs(self, weighted_tensor):
         # the negative sign is needed because of a bug in syngine? or because 
         # of inconsistent moment tensor conventions?
-        self._weighted_tensor[2] *= -1
+        weighted_tensor[2] *= -1
+        return weighted_tensor
 
 
         # Order of terms expected by syngine URL parser (from online
@@ -66,19 +74,42 @@ class GreensTensor(mtuq.greens_tensor.instaseis.GreensTensor):
 
 
 class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
-    def __init__(self, model):
+    """
+    Creates a GreensTensorList by downloading Green's functions from syngine
+
+    Downloads for all stations of an event are issued concurrently, over
+    at most max_connections persistent connections (see Client). Any other
+    keyword arguments, such as base_url, are passed to Client
+    """
+    def __init__(self, model, max_connections=4, **kwargs):
         self.model = model
+        self.client = Client(max_connections=max_connections, **kwargs)
 
 
-    def get_greens_tensor(self, station, origin):
-        # download and unizp data
-        dirname = unzip(download_greens_tensor(self.model, station, origin))
+    def __call__(self, stations, origin, verbose=False, nthreads=1,
+                 on_error='raise'):
+        """
+        Reads Green's tensors corresponding to given stations and origin
+        """
+        stations = iterable(stations)
 
-        # read data
-        stream = Stream()
+        for station in stations:
+            station.distance, station.azimuth = distance_azimuth(
+                station, origin)
+
+        # download and unpack everything up front; any station whose download
+        # fails is tried again, and reported, by get_greens_tensor
+        self.client.download_greens_tensors(self.model, stations, origin,
+            raise_errors=False)
+
+        return super(GreensTensorFactory, self).__call__(
+            stations, origin, verbose, nthreads, on_error)
+
+
+    def get_greens_tensor(self, station, origin):
+        # download data, or read them from the cache
+        stream = self.client.read_greens_tensor(self.model, station, origin)
         stream.id = station.id
-        for filename in GREENS_TENSOR_FILENAMES:
-            stream += obspy.read(dirname+'/'+filename, format='sac')
 
         # what are the start and end times of the data?
         t1_new = float(station.starttime)
@@ -104,8 +135,235 @@ class GreensTensorFactory(mtuq.greens_tensor.base.GreensTensorFactory):
         return GreensTensor(traces, station, origin)
 
 
-def download_greens_tensor(model, station, origin):
-    """ Downloads Green's functions through syngine URL interface
+class Client(object):
+    """
+    HTTP client for the syngine web service
+
+    Keeps connections to the server alive between requests, retries failed
+    requests with exponential backoff, and downloads for several stations
+    concurrently, over at most max_connections connections
+
+    param base_url: URL of the syngine query endpoint, which can be pointed
+        at a mirror or at a local stand-in server
+    param max_connections: number of concurrent downloads and size of the
+        connection pool
+    param retries: number of times a failed request is retried
+    param backoff: backoff factor (s) between retries
+    param timeout: connect and read timeout (s)
+    param cache_path: directory in which downloads are saved
+    param max_bytes: upper bound on the size of cached Green's functions
+
+    Green's functions are unpacked once, when first downloaded, and stored
+    as arrays under a key derived from the query URL (see 
+    mtuq.util.cache.DiskCache), so that later reads skip unzipping and SAC
+    parsing. Least recently used entries are evicted once the cache exceeds
+    max_bytes. The cache can be shared by several processes, which then
+    download each Green's tensor only once
+
+    Zip files saved by get, as by download_greens_tensor and 
+    download_synthetics, bypass the cache: they are kept in the downloads 
+    subdirectory of cache_path, are never evicted and do not count toward
+    max_bytes
+    """
+    def __init__(self, base_url=BASE_URL, max_connections=4, retries=3,
+                 backoff=2., timeout=60., cache_path=None, max_bytes=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+
+        if not cache_path:
+            cache_path = path_mtuq()+'/'+'data/greens_tensor/syngine/cache'
+
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.cache = DiskCache(cache_path, max_bytes)
+        self.download_path = cache_path+'/'+'downloads'
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            max_retries=Retry(total=retries, backoff_factor=backoff,
+                status_forcelist=[429, 500, 502, 503, 504]))
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def get(self, url, filename):
+        """
+        Downloads url to filename, unless filename already exists
+
+        Files saved this way are not managed by the cache
+        """
+        if exists(filename):
+            return filename
+
+        dirname = os.path.dirname(filename)
+        if dirname and not exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by another thread or process meanwhile
+                pass
+
+        response = self.session.get(url, timeout=self.timeout, stream=True)
+        try:
+            response.raise_for_status()
+
+            # written under a temporary name and renamed into place, so that
+            # an interrupted download is never mistaken for a complete one
+            temp = '%s.tmp%d.%d' % (filename, os.getpid(),
+                threading.current_thread().ident)
+            with open(temp, 'wb') as file:
+                for chunk in response.iter_content(2**16):
+                    file.write(chunk)
+            os.rename(temp, filename)
+
+        finally:
+            response.close()
+
+        return filename
+
+
+    def get_content(self, url):
+        """
+        Returns the body of the response to url
+        """
+        response = self.session.get(url, timeout=self.timeout)
+        try:
+            response.raise_for_status()
+            return response.content
+        finally:
+            response.close()
+
+
+    def download_greens_tensors(self, model, stations, origin,
+                                raise_errors=True):
+        """
+        Downloads Green's functions for all given stations into the cache,
+        returning cache keys
+
+        Failed downloads do not interrupt the others. Afterwards, the first
+        exception is raised if raise_errors is True; otherwise, exceptions
+        are returned in place of the corresponding keys
+        """
+        urls = [greens_tensor_url(model, station, origin, self.base_url)
+            for station in stations]
+
+        return self._map(self._cache_greens_tensor, urls, raise_errors)
+
+
+    def read_greens_tensor(self, model, station, origin):
+        """
+        Returns Green's functions for the given station as an obspy Stream,
+        downloading them first if they are not in the cache
+        """
+        url = greens_tensor_url(model, station, origin, self.base_url)
+
+        # another process may evict the entry between caching and reading
+        for _ in range(2):
+            entry = self.cache.get(self._cache_greens_tensor(url))
+            if entry is not None:
+                break
+        else:
+            raise IOError("Green's functions evicted before they could be "
+                "read: %s" % url)
+
+        array, header = entry
+
+        stream = Stream()
+        for id, data in zip(header['ids'], array):
+            network, station, location, channel = id.split('.')
+            stream += Trace(data, header={
+                'network': network,
+                'station': station,
+                'location': location,
+                'channel': channel,
+                'starttime': UTCDateTime(header['starttime']),
+                'delta': header['delta'],
+                })
+        return stream
+
+
+    def _cache_greens_tensor(self, url):
+        """
+        Downloads and unpacks Green's functions, unless they are already in
+        the cache, and returns the cache key
+        """
+        key = str(url2uuid(url))
+        if key in self.cache:
+            return key
+
+        # only one process or thread downloads a given entry; the others
+        # wait, then find it in the cache
+        with self.cache.lock(key):
+            if key in self.cache:
+                return key
+
+            archive = zipfile.ZipFile(io.BytesIO(self.get_content(url)))
+            traces = [obspy.read(io.BytesIO(archive.read(filename)),
+                format='sac')[0] for filename in GREENS_TENSOR_FILENAMES]
+
+            self.cache.put(key, np.array([trace.data for trace in traces]), {
+                'ids': [trace.id for trace in traces],
+                'starttime': float(traces[0].stats.starttime),
+                'delta': float(traces[0].stats.delta),
+                })
+
+        return key
+
+
+    def _map(self, function, items, raise_errors=True):
+        """
+        Applies function to each item, in at most max_connections threads
+        """
+        def call(item):
+            try:
+                return function(item)
+            except Exception as error:
+                return error
+
+        if self.max_connections > 1 and len(items) > 1:
+            pool = ThreadPool(min(self.max_connections, len(items)))
+            try:
+                results = pool.map(call, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(call, items)
+
+        if raise_errors:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+
+        return results
+
+
+    def _get_filename(self, url):
+        return self.download_path+'/'+str(url2uuid(url))
+
+
+
+def get_client():
+    """
+    Returns a Client shared by the download functions below, so that they
+    reuse connections from call to call
+    """
+    global _client
+    if _client is None:
+        _client = Client()
+    return _client
+
+_client = None
+
+
+def greens_tensor_url(model, station, origin, base_url=BASE_URL):
+    """ Returns syngine URL for Green's functions
     """
     try:
         distance_in_deg = km2deg(station.distance)
@@ -113,7 +371,7 @@ def download_greens_tensor(model, station, origin):
         distance_in_deg = km2deg(station.catalog_distance)
     depth_in_m = origin.depth
 
-    url = ('http://service.iris.edu/irisws/syngine/1/query'
+    return (base_url
          +'?model='+model
          +'&dt='+str(station.delta)
          +'&greensfunction=1'
@@ -121,18 +379,12 @@ def download_greens_tensor(model, station, origin):
          +'&sourcedepthinmeters='+str(int(round(depth_in_m)))
          +'&origintime='+str(origin.time)[:-1]
          +'&starttime='+str(origin.time)[:-1])
-    filename = (path_mtuq()+'/'+'data/greens_tensor/syngine/cache/'
-         +str(url2uuid(url)))
-    if not exists(filename):
-        print ' Downloading Green''s functions for station %s' % station.station
-        urlopen_with_retry(url, filename+'.zip')
-    return filename
 
 
-def download_synthetics(model, station, origin, mt):
-    """ Downloads synthetics through syngine URL interface
+def synthetics_url(model, station, origin, mt, base_url=BASE_URL):
+    """ Returns syngine URL for synthetics
     """
-    url = ('http://service.iris.edu/irisws/syngine/1/query'
+    return (base_url
          +'?model='+model
          +'&dt='+str(station.delta)
          +'&components=ZRT'
@@ -144,11 +396,37 @@ def download_synthetics(model, station, origin, mt):
          +'&origintime='+str(origin.time)[:-1]
          +'&starttime='+str(origin.time)[:-1]
          +'&sourcemomenttensor='+re.sub('\+','',",".join(map(str, mt))))
-    filename = (path_mtuq()+'/'+'data/greens_tensor/syngine/cache/'
-         +str(url2uuid(url)))
-    if not exists(filename):
+
+
+def download_greens_tensor(model, station, origin, client=None):
+    """ Downloads Green's functions through syngine URL interface
+
+    Returns the name of the zip file, without extension. Such files are
+    not managed by the client's cache (see Client)
+    """
+    client = client or get_client()
+
+    url = greens_tensor_url(model, station, origin, client.base_url)
+    filename = client._get_filename(url)
+    if not exists(filename+'.zip'):
+        print ' Downloading Green''s functions for station %s' % station.station
+        client.get(url, filename+'.zip')
+    return filename
+
+
+def download_synthetics(model, station, origin, mt, client=None):
+    """ Downloads synthetics through syngine URL interface
+
+    Returns the name of the zip file, without extension. Such files are
+    not managed by the client's cache (see Client)
+    """
+    client = client or get_client()
+
+    url = synthetics_url(model, station, origin, mt, client.base_url)
+    filename = client._get_filename(url)
+    if not exists(filename+'.zip'):
         print ' Downloading waveforms for station %s' % station.station
-        urlopen_with_retry(url, filename+'.zip')
+        client.get(url, filename+'.zip')
     return filename
 
 
@@ -1,7 +1,11 @@
 
+import os
 import numpy as np
+from collections import OrderedDict
+from mtuq.util.checkpoint import Checkpoint
 from mtuq.util.grid import Grid, UnstructuredGrid
-from mtuq.util.math import PI
+from mtuq.util.math import PI, weighted_median
+from mtuq.util.reduction import BestPoints
 from mtuq.util.util import asarray, timer, timer_mpi
 
 from mtuq.util.moment_tensor import tape2015, change_basis
@@ -11,41 +15,812 @@ from mtuq.util.math import open_interval as regular
 
 
 @timer
-def grid_search_serial(data, greens, misfit, grid):
+def grid_search_serial(data, greens, misfit, grid, batch_size=None,
+        topk=None, histogram_bins=None, early_abandon=False,
+        checkpoint=None, checkpoint_interval=1, records=None):
     """ 
     Grid search over moment tensors. For each moment tensor in grid, generates
     synthetics and evaluates data misfit
+
+    If batch_size is given, moment tensors are pulled from the grid in blocks
+    of that size and each block is evaluated with a few matrix-matrix products
+    per station, rather than a python loop per moment tensor
+
+    If topk is given, rather than an array of misfit values at all grid
+    points, returns a BestPoints object holding only the topk lowest misfit
+    values and their grid indices, along with running statistics and, if
+    histogram_bins is given, a histogram of all misfit values. Memory use 
+    then stays bounded regardless of grid size
+
+    If early_abandon is True in addition to topk, the current topk-th best 
+    misfit is passed to the misfit function as a threshold, and evaluation of
+    a grid point stops as soon as it is proven unable to enter the topk best.
+    Such points are counted in BestPoints.nabandoned rather than in the 
+    running statistics
+
+    If checkpoint is given as an HDF5 file name, misfit values and the grid
+    cursor are written to that file every checkpoint_interval batches. If 
+    the file already exists, batches it marks as completed are skipped, so
+    a search killed partway through can be resumed by rerunning it with the
+    same arguments (see mtuq.util.checkpoint.Checkpoint). Checkpointing 
+    requires topk=None and implies batched evaluation
+
+    If records is given as a dictionary of record arrays, one per data 
+    category, each of shape (grid.size, nstations, 3) (see 
+    mtuq.misfit.cap.allocate_records), per-station, per-component time 
+    shifts and sums of residuals are written to them in grid order
     """
-    results = np.zeros(grid.size)
-    count = 0
+    if batch_size or checkpoint:
+        return _grid_search_batched(data, greens, misfit, grid,
+            batch_size or 1000, topk, histogram_bins, early_abandon,
+            checkpoint, checkpoint_interval, records)
+
+    results = _allocate(grid, topk, histogram_bins)
 
     for mt in grid:
         print grid.index
-        for key in data:
-            results[count] += misfit[key](data[key], greens[key], mt)
-        count += 1
+        value = _evaluate_point(data, greens, misfit, mt,
+            _threshold(results, early_abandon),
+            _select_records(records, grid, grid.index-1, grid.index))
+        _store(results, grid, grid.index-1, value)
 
     return results
 
 
 @timer_mpi
-def grid_search_mpi(data, greens, misfit, grid):
+def grid_search_mpi(data, greens, misfit, grid, batch_size=None,
+        load_balancing='static', topk=None, histogram_bins=None,
+        early_abandon=False, checkpoint=None, checkpoint_interval=1):
     """
     To carry out a grid search in parallel, we decompose the grid into subsets 
     and scatter using MPI. Each MPI process then runs grid_search_serial on its
     assigned subset
+
+    With load_balancing='dynamic', the grid is instead split into chunks of
+    batch_size points, which rank 0 hands out to the other ranks on request.
+    Faster ranks thereby end up evaluating more chunks than slower ones.
+    Rank 0 returns the complete array of results and the other ranks return
+    empty arrays, so that gathering and concatenating gives the same output
+    as in the static case
+
+    With topk, each process keeps only its topk best points, which are then 
+    merged through a tree reduction; the merged BestPoints object is 
+    returned on rank 0 and None on the other ranks. With early_abandon, each
+    process abandons points using its own topk-th best misfit, which is a
+    conservative bound on the global one
+
+    With checkpoint, each process writes its own file, named by inserting 
+    the rank before the file extension, in the static case, and rank 0 
+    alone writes the given file in the dynamic case. Resuming requires the
+    same number of processes in the static case
     """
     from mpi4py import MPI
     comm = MPI.COMM_WORLD
     iproc, nproc = comm.rank, comm.size
 
+    if load_balancing=='dynamic':
+        return _grid_search_dynamic(data, greens, misfit, grid,
+            batch_size or 1000, topk, histogram_bins, early_abandon,
+            checkpoint, checkpoint_interval)
+
+    elif load_balancing!='static':
+        raise ValueError('Bad parameter: load_balancing')
+
     if iproc == 0:
         subset = grid.decompose(nproc)
     else: 
         subset = None
     subset = comm.scatter(subset, root=0)
 
-    return grid_search_serial(data, greens, misfit, subset)
+    if checkpoint:
+        checkpoint = _rank_filename(checkpoint, iproc)
+
+    results = grid_search_serial(data, greens, misfit, subset, batch_size,
+        topk, histogram_bins, early_abandon, checkpoint, checkpoint_interval)
+
+    if topk:
+        return results.reduce_mpi(comm)
+    else:
+        return results
+
+
+@timer
+def grid_search_multiprocessing(data, greens, misfit, grid, nproc=None,
+        batch_size=1000, topk=None, histogram_bins=None, early_abandon=False,
+        checkpoint=None, checkpoint_interval=1):
+    """
+    Grid search over moment tensors using a pool of processes on a single
+    machine, without requiring MPI
+
+    Data and precomputed Green's function arrays are moved once into shared 
+    memory before the pool is created, and worker processes attach to them 
+    rather than receiving copies. The grid is split into chunks of batch_size
+    points, which are handed out to workers as they become free, and results
+    are reduced into a single array in grid order (or, if topk is given, into
+    a BestPoints object, see grid_search_serial). With early_abandon, each
+    worker abandons points using its own topk-th best misfit. Checkpointing
+    is carried out by the parent process, as in grid_search_serial
+
+    Relies on fork-based process creation (the default on Unix)
+    """
+    import multiprocessing
+    global _shared
+
+    if not nproc:
+        nproc = multiprocessing.cpu_count()
+
+    # fill in components, weights and cross-correlations in the parent
+    # process, so that workers inherit rather than recompute them
+    _evaluate_block(data, greens, misfit, grid.get_block(
+        grid.start, grid.start+1))
+    _share_arrays(data, greens)
+
+    results = _allocate(grid, topk, histogram_bins, batch_size,
+        checkpoint, checkpoint_interval)
+    chunks = _chunks(grid, batch_size, results)
+
+    if early_abandon:
+        _shared = (data, greens, misfit, grid, topk)
+    else:
+        _shared = (data, greens, misfit, grid, None)
+    pool = multiprocessing.Pool(nproc)
+    try:
+        # results are stored as each chunk arrives, rather than after all
+        # of them have been computed
+        for start, values in pool.imap(_evaluate_chunk, chunks, chunksize=1):
+            _store(results, grid, start, values)
+    finally:
+        pool.close()
+        pool.join()
+        _shared = None
+
+    return _finalize(results)
+
+
+def grid_search_magnitude(data, greens, misfit, grid, batch_size=1000,
+        max_bytes=2**28):
+    """
+    Grid search over moment tensors in which scalar moment is solved for
+    analytically rather than gridded
+
+    Synthetics are linear in the moment tensor, and cross-correlation time
+    shifts do not change under positive scaling, so each grid point needs to
+    be evaluated only once, at whatever magnitude the grid gives it. The 
+    best-fitting nonnegative scale factor is then found in closed form for
+    the L2 norm and, for the L1 norm, as a weighted median of the ratios of 
+    data to synthetics. With more than one data category under the L2 norm,
+    the sum of misfits is minimized by bisection
+
+    The grid should therefore be built for a single magnitude; points that
+    differ only in rho give identical results. All misfit functions must use
+    the same norm. Polarity penalties, which do not depend on scalar 
+    moment, are added to the misfit values
+
+    The L1 weighted median works on arrays of shape (nsamples, nmt), where
+    nsamples is the total number of data samples over all stations and 
+    components, and holds about _L1_BYTES bytes per entry at once. For the 
+    L1 norm, blocks are therefore split further so that no more than about
+    max_bytes are used; with 1000 points per block and a few hundred 
+    thousand samples, one unsplit block would need tens of GB
+
+    Returns misfit values at the best-fitting moment and the corresponding
+    moment magnitudes, as two arrays in grid order. Magnitude is -inf where
+    zero moment fits best
+    """
+    orders = set([misfit[key].order for key in data])
+    if len(orders) > 1:
+        raise NotImplementedError(
+            'Analytic magnitude requires all misfit functions to use the '
+            'same norm')
+    order = orders.pop()
+
+    if order == 1:
+        # how many moment tensors can go into one weighted median?
+        nsamples = sum([misfit[key].prepare(data[key], greens[key]).nsamples
+            for key in data])
+        size = max(int(max_bytes/(_L1_BYTES*max(nsamples, 1))), 1)
+
+    results = np.zeros(grid.size)
+    magnitudes = np.zeros(grid.size)
+
+    for start, stop, mt_block in grid.iter_blocks(batch_size):
+        if order == 2:
+            values, scale = _best_scale_l2([
+                misfit[key].get_quadratic_terms(data[key], greens[key], 
+                    mt_block) for key in data])
+        elif order == 1:
+            values = np.zeros(len(mt_block))
+            scale = np.zeros(len(mt_block))
+            for _i in range(0, len(mt_block), size):
+                values[_i:_i+size], scale[_i:_i+size] = _best_scale_l1([
+                    misfit[key].get_aligned_batch(data[key], greens[key],
+                        mt_block[_i:_i+size]) for key in data])
+        else:
+            raise NotImplementedError
+
+        # polarity penalties do not depend on scalar moment
+        for key in data:
+            if misfit[key].polarity_weight > 0.:
+                values = values + misfit[key].get_polarity_penalty(
+                    data[key], mt_block)
+
+        results[start-grid.start:stop-grid.start] = values
+        magnitudes[start-grid.start:stop-grid.start] = _magnitude(
+            scale[:,np.newaxis]*mt_block)
+
+    return results, magnitudes
+
+
+def _best_scale_l2(terms, niter=60):
+    """ Given quadratic coefficients (A, B, C) for each data category, finds
+    the nonnegative scale factor minimizing the sum of L2 misfits
+    """
+    A = np.array([term[0] for term in terms])
+    B = np.array([term[1] for term in terms])
+    C = np.array([term[2] for term in terms])
+
+    # scale factor minimizing each category on its own
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.where(A > 0., B/A, 0.)
+    alpha = np.maximum(alpha, 0.)
+
+    if len(terms) == 1:
+        scale = alpha[0]
+
+    else:
+        # the sum of misfits is convex, and its minimum lies between the 
+        # smallest and largest of the individual minima
+        lower = alpha.min(axis=0)
+        upper = alpha.max(axis=0)
+        for _ in range(niter):
+            middle = 0.5*(lower + upper)
+            q = np.maximum(A*middle**2 - 2.*B*middle + C, 0.)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = np.where(q > 0., (A*middle - B)/np.sqrt(q), 0.)
+            increasing = slope.sum(axis=0) > 0.
+            upper = np.where(increasing, middle, upper)
+            lower = np.where(increasing, lower, middle)
+        scale = 0.5*(lower + upper)
+
+    q = np.maximum(A*scale**2 - 2.*B*scale + C, 0.)
+    return np.sqrt(q).sum(axis=0), scale
+
+
+# approximate number of bytes held at once by _best_scale_l1 for each entry
+# of the (nsamples, nmt) synthetics array: synthetics, ratios and weights,
+# plus the sort order, sorted copies and cumulative sums in weighted_median
+_L1_BYTES = 96
+
+
+def _best_scale_l1(terms):
+    """ Given data, synthetics and weights for each data category, finds the
+    nonnegative scale factor minimizing the sum of L1 misfits
+    """
+    d = np.concatenate([term[0] for term in terms])
+    s = np.concatenate([term[1] for term in terms])
+    w = np.concatenate([term[2] for term in terms])
+
+    # sum(w*|d - scale*s|) equals sum(w*|s|*|d/s - scale|) plus a constant
+    # from samples where s is zero
+    nonzero = s != 0.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(nonzero, d[:,np.newaxis]/s, 0.)
+    weights = w[:,np.newaxis]*np.abs(s)
+
+    if d.size > 0:
+        scale = np.maximum(weighted_median(ratios, weights), 0.)
+    else:
+        scale = np.zeros(s.shape[1])
+
+    values = np.sum(w[:,np.newaxis]*np.abs(d[:,np.newaxis] - scale*s), 
+        axis=0)
+    return values, scale
+
+
+def _magnitude(mt_block):
+    """ Moment magnitudes of an (N, 6) array of moment tensors
+    """
+    M0 = np.sqrt(np.sum(mt_block[:,0:3]**2, axis=1) +
+        2.*np.sum(mt_block[:,3:6]**2, axis=1))/np.sqrt(2.)
+    with np.errstate(divide='ignore'):
+        return 2./3.*(np.log10(M0) - 9.1)
+
+
+def grid_search_variants(data, greens, variants, grid, batch_size=1000):
+    """
+    Grid search over moment tensors in which several misfit functions are 
+    evaluated in one pass
+
+    variants maps each data category to a MisfitVariants object (see 
+    mtuq.misfit.cap.MisfitVariants), all with the same number of variants.
+    Synthetics, cross-correlations and residuals are computed once per 
+    block, so comparing norms or time-shift groups costs about as much as 
+    a single grid search
+
+    Returns misfit values as an array of shape (grid.size, nvariants), 
+    summed over data categories
+    """
+    nvariants = set([len(variants[key]) for key in data])
+    if len(nvariants) > 1:
+        raise ValueError(
+            'All data categories must have the same number of variants')
+
+    results = np.zeros((grid.size, nvariants.pop()))
+
+    for start, stop, mt_block in grid.iter_blocks(batch_size):
+        for key in data:
+            results[start-grid.start:stop-grid.start] += \
+                variants[key].evaluate_batch(data[key], greens[key], mt_block)
+
+    return results
+
+
+def grid_search_adaptive(data, greens, misfit, grid, nlevels=3,
+        refinement=3, nbest=5, resolution=None, batch_size=1000,
+        periods={'kappa': 360.}):
+    """
+    Coarse-to-fine grid search over moment tensors
+
+    Evaluates misfit on a coarse structured grid, picks the lowest-misfit
+    cells, subdivides each of them by a factor of refinement along every 
+    axis, with one extra point on either side reaching into the neighboring
+    cells, and repeats. To keep several basins in play for multimodal
+    solutions, up to nbest cells are refined at each level, and a cell is
+    skipped if it borders one already chosen at that level. Points that 
+    have already been evaluated, such as the centers of cells refined by an
+    odd factor, are not evaluated again, but their stored misfit values
+    keep them in the running when cells are picked at the next level
+
+    Axes listed in periods, by default strike, are treated as angles: 
+    refined points are wrapped into [0, period), and cells on either side of
+    0 count as neighbors. Other axes are clipped to the extent of the grid
+
+    Refinement stops after nlevels levels or, if resolution is given as a
+    dictionary of target spacings, once all axes have reached them
+
+    Returns an UnstructuredGrid containing every evaluated point, each
+    exactly once, with the same callback as the input grid, along with the
+    corresponding misfit values, so that uncertainty estimates can still be
+    made
+    """
+    if not isinstance(grid, Grid):
+        raise TypeError('Adaptive search requires a structured Grid')
+
+    keys = list(grid.keys)
+    axes = [np.asarray(val, dtype=float) for val in grid.vals]
+    period = np.array([periods.get(key, 0.) for key in keys])
+
+    # the original grid points are taken to be cell centers
+    spacing = np.array([_spacing(axis) for axis in axes])
+    lower = np.array([axis.min() for axis in axes]) - spacing/2.
+    upper = np.array([axis.max() for axis in axes]) + spacing/2.
+
+    # points are identified by their coordinates in units much finer than
+    # the finest spacing, so that round-off cannot hide a duplicate
+    varying = spacing > 0.
+    unit = spacing[varying]/float(refinement)**(nlevels-1)/1000.
+
+    # evaluate coarse grid
+    points = grid.get_values(grid.start, grid.stop)
+    points = np.column_stack([points[key] for key in keys])
+    values = _grid_search_batched(data, greens, misfit, grid, batch_size)
+
+    all_points = [points]
+    all_values = [values]
+    evaluated = dict(zip(_point_keys(points, varying, unit), values))
+
+    for _ in range(nlevels-1):
+        if resolution is not None and all([spacing[_k] <= resolution[key]
+            for _k, key in enumerate(keys) if key in resolution]):
+            break
+
+        centers = _select_cells(points, values, spacing, nbest, period)
+
+        # subdivide the chosen cells, extending one new spacing beyond each
+        # of them, so that a minimum just across a cell boundary, in a 
+        # neighbor that was skipped, can still be reached
+        spacing = spacing/refinement
+        offsets = (np.arange(refinement+2) - (refinement+1)/2.)
+        points = []
+        for center in centers:
+            local_axes = []
+            for _k, x in enumerate(center):
+                if spacing[_k] == 0.:
+                    local = np.array([x])
+                elif period[_k] > 0.:
+                    local = np.mod(x + offsets*spacing[_k], period[_k])
+                else:
+                    local = x + offsets*spacing[_k]
+                    local = local[(lower[_k] <= local) & (local <= upper[_k])]
+                local_axes += [local]
+            mesh = np.meshgrid(*local_axes, indexing='ij')
+            points += [np.column_stack([m.ravel() for m in mesh])]
+        points = np.concatenate(points)
+
+        # every point of this level is a candidate for further refinement,
+        # but only points not seen before are evaluated; the others, such 
+        # as the centers of cells refined by an odd factor, keep their
+        # stored values
+        unique = OrderedDict()
+        for point, key in zip(points, _point_keys(points, varying, unit)):
+            unique.setdefault(key, point)
+        new = [key for key in unique if key not in evaluated]
+
+        if new:
+            subset = np.array([unique[key] for key in new])
+            values = _grid_search_batched(data, greens, misfit,
+                UnstructuredGrid(dict(zip(keys, subset.T)),
+                callback=grid.callback), batch_size)
+            evaluated.update(zip(new, values))
+
+            all_points += [subset]
+            all_values += [values]
+
+        points = np.array(unique.values())
+        values = np.array([evaluated[key] for key in unique])
+
+    all_points = np.concatenate(all_points)
+    all_values = np.concatenate(all_values)
+
+    return UnstructuredGrid(dict(zip(keys, all_points.T)),
+        callback=grid.callback), all_values
+
+
+def _spacing(axis):
+    """ Spacing between points along a grid axis, or zero for a constant axis
+    """
+    if len(axis) < 2:
+        return 0.
+    return np.median(np.diff(np.sort(axis)))
+
+
+def _point_keys(points, varying, unit):
+    """ Hashable keys identifying points, rounded to multiples of unit along
+    varying axes
+    """
+    return [tuple(key) for key in
+        np.round(points[:, varying]/unit).astype(np.int64)]
+
+
+def _select_cells(points, values, spacing, nbest, period):
+    """ Picks up to nbest lowest-misfit points, skipping any point that lies 
+    within one cell of a point already picked
+    """
+    varying = spacing > 0.
+    periodic = period[varying] > 0.
+    selected = []
+    for index in np.argsort(values):
+        if len(selected) >= nbest:
+            break
+        if np.isinf(values[index]):
+            break
+        point = points[index]
+        for other in selected:
+            difference = np.abs(point-other)[varying]
+            difference[periodic] = np.minimum(difference[periodic],
+                period[varying][periodic] - difference[periodic])
+            if np.all(difference/spacing[varying] <= 1.+1.e-6):
+                break
+        else:
+            selected += [point]
+    return selected
+
+
+# keeps work requests separate from other point-to-point messages, such as
+# those sent during BestPoints.reduce_mpi
+_TAG = 1
+
+
+def _grid_search_dynamic(data, greens, misfit, grid, batch_size,
+        topk=None, histogram_bins=None, early_abandon=False,
+        checkpoint=None, checkpoint_interval=1):
+    """
+    Master/worker grid search, in which rank 0 hands out chunks of grid 
+    indices on demand and workers send back results by index
+
+    Only rank 0 allocates results for the whole grid; workers hold one
+    chunk at a time or, with topk, their own BestPoints
+    """
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+
+    if comm.size == 1:
+        return _grid_search_batched(data, greens, misfit, grid, batch_size,
+            topk, histogram_bins, early_abandon, checkpoint,
+            checkpoint_interval)
+
+    if comm.rank == 0:
+        results = _allocate(grid, topk, histogram_bins, batch_size,
+            checkpoint, checkpoint_interval)
+        chunks = _chunks(grid, batch_size, results)
+    elif topk:
+        results = BestPoints(topk, histogram_bins)
+    else:
+        # values are sent to rank 0 chunk by chunk, so workers keep nothing
+        # of grid size
+        results = None
+
+    if comm.rank == 0:
+
+        status = MPI.Status()
+        nactive = comm.size-1
+        while nactive > 0:
+            # each message carries the previous chunk's results, if any, and
+            # doubles as a request for more work
+            message = comm.recv(source=MPI.ANY_SOURCE, tag=_TAG,
+                status=status)
+            if message is not None:
+                start, values = message
+                _store(results, grid, start, values)
+
+            if chunks:
+                comm.send(chunks.pop(0), dest=status.Get_source(), tag=_TAG)
+            else:
+                comm.send(None, dest=status.Get_source(), tag=_TAG)
+                nactive -= 1
+
+        results = _finalize(results)
+
+    else:
+        message = None
+        while True:
+            comm.send(message, dest=0, tag=_TAG)
+            chunk = comm.recv(source=0, tag=_TAG)
+            if chunk is None:
+                break
+
+            start, stop = chunk
+            values = _evaluate_block(data, greens, misfit,
+                grid.get_block(start, stop),
+                _threshold(results, early_abandon))
+
+            if topk:
+                # reduce locally, then merge at the end
+                _store(results, grid, start, values)
+                message = None
+            else:
+                message = (start, values)
+
+        if not topk:
+            results = np.zeros(0)
+
+    if topk:
+        return results.reduce_mpi(comm)
+    else:
+        return results
+
+
+def _grid_search_batched(data, greens, misfit, grid, batch_size,
+        topk=None, histogram_bins=None, early_abandon=False,
+        checkpoint=None, checkpoint_interval=1, records=None):
+    """
+    Evaluates misfit for blocks of batch_size moment tensors at a time
+    """
+    results = _allocate(grid, topk, histogram_bins, batch_size,
+        checkpoint, checkpoint_interval)
+
+    for start, stop in _chunks(grid, batch_size, results):
+        _store(results, grid, start,
+            _evaluate_block(data, greens, misfit, grid.get_block(start, stop),
+                _threshold(results, early_abandon),
+                _select_records(records, grid, start, stop)))
+
+    return _finalize(results)
+
+
+def _evaluate_point(data, greens, misfit, mt, threshold=None,
+        records=None):
+    """
+    Sums misfit over all data categories for a single moment tensor
+    """
+    if records is not None:
+        return _evaluate_block(data, greens, misfit, np.atleast_2d(mt),
+            threshold, records)[0]
+
+    if threshold is None:
+        value = 0.
+        for key in data:
+            value += misfit[key](data[key], greens[key], mt)
+        return value
+
+    value = 0.
+    for key in data:
+        value += misfit[key](data[key], greens[key], mt, threshold-value)
+        if np.isinf(value):
+            break
+    return value
+
+
+def _evaluate_block(data, greens, misfit, mt_block, threshold=None,
+        records=None):
+    """
+    Sums misfit over all data categories for a block of moment tensors
+    """
+    results = np.zeros(len(mt_block))
+
+    if threshold is None:
+        for key in data:
+            results += misfit[key].evaluate_batch(
+                data[key], greens[key], mt_block,
+                records=_get(records, key))
+        return results
+
+    for key in data:
+        # skip moment tensors already abandoned for a previous category
+        active = np.isfinite(results)
+        if not active.any():
+            break
+
+        if records is not None:
+            # fancy indexing would copy, so write through a temporary
+            subset = records[key][active]
+            results[active] += misfit[key].evaluate_batch(
+                data[key], greens[key], mt_block[active],
+                threshold-results[active], subset)
+            records[key][active] = subset
+        else:
+            results[active] += misfit[key].evaluate_batch(
+                data[key], greens[key], mt_block[active],
+                threshold-results[active])
+    return results
+
+
+def _select_records(records, grid, start, stop):
+    """
+    Returns views into each record array for grid points start through 
+    stop-1, or None
+    """
+    if records is None:
+        return None
+    return dict([(key, val[start-grid.start:stop-grid.start])
+        for key, val in records.items()])
+
+
+def _get(records, key):
+    if records is None:
+        return None
+    return records[key]
+
+
+def _threshold(results, early_abandon):
+    """
+    Returns the misfit value a grid point must beat to be worth finishing,
+    or None if points are never abandoned
+    """
+    if early_abandon and isinstance(results, BestPoints):
+        return results.threshold
+    else:
+        return None
+
+
+def _allocate(grid, topk=None, histogram_bins=None, batch_size=None,
+        checkpoint=None, checkpoint_interval=1):
+    """
+    Returns an array for misfit values at all grid points or, if topk is
+    given, a bounded-memory BestPoints object, or, if checkpoint is given,
+    a Checkpoint object backed by that file
+    """
+    if topk and checkpoint:
+        raise ValueError('Checkpointing requires topk=None')
+    elif topk:
+        return BestPoints(topk, histogram_bins)
+    elif checkpoint:
+        return Checkpoint(checkpoint, grid, batch_size, checkpoint_interval)
+    else:
+        return np.zeros(grid.size)
+
+
+def _chunks(grid, batch_size, results):
+    """
+    Returns (start, stop) pairs of grid indices still to be evaluated
+    """
+    if isinstance(results, Checkpoint):
+        return results.chunks()
+
+    chunks = []
+    for start in range(grid.start, grid.stop, batch_size):
+        chunks += [(start, min(start+batch_size, grid.stop))]
+    return chunks
+
+
+def _store(results, grid, start, values):
+    """
+    Stores misfit values for consecutive grid points beginning at start
+    """
+    values = np.atleast_1d(values)
+    if isinstance(results, BestPoints):
+        results.update(np.arange(start, start+values.size), values)
+    elif isinstance(results, Checkpoint):
+        results.update(start, values)
+    else:
+        results[start-grid.start:start-grid.start+values.size] = values
+
+
+def _finalize(results):
+    """
+    Writes any outstanding checkpoint data and returns the results
+    """
+    if isinstance(results, Checkpoint):
+        results.flush()
+        return results.results
+    return results
+
+
+def _rank_filename(filename, rank):
+    """
+    Inserts an MPI rank before the file extension
+    """
+    root, ext = os.path.splitext(filename)
+    return '%s_%04d%s' % (root, rank, ext)
+
+
+# data, Green's functions, misfit, grid and, with early abandonment, topk
+# inherited by worker processes in grid_search_multiprocessing
+_shared = None
+
+# each worker's own best points, used for early abandonment
+_local = None
+
+
+def _evaluate_chunk(chunk):
+    """
+    Evaluates misfit for grid points start through stop-1 in a worker
+    process, returning start along with the misfit values
+    """
+    global _local
+    data, greens, misfit, grid, topk = _shared
+    start, stop = chunk
+
+    if not topk:
+        return start, _evaluate_block(data, greens, misfit,
+            grid.get_block(start, stop))
+
+    if _local is None:
+        _local = BestPoints(topk)
+
+    values = _evaluate_block(data, greens, misfit,
+        grid.get_block(start, stop), _local.threshold)
+    _local.update(np.arange(start, stop), values)
+    return start, values
+
+
+def _share_arrays(data, greens):
+    """
+    Moves data and read-only precomputed Green's function arrays into shared 
+    memory
+    """
+    for key in data:
+        for stream in data[key]:
+            for trace in stream:
+                trace.data = _shared_copy(trace.data)
+
+        for greens_tensor in greens[key]:
+            if hasattr(greens_tensor, '_weighted_tensor'):
+                greens_tensor._weighted_tensor = [_shared_copy(array) 
+                    for array in greens_tensor._weighted_tensor]
+
+            for attr in ['_CCZ', '_CCR', '_CCT']:
+                if hasattr(greens_tensor, attr):
+                    setattr(greens_tensor, attr, 
+                        _shared_copy(getattr(greens_tensor, attr)))
+
+            for attr in ['_autocorrelation', '_cross_correlation64']:
+                if hasattr(greens_tensor, attr):
+                    setattr(greens_tensor, attr, [
+                        _shared_copy(array) if array is not None else None
+                        for array in getattr(greens_tensor, attr)])
+
+
+def _shared_copy(array):
+    """
+    Returns a copy of a numpy array backed by shared memory
+    """
+    from multiprocessing.sharedctypes import RawArray
+    buffer = RawArray('b', max(array.nbytes, 1))
+    copy = np.frombuffer(buffer, dtype=array.dtype, count=array.size)
+    copy = copy.reshape(array.shape)
+    copy[...] = array
+    return copy
 
 
 def FullMomentTensorGridRandom(Mw, npts=50000):
@@ -157,8 +932,14 @@ def callback(*args, **kwargs):
     """ Callback applied to each grid point; converts from Tape2015
         parameterization in which the grid is defined to Mij parameterization 
         used elsewhere in the code (up-south-east convention)
+
+        When applied to a block of grid points, i.e. when parameter values are
+        arrays, returns an array of moment tensors with shape (N, 6)
     """
-    from mtuq.util.moment_tensor.tape2015 import tt152cmt
+    from mtuq.util.moment_tensor.tape2015 import tt152cmt, tt152cmt_array
     #from mtuq.util.moment_tensor.change_basis import change_basis
-    return tt152cmt(*args, **kwargs)
+    if len(args)==1 and np.ndim(args[0].rho) > 0:
+        return tt152cmt_array(*args, **kwargs)
+    else:
+        return tt152cmt(*args, **kwargs)
 
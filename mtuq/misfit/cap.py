@@ -1,14 +1,44 @@
-
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from math import ceil, floor
 from scipy.signal import fftconvolve
+from mtuq.misfit import polarity
 from mtuq.util.math import isclose, list_intersect_with_indices
+from mtuq.util.util import AttribDict
 import numpy as np
+import threading
 import warnings
 
 
+# per-station, per-component misfit diagnostics (see allocate_records)
+RECORD_DTYPE = np.dtype([
+    ('time_shift', np.float64),
+    ('sum_residuals', np.float64),
+    ])
+
+# order of components along the last axis of record arrays
+RECORD_COMPONENTS = ['Z','R','T']
+
+# serializes creation of misfit plans, which writes to Green's tensors
+_prepare_lock = threading.Lock()
+
+
+def allocate_records(npoints, nstations):
+    """ Allocates a record array of shape (npoints, nstations, 3) for
+    time shifts and sums of residuals, indexed by moment tensor, station and
+    component (Z, R, T)
+
+    Entries not written by the misfit function, such as missing components
+    or abandoned moment tensors, remain NaN
+    """
+    records = np.empty((npoints, nstations, len(RECORD_COMPONENTS)),
+        dtype=RECORD_DTYPE)
+    records['time_shift'] = np.nan
+    records['sum_residuals'] = np.nan
+    return records
+
+
 class Misfit(object):
-    """ 
+    """
     CAP-style data misfit function
 
     Evaluating misfit is a two-step procedure:
@@ -18,15 +48,24 @@ class Misfit(object):
     In the first step, the user supplies a list of parameters, including
     the order of the norm applied to the residuals, whether or not to use
     polarity information, and various tuning parameters (see below for detailed
-    descriptions.) In the second step, the user supplies data and synthetics 
+    descriptions.) In the second step, the user supplies data and synthetics
     and gets back the corresponding misfit value.
+
+    Station and component layout is resolved once per dataset (see
+    Misfit.prepare), so the same misfit function can be used with more than
+    one dataset
     """
 
+    # number of datasets for which plans are kept at once
+    max_plans = 4
+
     def __init__(self,
         norm_order=1,
         polarity_weight=0.,
         time_shift_groups=['ZRT'],
         time_shift_max=0.,
+        engine='waveform',
+        taup_model='ak135',
         ):
         """ Checks misfit parameters
 
@@ -35,11 +74,34 @@ class Misfit(object):
             ['ZR','T'] locks vertical and radial components only
             ['Z','R','T'] allows time shifts to vary freely between components
 
+        engine
+            'waveform' generates synthetics and sums residuals sample by
+            sample
+            'gram' (L2 norm only) evaluates batches of moment tensors from
+            precomputed Green's function autocorrelations, data energies and
+            data-Green's function cross-correlations, at a cost independent
+            of trace length
+
+        polarity_weight
+            penalty added to the misfit for each station at which the
+            predicted first-motion polarity disagrees with the observed one;
+            with np.inf, inconsistent moment tensors are rejected before any
+            waveforms are compared. Observed polarities and, optionally,
+            takeoff angles are read from station metadata (see
+            mtuq.misfit.polarity); missing takeoff angles are computed with
+            taup_model
+
         """
         for group in time_shift_groups:
             for component in group:
                 assert component in ['Z','R','T']
 
+        if engine not in ['waveform', 'gram']:
+            raise ValueError('Bad parameter: engine')
+
+        if engine=='gram' and norm_order!=2:
+            raise ValueError('Bad parameter: norm_order')
+
         # what norm should we apply to the residuals?
         self.order = norm_order
 
@@ -51,83 +113,667 @@ class Misfit(object):
 
         # should we include polarities in misfit?
         self.polarity_weight = polarity_weight
+        self.taup_model = taup_model
 
-        # keeps track of what components are available in each stream
-        self._components = defaultdict(list)
+        # how should batches of moment tensors be evaluated?
+        self.engine = engine
 
+        # station and component layout for the most recently used datasets,
+        # keyed by identity of data and greens
+        self._plans = OrderedDict()
 
-    def __call__(self, data, greens, mt):
+        # observed polarities and radiation coefficients for the most recent
+        # dataset, as (data, polarities, coefficients)
+        self._polarities = None
+
+
+    def prepare(self, data, greens):
+        """ Returns a MisfitPlan for the given data and Green's tensors
+
+        Plans for the max_plans most recently used data and greens are kept,
+        so calling prepare again with the same objects is cheap, even when
+        one Misfit alternates between, say, body-wave and surface-wave
+        data, while a Misfit reused across many events holds on to only a
+        few of them. Components, weights, polarities and expected 
+        contributions are read when the plan is created; if they change
+        afterward, a new Misfit should be used
+
+        Plans are created under a lock and hold everything needed for
+        evaluation, so that once prepared, a dataset can be evaluated from
+        several threads at once
+        """
+        key = (id(data), id(greens))
+
+        with _prepare_lock:
+            plan = self._plans.pop(key, None)
+
+            # ids are reused once an object is freed, so identity is checked
+            # as well
+            if plan is None or plan.data is not data or\
+               plan.greens is not greens:
+                plan = MisfitPlan(self, data, greens)
+
+            # most recently used last
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+
+        return plan
+
+
+    def __call__(self, data, greens, mt, threshold=None, records=None):
         """ CAP-style misfit calculation
-        """ 
+
+        If a threshold is given, stations are visited in order of expected
+        contribution, and evaluation stops as soon as the partial misfit
+        exceeds the threshold, in which case infinity is returned
+
+        If a record array of shape (nstations, 3) is given (see
+        allocate_records), time shifts and sums of residuals are written to
+        it rather than to trace attributes, so that the same data can be
+        evaluated concurrently
+        """
+        plan = self.prepare(data, greens)
+
+        if records is not None:
+            return plan.evaluate_batch(mt, threshold, records[np.newaxis])[0]
+
+        return plan(mt, threshold)
+
+
+    def evaluate_batch(self, data, greens, mt_block, threshold=None,
+                       records=None):
+        """ CAP-style misfit calculation for a block of moment tensors
+
+        Given an array of shape (nmt, 6), returns an array of shape (nmt,)
+        equal to the values __call__ would return for each row of mt_block.
+        Synthetics are generated for the whole block through one matrix-matrix
+        product per component, and residuals are summed along the batch axis.
+
+        If a threshold is given (a scalar or one value per moment tensor),
+        moment tensors are dropped from the block as soon as their partial
+        misfit exceeds it, and infinity is returned for them
+
+        Unlike __call__, no time-shift or residual attributes are written to
+        the synthetics or data. Instead, if a record array of shape
+        (nmt, nstations, 3) is given (see allocate_records), time shifts and
+        sums of residuals are written to it. With engine='gram', synthetics
+        are not generated at all
+        """
+        return self.prepare(data, greens).evaluate_batch(
+            mt_block, threshold, records)
+
+
+    def get_quadratic_terms(self, data, greens, mt_block):
+        """ Coefficients of the squared L2 misfit as a function of scalar
+        moment
+
+        Synthetics are linear in the moment tensor, and cross-correlation
+        time shifts do not change under positive scaling, so the squared
+        misfit of alpha*mt is the quadratic A*alpha**2 - 2*B*alpha + C.
+        Returns arrays A, B and C of shape (nmt,)
+        """
+        if self.order != 2:
+            raise NotImplementedError
+
+        mt_block = np.atleast_2d(mt_block)
+        nmt = mt_block.shape[0]
+
+        A = np.zeros(nmt)
+        B = np.zeros(nmt)
+        C = np.zeros(nmt)
+        for d, s, w in self.prepare(data, greens).iter_aligned(mt_block):
+            A += w*np.sum(s**2, axis=0)
+            B += w*np.dot(d, s)
+            C += w*np.sum(d**2)
+
+        return A, B, C
+
+
+    def get_aligned_batch(self, data, greens, mt_block):
+        """ Data and time-shifted synthetics for a block of moment tensors
+
+        Returns arrays d, s and w of shapes (N,), (N, nmt) and (N,), where N
+        is the total number of samples over all stations and components and
+        w holds the corresponding trace weights times the sampling interval,
+        so that misfit equals (sum(w*|d - s|**p))**(1/p) column by column
+        """
+        mt_block = np.atleast_2d(mt_block)
+
+        d_all, s_all, w_all = [], [], []
+        for d, s, w in self.prepare(data, greens).iter_aligned(mt_block):
+            d_all += [d]
+            s_all += [s]
+            w_all += [w*np.ones(d.size)]
+
+        if not d_all:
+            return np.zeros(0), np.zeros((0, mt_block.shape[0])), np.zeros(0)
+
+        return np.concatenate(d_all), np.concatenate(s_all),\
+            np.concatenate(w_all)
+
+
+    def get_polarity_penalty(self, data, mt_block):
+        """ Returns polarity_weight times the number of stations with
+        inconsistent first-motion polarities, for each moment tensor
+
+        The penalty does not change under positive scaling of the moment
+        tensor, and is not included in get_quadratic_terms or
+        get_aligned_batch
+        """
+        # observed polarities and radiation coefficients depend only on
+        # data, and are kept for the most recent dataset
+        cached = self._polarities
+
+        if cached is None or cached[0] is not data:
+            cached = (data,) + self._get_polarity_terms(data)
+            self._polarities = cached
+
+        return self._get_polarity_penalty(mt_block, *cached[1:])
+
+
+    def _get_polarity_terms(self, data):
+        """ Returns observed polarities and radiation coefficients for the
+        stations at which polarities are observed
+        """
+        polarities = polarity.get_polarities(data)
+        observed = polarities != 0
+        if observed.any():
+            subset = [d for d, flag in zip(data, observed) if flag]
+            coefficients = polarity.get_coefficients(
+                polarity.get_takeoff_angles(subset, self.taup_model),
+                polarity.get_azimuths(subset))
+        else:
+            coefficients = np.zeros((0, 6))
+        return polarities[observed], coefficients
+
+
+    def _get_polarity_penalty(self, mt_block, polarities, coefficients):
+        """ Polarity penalty for each moment tensor, given observed
+        polarities and radiation coefficients
+        """
+        mismatches = polarity.get_mismatches(
+            mt_block, coefficients, polarities)
+
+        if np.isinf(self.polarity_weight):
+            return np.where(mismatches > 0, np.inf, 0.)
+        else:
+            return self.polarity_weight*mismatches
+
+
+    def _sum_residuals(self, s, d, out, axis=None):
+        """ Returns the sum of |s - d|**p, using out as scratch space
+
+        Gives the same result, bit for bit, as np.sum(np.abs(s - d)**p),
+        but without allocating temporaries. The L1 and L2 norms avoid the
+        generic power function
+        """
         p = self.order
 
-        sum_misfit = 0.
-        for _i, d in enumerate(data):
-            # what components are in stream d?
-            if _i not in self._components:
-                for trace in d:
-                    self._components[_i] += [trace.stats.channel[-1].upper()]
-                greens[_i].components = self._components[_i]
-
-            components = self._components[_i]
+        np.subtract(s, d, out=out)
+        if p == 1:
+            np.abs(out, out=out)
+        elif p == 2:
+            np.multiply(out, out, out=out)
+        else:
+            np.abs(out, out=out)
+            np.power(out, p, out=out)
+        return np.sum(out, axis=axis)
+
+
+class MisfitPlan(object):
+    """
+    Station and component layout of a CAP-style misfit function for a given
+    dataset
+
+    Created by Misfit.prepare. For each station with data, resolves once the
+    components present, which components belong to each
+    time-shift group, the time sampling and padding, and the mapping from
+    cross-correlation lag to first sample of the shifted synthetics, along
+    with the order in which to visit stations when a threshold is given.
+    Evaluating the plan repeatedly, as during a grid search, then involves
+    only numerical work
+    """
+    def __init__(self, misfit, data, greens):
+        # data and Green's tensors are paired by index; a mismatch usually
+        # means some Green's tensors could not be read (see
+        # GreensTensorFactory.__call__)
+        if len(data) != len(greens):
+            raise ValueError("Number of data streams (%d) differs from "
+                "number of Green's tensors (%d)" % (len(data), len(greens)))
+
+        self.misfit = misfit
+        self.data = data
+        self.greens = greens
+
+        # per-thread scratch arrays used by evaluate_batch
+        self._scratch = threading.local()
+
+        p = misfit.order
+
+        self.stations = []
+        for _i, (d, g) in enumerate(zip(data, greens)):
+            components = [trace.stats.channel[-1].upper() for trace in d]
+            g.components = components
             if not components:
                 continue
 
-            # generate synthetics
-            s = greens[_i].get_synthetics(mt)
+            station = AttribDict()
+            station.index = _i
+            station.data = d
+            station.greens = g
+            station.components = components
+
+            # cross-correlations and other arrays read during evaluation are
+            # computed now rather than on first use
+            if not hasattr(g, '_weighted_tensor'):
+                g._precompute_weights()
+            if not hasattr(g, '_cross_correlation'):
+                g._precompute_time_shifts(d, misfit.time_shift_max)
+            if misfit.engine=='gram' and not hasattr(g, '_autocorrelation'):
+                g._precompute_autocorrelations(d, misfit.time_shift_max)
 
             # time sampling scheme
-            npts = d[0].data.size
-            dt = d[0].stats.delta
-            npts_padding = int(self.time_shift_max/dt)
+            station.npts = d[0].data.size
+            station.dt = d[0].stats.delta
+            station.npts_padding = int(misfit.time_shift_max/station.dt)
+
+            # first sample of the shifted synthetics for each lag
+            station.starts = 2*station.npts_padding -\
+                np.arange(2*station.npts_padding+1)
+            station.offsets = np.arange(station.npts)[:,np.newaxis]
+
+            station.groups = []
+            for group in misfit.time_shift_groups:
+                # what components are in stream d?
+                group, indices = list_intersect_with_indices(components, group)
+                if not indices:
+                    continue
+
+                station.groups += [AttribDict({
+                    'group': group,
+                    'indices': indices,
+                    'components': [components[_j] for _j in indices],
+                    'records': [RECORD_COMPONENTS.index(components[_j])
+                        for _j in indices],
+                    })]
+
+            # trace weights, in the same order as components
+            station.weights = np.array([getattr(trace, 'weight', 1.)
+                for trace in d])
+
+            # expected contribution to the misfit, i.e. the misfit that zero
+            # synthetics would give
+            station.expected = sum([weight *
+                np.sum(np.abs(trace.data)**p)*trace.stats.delta
+                for weight, trace in zip(station.weights, d)])
+
+            # scratch space for residuals, allocated on first use
+            station.buffer = None
+
+            # length and precision of the synthetics generated by the Green's
+            # tensor, which exceed the data by the time-shift padding
+            station.npts_greens = g._weighted_tensor[0].shape[0]
+            station.dtype = g._weighted_tensor[0].dtype
+
+            self.stations += [station]
+
+        # observed polarities and radiation coefficients, kept with the plan
+        # so that datasets used in turn do not replace each other's
+        if misfit.polarity_weight > 0.:
+            self.polarities = misfit._get_polarity_terms(data)
+
+        # total number of data samples over stations and components, i.e.
+        # the length of the arrays returned by Misfit.get_aligned_batch
+        self.nsamples = sum([station.npts*len(group.indices)
+            for station in self.stations for group in station.groups])
+
+        # with a threshold, stations expected to contribute the most to the
+        # misfit are visited first, so that poor fits are detected sooner
+        self.threshold_order = [self.stations[int(_k)] for _k in
+            np.argsort([station.expected for station in self.stations])[::-1]]
+
+
+    def __call__(self, mt, threshold=None):
+        """ Misfit for a single moment tensor, writing time-shift and 
+        residual attributes to synthetics and data (see Misfit.__call__)
+        """
+        misfit = self.misfit
+        p = misfit.order
+
+        # CAP-style polarity calculation, carried out first so that
+        # inconsistent moment tensors can be rejected cheaply
+        penalty = 0.
+        if misfit.polarity_weight > 0.:
+            penalty = self.get_polarity_penalty(mt)[0]
+            if np.isinf(penalty):
+                return np.inf
+            if threshold is not None:
+                threshold = threshold-penalty
+
+        sum_misfit = 0.
+        for station in self._get_station_order(threshold):
+            d = station.data
+            npts = station.npts
+            dt = station.dt
+            npts_padding = station.npts_padding
 
+            # generate synthetics
+            s = station.greens.get_synthetics(mt)
 
             #
-            # PART 1: CAP-style waveform-difference misfit calculation, with
-            #     time-shift corrections
+            # CAP-style waveform-difference misfit calculation, with
+            # time-shift corrections
             #
-             
-            for group in self.time_shift_groups:
+
+            for group in station.groups:
                 # Finds the time-shift between data and synthetics that yields
-                # the maximum cross-correlation value across all components in 
+                # the maximum cross-correlation value across all components in
                 # in a given group, subject to time_shift_max constraint
-
-                # what components are in stream d?
-                group, indices = list_intersect_with_indices(components, group)
-
-                # what time-shift yields the maximum cross-correlation value?
-                result = greens[_i].get_time_shift(d, mt, group, self.time_shift_max)
+                result = station.greens.get_time_shift(
+                    d, mt, group.group, misfit.time_shift_max)
                 argmax = result.argmax()
                 time_shift = (argmax-npts_padding)*dt
 
-                # what start and stop indices will correctly shift synthetics 
+                # what start and stop indices will correctly shift synthetics
                 # relative to data?
-                start = 2*npts_padding-argmax
-                stop = 2*npts_padding-argmax+npts
+                start = station.starts[argmax]
+                stop = start+npts
 
-                for _j in indices:
+                for _j in group.indices:
                     s[_j].time_shift = time_shift
-                    s[_j].time_shift_group = group
+                    s[_j].time_shift_group = group.group
                     s[_j].start = start
                     s[_j].stop = stop
-                    
-                    # substract data from shifted synthetics
-                    r = s[_j].data[start:stop] - d[_j].data
+
+                    # substract data from shifted synthetics and sum the
+                    # resulting residuals
+                    d[_j].sum_residuals = misfit._sum_residuals(
+                        s[_j].data[start:stop], d[_j].data,
+                        self._get_buffer(station,
+                            np.result_type(s[_j].data, d[_j].data)))*dt
+                    sum_misfit += station.weights[_j] * d[_j].sum_residuals
+
+            if threshold is not None and sum_misfit > max(threshold, 0.)**p:
+                # this point can no longer beat the threshold
+                return np.inf
+
+        return sum_misfit**(1./p) + penalty
+
+
+    def evaluate_batch(self, mt_block, threshold=None, records=None):
+        """ Misfit for a block of moment tensors (see Misfit.evaluate_batch)
+        """
+        misfit = self.misfit
+        p = misfit.order
+
+        mt_block = np.atleast_2d(mt_block)
+        nmt = mt_block.shape[0]
+
+        # which moment tensors are still being evaluated?
+        active = np.arange(nmt)
+
+        # CAP-style polarity calculation, carried out for the whole block
+        # before any synthetics are generated
+        penalty = np.zeros(nmt)
+        if misfit.polarity_weight > 0.:
+            penalty = self.get_polarity_penalty(mt_block)
+            active = active[np.isfinite(penalty)]
+            if threshold is not None:
+                threshold = threshold-penalty
+
+        if threshold is not None:
+            threshold = np.maximum(threshold, 0.)**p * np.ones(nmt)
+
+        sum_misfit = np.zeros(nmt)
+        for station in self._get_station_order(threshold):
+            if active.size == 0:
+                break
+
+            _i = station.index
+            d = station.data
+            dt = station.dt
+
+            block = mt_block[active]
+            nblock = active.size
+
+            # generate synthetics, one (npts, nmt) array per component,
+            # written to scratch arrays reused from block to block
+            if misfit.engine=='waveform':
+                s = station.greens.get_synthetics_batch(block, out=[
+                    self._get_scratch('synthetics%d' % _j,
+                        (station.npts_greens, nblock), station.dtype)
+                    for _j in range(len(station.components))])
+
+                r = self._get_scratch('residuals', (station.npts, nblock),
+                    station.dtype)
+                index = self._get_scratch('index', (station.npts, nblock),
+                    np.intp)
+
+            for group in station.groups:
+                # what time-shift yields the maximum cross-correlation value?
+                lags = self._get_lags(station, block, group)
+
+                # what entries of the flattened synthetics array correctly
+                # shift synthetics relative to data?
+                if misfit.engine=='waveform':
+                    np.add(station.offsets*nblock,
+                        station.starts[lags]*nblock + np.arange(nblock),
+                        out=index)
+
+                for _j, component, _k in zip(
+                    group.indices, group.components, group.records):
+
+                    if misfit.engine=='gram':
+                        sum_residuals = station.greens.\
+                            get_squared_residuals_batch(d, block, component,
+                            lags, misfit.time_shift_max)*dt
+                    else:
+                        # substract data from shifted synthetics, using the
+                        # same scratch array for shifting and summing
+                        np.take(s[_j], index, out=r, mode='clip')
+                        sum_residuals = misfit._sum_residuals(
+                            r, d[_j].data[:,np.newaxis], r, axis=0)*dt
 
                     # sum the resulting residuals
-                    d[_j].sum_residuals = np.sum(np.abs(r)**p)*dt
-                    sum_misfit += d[_j].weight * d[_j].sum_residuals
+                    sum_misfit[active] += station.weights[_j] * sum_residuals
 
+                    if records is not None:
+                        records['time_shift'][active, _i, _k] =\
+                            (lags-station.npts_padding)*dt
+                        records['sum_residuals'][active, _i, _k] =\
+                            sum_residuals
 
+            if threshold is not None:
+                # drop moment tensors that can no longer beat the threshold
+                active = active[sum_misfit[active] <= threshold[active]]
 
-            #
-            # PART 2: CAP-style polarity calculation
-            #
+        results = sum_misfit**(1./p) + penalty
+
+        if threshold is not None or misfit.polarity_weight > 0.:
+            abandoned = np.ones(nmt, dtype=bool)
+            abandoned[active] = False
+            results[abandoned] = np.inf
+
+        return results
+
+
+    def iter_aligned(self, mt_block):
+        """ Yields data, time-shifted synthetics and weight times sampling
+        interval, one station component at a time
+        """
+        cols = np.arange(mt_block.shape[0])
+
+        for station in self.stations:
+            d = station.data
+            s = station.greens.get_synthetics_batch(mt_block)
+
+            for group in station.groups:
+                lags = self._get_lags(station, mt_block, group)
+                rows = station.starts[lags][np.newaxis,:] + station.offsets
+
+                for _j in group.indices:
+                    yield d[_j].data, s[_j][rows, cols],\
+                        station.weights[_j]*station.dt
+
+
+    def get_polarity_penalty(self, mt_block):
+        """ Polarity penalty for each moment tensor (see 
+        Misfit.get_polarity_penalty)
+        """
+        return self.misfit._get_polarity_penalty(mt_block, *self.polarities)
+
+
+    def _get_lags(self, station, mt_block, group):
+        """ Returns, for each moment tensor, the index of maximum
+        cross-correlation between data and synthetics
+        """
+        lags, _ = station.greens.get_time_shift_batch(
+            station.data, mt_block, group.group, self.misfit.time_shift_max)
+        return lags
+
+
+    def _get_station_order(self, threshold=None):
+        """ Returns stations in their original order or, if a threshold is
+        given, in order of decreasing expected contribution
+        """
+        if threshold is None:
+            return self.stations
+        else:
+            return self.threshold_order
+
+
+    def _get_scratch(self, name, shape, dtype):
+        """ Returns a C-contiguous scratch array of the given shape
+
+        Memory is reused from call to call, growing as needed, and is kept
+        separately for each thread, so that several threads can evaluate the
+        same plan at once
+        """
+        size = int(np.prod(shape))
+        buffer = getattr(self._scratch, name, None)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            buffer = np.empty(size, dtype=dtype)
+            setattr(self._scratch, name, buffer)
+        return buffer[:size].reshape(shape)
+
+
+    def _get_buffer(self, station, dtype):
+        """ Returns a scratch array for the given station, allocating it only
+        on first use
+        """
+        buffer = station.buffer
+        if buffer is None or buffer.dtype != dtype:
+            buffer = np.empty(station.npts, dtype=dtype)
+            station.buffer = buffer
+        return buffer
+
+
+class MisfitVariants(object):
+    """
+    Several CAP-style misfit functions evaluated in one pass
+
+    Given misfit functions that differ in norm order, time-shift groups or
+    polarity weight, but share time_shift_max, returns an array of shape
+    (nmt, nvariants) holding the values each misfit function would return.
+    Synthetics are generated once per station, cross-correlation time shifts
+    once per distinct time-shift group, and residuals once per group and
+    component; only the final sums are repeated for each norm
+
+    EXAMPLE
+
+        variants = MisfitVariants([
+            Misfit(norm_order=1, time_shift_groups=['ZRT'], **parameters),
+            Misfit(norm_order=2, time_shift_groups=['ZRT'], **parameters),
+            Misfit(norm_order=1, time_shift_groups=['ZR','T'], **parameters),
+            Misfit(norm_order=2, time_shift_groups=['ZR','T'], **parameters),
+            ])
+        values = variants.evaluate_batch(data, greens, mt_block)
+
+    """
+    def __init__(self, misfits):
+        misfits = list(misfits)
+
+        if not misfits:
+            raise ValueError('Bad parameter: misfits')
+
+        for misfit in misfits:
+            if misfit.time_shift_max != misfits[0].time_shift_max:
+                raise ValueError('Bad parameter: time_shift_max')
+
+            if misfit.engine != 'waveform':
+                raise ValueError('Bad parameter: engine')
+
+        self.misfits = misfits
+
+
+    def __len__(self):
+        return len(self.misfits)
+
+
+    def __call__(self, data, greens, mt):
+        """ Misfit values for a single moment tensor, one per variant
+        """
+        return self.evaluate_batch(data, greens, mt)[0]
+
+
+    def evaluate_batch(self, data, greens, mt_block):
+        """ Misfit values for a block of moment tensors, as an array of shape
+        (nmt, nvariants)
+        """
+        mt_block = np.atleast_2d(mt_block)
+        nmt = mt_block.shape[0]
+        cols = np.arange(nmt)
+
+        plans = [misfit.prepare(data, greens) for misfit in self.misfits]
+
+        sum_misfit = np.zeros((nmt, len(self.misfits)))
+        for stations in zip(*[plan.stations for plan in plans]):
+            d = stations[0].data
+            dt = stations[0].dt
+
+            # generate synthetics once for all variants
+            s = stations[0].greens.get_synthetics_batch(mt_block)
+
+            # residuals keyed by time-shift group, and sums of residuals keyed
+            # by group, component and norm order
+            residuals = {}
+            sums = {}
+
+            for _v, (plan, station) in enumerate(zip(plans, stations)):
+                p = plan.misfit.order
+
+                for group in station.groups:
+                    key = tuple(sorted(group.indices))
+
+                    if key not in residuals:
+                        # what time-shift yields the maximum cross-correlation
+                        # value, and what rows of the synthetics array
+                        # correctly shift synthetics relative to data?
+                        lags = plan._get_lags(station, mt_block, group)
+                        rows = station.starts[lags][np.newaxis,:] +\
+                            station.offsets
+
+                        # substract data from shifted synthetics
+                        residuals[key] = dict([(_j,
+                            s[_j][rows, cols] - d[_j].data[:,np.newaxis])
+                            for _j in group.indices])
+
+                    for _j in group.indices:
+                        if (key, _j, p) not in sums:
+                            r = residuals[key][_j]
+                            sums[key, _j, p] = plan.misfit._sum_residuals(
+                                r, 0., np.empty_like(r), axis=0)*dt
 
-            if self.polarity_weight > 0.:
-                raise NotImplementedError
+                        sum_misfit[:, _v] += station.weights[_j] *\
+                            sums[key, _j, p]
 
+        results = np.empty((nmt, len(self.misfits)))
+        for _v, misfit in enumerate(self.misfits):
+            results[:, _v] = sum_misfit[:, _v]**(1./misfit.order)
 
-        return sum_misfit**(1./p)
+            if misfit.polarity_weight > 0.:
+                results[:, _v] += misfit.get_polarity_penalty(data, mt_block)
 
+        return results
 
@@ -0,0 +1,93 @@
+
+import numpy as np
+
+
+def get_polarities(data):
+    """ Returns observed first-motion polarities, one per station
+
+    Polarities are read from the station metadata attribute "polarity"
+    (+1 for up, -1 for down); stations without a polarity get 0
+    """
+    polarities = []
+    for stream in data:
+        meta = getattr(stream, 'meta', {})
+        polarities += [np.sign(meta.get('polarity', 0.) or 0.)]
+    return np.array(polarities)
+
+
+def get_takeoff_angles(data, taup_model='ak135'):
+    """ Returns P-wave takeoff angles in degrees from the downward vertical,
+    one per station
+
+    Angles are read from the station metadata attribute "takeoff_angle" or,
+    if it is missing, computed from catalog depth and distance with
+    obspy.taup
+    """
+    angles = []
+    model = None
+    for stream in data:
+        meta = stream.meta
+        if 'takeoff_angle' in meta:
+            angles += [meta.takeoff_angle]
+            continue
+
+        from obspy.geodetics import kilometer2degrees
+        if model is None:
+            from obspy.taup import TauPyModel
+            model = TauPyModel(taup_model)
+
+        arrivals = model.get_travel_times(
+            source_depth_in_km=meta.catalog_depth/1000.,
+            distance_in_degree=kilometer2degrees(meta.catalog_distance),
+            phase_list=['p', 'P'])
+
+        if not arrivals:
+            raise Exception('Could not determine takeoff angle')
+        angles += [arrivals[0].takeoff_angle]
+
+    return np.array(angles, dtype=float)
+
+
+def get_azimuths(data):
+    """ Returns source-to-station azimuths in degrees, one per station
+    """
+    return np.array([stream.meta.catalog_azimuth for stream in data],
+        dtype=float)
+
+
+def get_coefficients(takeoff_angles, azimuths):
+    """ Returns an array of shape (nsta, 6) which, multiplied by an
+    up-south-east moment tensor, gives the P-wave radiation amplitude along
+    each station's ray
+
+    The ray direction in up-south-east coordinates is
+    (-cos(i), -sin(i) cos(phi), sin(i) sin(phi)), where i is the takeoff
+    angle from the downward vertical and phi is azimuth clockwise from north
+    """
+    i = np.deg2rad(takeoff_angles)
+    phi = np.deg2rad(azimuths)
+
+    up = -np.cos(i)
+    south = -np.sin(i)*np.cos(phi)
+    east = np.sin(i)*np.sin(phi)
+
+    return np.column_stack([
+        up**2,
+        south**2,
+        east**2,
+        2.*up*south,
+        2.*up*east,
+        2.*south*east])
+
+
+def get_mismatches(mt_block, coefficients, polarities):
+    """ Returns the number of stations at which each moment tensor predicts
+    the wrong first-motion polarity
+
+    Stations with zero observed polarity are ignored
+    """
+    mt_block = np.atleast_2d(mt_block)
+    predicted = np.sign(np.dot(mt_block, coefficients.T))
+    observed = polarities[np.newaxis,:]
+    return np.sum((observed != 0) & (predicted != observed), axis=1)
+
@@ -5,7 +5,7 @@ import numpy as np
 
 from collections import defaultdict
 from copy import deepcopy
-from os.path import basename, exists, join
+from os.path import basename, exists, isfile, join
 from obspy.geodetics import kilometers2degrees as km2deg
 from mtuq.util.cap_util import taper, parse_weight_file
 from mtuq.util.signal import cut
@@ -141,6 +141,17 @@ class ProcessData(object):
             self.padding_length = 0.
 
 
+        #
+        # check precision
+        #
+        if 'dtype' in parameters:
+            # e.g. np.float32, to halve memory use and bandwidth in 
+            # synthetics and misfit calculations
+            self.dtype = np.dtype(parameters['dtype'])
+        else:
+            self.dtype = None
+
+
         #
         # check weight parameters
         #
@@ -285,6 +296,15 @@ class ProcessData(object):
                 picks.S = sac_headers.t6
 
 
+            elif self.pick_type=='from_fk_database' and\
+                 isfile(self._fk_database):
+                # single file written by mtuq.greens_tensor.fk.pack_database
+                from mtuq.greens_tensor.fk import open_database
+                picks.P, picks.S = open_database(self._fk_database).get_picks(
+                     int(round(meta.catalog_depth/1000.)),
+                     int(round(meta.catalog_distance)))
+
+
             elif self.pick_type=='from_fk_database':
                 sac_headers = obspy.read('%s/%s_%s/%s.grn.0' %
                     (self._fk_database,
@@ -467,6 +487,15 @@ class ProcessData(object):
                 trace.data *= 1.
 
 
+        #
+        # part 5: convert to requested precision
+        #
+
+        if self.dtype:
+            for trace in traces:
+                trace.data = trace.data.astype(self.dtype)
+
+
         return traces
 
 
@@ -0,0 +1,310 @@
+
+import json
+import os
+import threading
+import time
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from glob import glob
+from os.path import exists, getmtime, getsize, join
+
+
+class LRUCache(object):
+    """ Read-through cache holding up to max_bytes of values
+
+    Values are looked up by key and, if missing, created by calling the
+    given function, after which least recently used values are dropped
+    until the total size is within max_bytes. A single value larger than
+    max_bytes is returned but not kept. The cache can be shared between
+    threads
+
+    param max_bytes: upper bound on the total size of cached values
+    param sizeof: function returning the size of a value in bytes
+
+
+    EXAMPLE
+
+        cache = LRUCache(2**28, sizeof=lambda trace: trace.data.nbytes)
+        trace = cache.get(filename, lambda: obspy.read(filename)[0])
+
+    """
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, function):
+        """ Returns the value cached under key or, if there is none, the
+        result of function()
+        """
+        with self._lock:
+            if key in self._values:
+                # move to the most recently used end
+                value, size = self._values.pop(key)
+                self._values[key] = (value, size)
+                self.hits += 1
+                return value
+
+        # created outside the lock, so that other keys can be served
+        # meanwhile; if two threads miss on the same key, both create it
+        value = function()
+        size = self.sizeof(value)
+
+        with self._lock:
+            self.misses += 1
+            if key in self._values or size > self.max_bytes:
+                return value
+
+            self._values[key] = (value, size)
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._values.popitem(last=False)
+                self.nbytes -= size
+
+        return value
+
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.nbytes = 0
+
+
+    def __contains__(self, key):
+        return key in self._values
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+class DiskCache(object):
+    """ Directory of arrays with JSON headers, evicted least recently used
+    first
+
+    Each entry is an .npy file holding an array and a .json file holding a
+    header dictionary. Both are written under temporary names and renamed
+    into place, header last, so that an entry is either complete or not
+    visible at all. The .json file also records the inode and size of the
+    .npy file it was written with, and entries whose files do not match, 
+    as after a crash between the two renames, are treated as missing.
+    Entries are read back memory-mapped copy-on-write, and reading an 
+    entry counts as using it, unless the directory is read-only.
+
+    If max_bytes is given, least recently used entries are deleted after 
+    each write until the total size is within max_bytes.
+
+    The cache can be shared between processes, such as MPI ranks or jobs
+    on a shared filesystem. Eviction holds an exclusive lock on a lock file
+    in the directory, and lock(key) lets processes agree on which of them
+    creates a given entry, through a lock file removed again on release. Readers that find an entry deleted under them 
+    treat it as missing; entries already memory-mapped remain readable
+
+    param path: cache directory, created if necessary
+    param max_bytes: upper bound on the total size of entries
+
+
+    EXAMPLE
+
+        cache = DiskCache('cache', max_bytes=10**10)
+        with cache.lock(key):
+            if key not in cache:
+                cache.put(key, array, {'delta': delta})
+        array, header = cache.get(key)
+
+    """
+    def __init__(self, path, max_bytes=None):
+        if not exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by another process meanwhile
+                pass
+
+        self.path = path
+        self.max_bytes = max_bytes
+
+
+    def get(self, key):
+        """ Returns (array, header) for the given key, or None
+        """
+        filename = join(self.path, key)
+
+        try:
+            with open(filename+'.json') as file:
+                manifest = json.load(file)
+
+            # is the array the one the header was written with? checked
+            # before and after reading, in case it is replaced meanwhile
+            if _identify(filename+'.npy') != manifest['array']:
+                return None
+            array = np.load(filename+'.npy', mmap_mode='c')
+            if _identify(filename+'.npy') != manifest['array']:
+                return None
+
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        try:
+            # least recently used entries are evicted first; file system
+            # timestamps can be coarser than the interval between accesses,
+            # so the time is given explicitly
+            now = time.time()
+            os.utime(filename+'.json', (now, now))
+        except OSError:
+            # read-only cache
+            pass
+
+        return array, manifest['header']
+
+
+    def put(self, key, array, header):
+        """ Stores array and header under the given key, then evicts least
+        recently used entries if necessary
+        """
+        filename = join(self.path, key)
+        suffix = '.tmp%d.%d' % (os.getpid(), threading.current_thread().ident)
+
+        with open(filename+'.npy'+suffix, 'wb') as file:
+            np.save(file, array)
+        os.rename(filename+'.npy'+suffix, filename+'.npy')
+
+        with open(filename+'.json'+suffix, 'w') as file:
+            json.dump({
+                'header': header,
+                'array': _identify(filename+'.npy'),
+                }, file)
+        now = time.time()
+        os.utime(filename+'.json'+suffix, (now, now))
+        os.rename(filename+'.json'+suffix, filename+'.json')
+
+        self.evict()
+
+
+    @contextmanager
+    def lock(self, key=None):
+        """ Holds an exclusive lock on the given key or, if no key is given,
+        on the whole cache
+        """
+        import fcntl
+
+        if key is None:
+            filename = join(self.path, '.lock')
+        else:
+            filename = join(self.path, key+'.lock')
+
+        # POSIX record locks, which unlike flock also work over NFS, are held
+        # by the process as a whole, so threads also need a lock of their own
+        with _get_thread_lock(filename):
+            while True:
+                file = open(filename, 'a')
+                fcntl.lockf(file, fcntl.LOCK_EX)
+
+                # per-key lock files are removed on release, so the file
+                # locked may no longer be the one in the directory
+                try:
+                    if os.fstat(file.fileno()).st_ino ==\
+                       os.stat(filename).st_ino:
+                        break
+                except OSError:
+                    pass
+                file.close()
+
+            try:
+                yield
+            finally:
+                if key is not None:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                fcntl.lockf(file, fcntl.LOCK_UN)
+                file.close()
+
+
+    def evict(self):
+        """ Deletes least recently used entries until the total size is
+        within max_bytes
+        """
+        if self.max_bytes is None:
+            return
+
+        with self.lock():
+            entries = []
+            for key in self.keys():
+                filename = join(self.path, key)
+                try:
+                    entries += [(getmtime(filename+'.json'), key,
+                        getsize(filename+'.npy') + getsize(filename+'.json'))]
+                except OSError:
+                    pass
+
+            total = sum([size for _, _, size in entries])
+            for _, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self.delete(key)
+                total -= size
+
+
+    def delete(self, key):
+        # the header goes first, so that no entry is visible without its
+        # array
+        for extension in ['.json', '.npy']:
+            try:
+                os.remove(join(self.path, key)+extension)
+            except OSError:
+                pass
+
+
+    def clear(self):
+        """ Deletes all entries
+        """
+        with self.lock():
+            for key in self.keys():
+                self.delete(key)
+
+
+    def keys(self):
+        """ Returns keys of complete entries
+        """
+        keys = []
+        for filename in glob(join(self.path, '*.json')):
+            if exists(filename[:-len('.json')]+'.npy'):
+                keys += [os.path.basename(filename)[:-len('.json')]]
+        return keys
+
+
+    def __contains__(self, key):
+        filename = join(self.path, key)
+        return exists(filename+'.json') and exists(filename+'.npy')
+
+
+def _identify(filename):
+    """ Returns the inode and size of a file, which together tell apart
+    files successively renamed into place under the same name
+    """
+    stat = os.stat(filename)
+    return [stat.st_ino, stat.st_size]
+
+
+# thread locks by lock file name (see DiskCache.lock)
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _get_thread_lock(filename):
+    with _thread_locks_lock:
+        if filename not in _thread_locks:
+            _thread_locks[filename] = threading.Lock()
+        return _thread_locks[filename]
+
@@ -0,0 +1,158 @@
+
+import os
+import numpy as np
+
+
+class Checkpoint(object):
+    """ Periodically saves partial grid search results to HDF5
+
+    The grid is split into chunks of batch_size points. As chunks are
+    evaluated, their misfit values are written to the file along with a flag
+    marking the chunk as completed and the grid cursor (start, stop and the
+    first index not yet completed). Only chunks evaluated since the last
+    write are written, so the cost of a checkpoint does not grow with grid
+    size
+
+    If the file already exists, it is read back and chunks marked as
+    completed are skipped, so that an interrupted search can be resumed by
+    rerunning it with the same arguments. ValueError is raised if the file
+    was written for a different grid, including one with the same size but
+    different axis values
+
+    Grid axes are written alongside the misfit values in the same layout as
+    Grid.save, so a finished checkpoint file can be used in place of the
+    output of Grid.save
+
+    param filename: HDF5 file name
+    param grid: Grid or UnstructuredGrid being searched
+    param batch_size: number of grid points per chunk
+    param interval: number of completed chunks between writes
+
+
+    EXAMPLE
+
+        checkpoint = Checkpoint('misfit.h5', grid, 1000)
+        for start, stop in checkpoint.chunks():
+            checkpoint.update(start, misfit(grid.get_block(start, stop)))
+        checkpoint.flush()
+        checkpoint.results
+
+    """
+    def __init__(self, filename, grid, batch_size, interval=1):
+        self.filename = filename
+        self.grid = grid
+        self.batch_size = batch_size
+        self.interval = max(interval, 1)
+
+        self.starts = np.arange(grid.start, grid.stop, batch_size)
+
+        # chunks completed since the last write
+        self._pending = []
+
+        if os.path.exists(filename):
+            self._load()
+        else:
+            self.results = np.nan*np.ones(grid.stop-grid.start)
+            self.completed = np.zeros(len(self.starts), dtype=bool)
+            self._create()
+
+
+    def chunks(self):
+        """ Returns (start, stop) pairs of chunks not yet completed
+        """
+        chunks = []
+        for start, completed in zip(self.starts, self.completed):
+            if not completed:
+                chunks += [(start, min(start+self.batch_size, self.grid.stop))]
+        return chunks
+
+
+    def update(self, start, values):
+        """ Stores misfit values for the chunk beginning at start, writing to
+        disk every interval chunks
+        """
+        values = np.atleast_1d(values)
+        offset = start-self.grid.start
+        self.results[offset:offset+values.size] = values
+        self.completed[offset//self.batch_size] = True
+
+        self._pending += [offset//self.batch_size]
+        if len(self._pending) >= self.interval:
+            self.flush()
+
+
+    def flush(self):
+        """ Writes all chunks completed since the last write
+        """
+        if not self._pending:
+            return
+
+        import h5py
+        with h5py.File(self.filename, 'r+') as hf:
+            # misfit values are written before completion flags, so that a
+            # job killed in between only loses the chunks being written
+            for _k in self._pending:
+                offset = _k*self.batch_size
+                stop = min(offset+self.batch_size, self.results.size)
+                hf['misfit'][offset:stop] = self.results[offset:stop]
+            hf.flush()
+
+            hf['completed'][...] = self.completed
+            hf.attrs['index'] = self.index
+
+        self._pending = []
+
+
+    @property
+    def index(self):
+        """ First grid index not yet completed, or stop if the search is
+        finished
+        """
+        remaining = np.where(~self.completed)[0]
+        if remaining.size == 0:
+            return self.grid.stop
+        return self.starts[remaining[0]]
+
+
+    @property
+    def finished(self):
+        return self.completed.all()
+
+
+    def _create(self):
+        import h5py
+        with h5py.File(self.filename, 'w') as hf:
+            for key, val in zip(self.grid.keys, self.grid.vals):
+                hf.create_dataset(key, data=val)
+
+            hf.create_dataset('misfit', data=self.results,
+                chunks=(max(min(self.batch_size, self.results.size), 1),))
+            hf.create_dataset('completed', data=self.completed)
+
+            hf.attrs['start'] = self.grid.start
+            hf.attrs['stop'] = self.grid.stop
+            hf.attrs['index'] = self.index
+            hf.attrs['batch_size'] = self.batch_size
+
+
+    def _load(self):
+        import h5py
+        with h5py.File(self.filename, 'r') as hf:
+            if hf.attrs['start'] != self.grid.start or\
+               hf.attrs['stop'] != self.grid.stop or\
+               hf.attrs['batch_size'] != self.batch_size:
+                raise ValueError(
+                    'Checkpoint file does not match grid: %s' % self.filename)
+
+            # a regenerated grid, such as a random grid drawn with a new
+            # seed, must not be merged with misfit values from the old one
+            for key, val in zip(self.grid.keys, self.grid.vals):
+                if key not in hf or\
+                   not np.array_equal(hf[key][...], np.asarray(val)):
+                    raise ValueError(
+                        'Checkpoint file does not match grid: %s' % 
+                        self.filename)
+
+            self.results = hf['misfit'][...]
+            self.completed = hf['completed'][...].astype(bool)
+
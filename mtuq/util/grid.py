@@ -81,6 +81,45 @@ class Grid(object):
             return p
 
 
+    def get_values(self, start, stop):
+        """ Returns parameter values at points start through stop-1
+
+        Values are returned as a dictionary of contiguous arrays, one for each
+        parameter, rather than point by point
+        """
+        indices = np.unravel_index(np.arange(start, stop), self.shape,
+            order='F')
+
+        p = AttribDict()
+        for key, val, index in zip(self.keys, self.vals, indices):
+            p[key] = np.asarray(val)[index]
+        return p
+
+
+    def get_block(self, start, stop):
+        """ Returns points start through stop-1 of grid
+
+        The callback, if any, is applied to the whole block of parameter 
+        values at once and so must accept arrays
+        """
+        p = self.get_values(start, stop)
+
+        if self.callback:
+            return self.callback(p)
+        else:
+            return p
+
+
+    def iter_blocks(self, block_size):
+        """ Iterates over the grid in blocks of up to block_size points
+
+        Yields start index, stop index, and block for each block
+        """
+        for start in range(self.start, self.stop, block_size):
+            stop = min(start+block_size, self.stop)
+            yield start, stop, self.get_block(start, stop)
+
+
     def decompose(self, nproc):
         """ Decomposes grid for parallel processing
         """
@@ -91,7 +130,7 @@ class Grid(object):
         for iproc in range(nproc):
             start=iproc*self.size/nproc
             stop=(iproc+1)*self.size/nproc
-            items = zip(self.keys, self.values)
+            items = zip(self.keys, self.vals)
             subsets += [Grid(dict(items), start, stop, callback=self.callback)]
         return subsets
 
@@ -177,6 +216,42 @@ class UnstructuredGrid(object):
             return p
 
 
+    def get_values(self, start, stop):
+        """ Returns parameter values at points start through stop-1
+
+        Values are returned as a dictionary of contiguous arrays, one for each
+        parameter, rather than point by point
+        """
+        p = AttribDict()
+        for key, val in zip(self.keys, self.vals):
+            p[key] = np.asarray(val)[start-self.start:stop-self.start]
+        return p
+
+
+    def get_block(self, start, stop):
+        """ Returns points start through stop-1 of grid
+
+        The callback, if any, is applied to the whole block of parameter 
+        values at once and so must accept arrays
+        """
+        p = self.get_values(start, stop)
+
+        if self.callback:
+            return self.callback(p)
+        else:
+            return p
+
+
+    def iter_blocks(self, block_size):
+        """ Iterates over the grid in blocks of up to block_size points
+
+        Yields start index, stop index, and block for each block
+        """
+        for start in range(self.start, self.stop, block_size):
+            stop = min(start+block_size, self.stop)
+            yield start, stop, self.get_block(start, stop)
+
+
     def decompose(self, nproc):
         """ Decomposes grid for parallel processing
         """
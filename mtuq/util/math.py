@@ -90,6 +90,62 @@ def rotmat_gen(v, xi):
             rotmat(-vph*DEG,2))
 
 
+def rotmat_array(xdeg, idx):
+    """ Stacked 3D rotation matrices about given axis
+
+    Given an array of N angles, returns an array of shape (N, 3, 3)
+    """
+    if idx not in [0, 1, 2]:
+        raise ValueError
+
+    xdeg = np.asarray(xdeg, dtype=float)
+    cosx = np.cos(xdeg / DEG)
+    sinx = np.sin(xdeg / DEG)
+
+    R = np.zeros(xdeg.shape + (3, 3))
+
+    if idx==0:
+        R[..., 0, 0] = 1.
+        R[..., 1, 1] = cosx
+        R[..., 1, 2] = -sinx
+        R[..., 2, 1] = sinx
+        R[..., 2, 2] = cosx
+
+    elif idx==1:
+        R[..., 0, 0] = cosx
+        R[..., 0, 2] = sinx
+        R[..., 1, 1] = 1.
+        R[..., 2, 0] = -sinx
+        R[..., 2, 2] = cosx
+
+    elif idx==2:
+        R[..., 0, 0] = cosx
+        R[..., 0, 1] = -sinx
+        R[..., 1, 0] = sinx
+        R[..., 1, 1] = cosx
+        R[..., 2, 2] = 1.
+
+    return R
+
+
+def rotmat_gen_array(v, xi):
+    """ Stacked rotation matrices about arbitrary axes
+
+    Given an array of N axis vectors with shape (N, 3) and N angles, returns
+    an array of shape (N, 3, 3)
+    """
+    rho = np.linalg.norm(v, axis=-1)
+    vth = np.arccos(v[..., 2] / rho)
+    vph = np.arctan2(v[..., 1], v[..., 0])
+
+    return np.matmul(np.matmul(np.matmul(np.matmul(
+            rotmat_array(vph*DEG,2),
+            rotmat_array(vth*DEG,1)),
+            rotmat_array(xi,2)),
+            rotmat_array(-vth*DEG,1)),
+            rotmat_array(-vph*DEG,2))
+
+
 def fangle(x,y):
     """ Returns the angle between two vectors, in degrees
     """
@@ -136,6 +192,26 @@ def isclose(X, Y):
 
 
 
+def weighted_median(x, w):
+    """ Weighted median along the first axis
+
+    Given arrays x and w of shape (N, ...), returns for each column the
+    value of x minimizing sum(w*|x - value|)
+    """
+    x = np.asarray(x, dtype=float)
+    w = np.broadcast_to(np.asarray(w, dtype=float), x.shape)
+
+    order = np.argsort(x, axis=0)
+    x = np.take_along_axis(x, order, axis=0)
+    w = np.take_along_axis(w, order, axis=0)
+
+    cumsum = np.cumsum(w, axis=0)
+    half = 0.5*cumsum[-1]
+    index = np.argmax(cumsum >= half[np.newaxis,...], axis=0)
+    return np.take_along_axis(x, index[np.newaxis,...], axis=0)[0]
+
+
+
 def open_interval(x1,x2,nx):
     return np.linspace(x1,x2,nx+2)[1:-1]
 
@@ -7,7 +7,8 @@ VERBOSE = 0
 import numpy as np
 
 from mtuq.util.moment_tensor.change_basis import change_basis
-from mtuq.util.math import PI, DEG, eig, fangle_signed, rotmat, rotmat_gen, wrap360
+from mtuq.util.math import PI, DEG, eig, fangle_signed, rotmat, rotmat_gen,\
+    rotmat_array, rotmat_gen_array, wrap360
 
 
 
@@ -141,6 +142,84 @@ def tt152cmt(*args):
     return M
 
 
+def tt2cmt_array(*args):
+    """
+    Converts 2012 parameters to up-south-east moment tensors, for whole
+    arrays of parameter values at once
+
+    input: gamma, delta, M0, kappa, theta, sigma
+           (arrays of length N, or scalars, which are broadcast)
+
+    output: M: moment tensors with shape [N, 6]
+               in up-south-east (GCMT) convention
+    """
+    try:
+        gamma, delta, M0, kappa, theta, sigma = args
+    except:
+        gamma, delta, M0, kappa, theta, sigma =\
+             args[0].gamma, args[0].delta, args[0].M0,\
+             args[0].kappa, args[0].theta, args[0].sigma
+
+    gamma, delta, M0, kappa, theta, sigma = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(arg, dtype=float)) for arg in
+          (gamma, delta, M0, kappa, theta, sigma)])
+
+    # eigenvalues with shape [N, 3]
+    lam = lune2lam(gamma, delta, M0).T
+
+    # TT2012, p.485
+    phi = -kappa
+
+    north = np.array([-1, 0, 0])
+    zenith = np.array([0, 0, 1])
+
+    K = np.dot(rotmat_array(phi, 2), north)
+    N = np.dot(rotmat_gen_array(K, theta), zenith)
+    S = np.einsum('nij,nj->ni', rotmat_gen_array(N, sigma), K)
+
+    # TT2012, eq.28
+    Y = rotmat(-45,1)
+
+    V = np.stack([S, np.cross(N,S), N], axis=-1)
+    U = np.matmul(V, Y)
+    M = np.einsum('nij,nj,nkj->nik', U, lam, U)
+
+    # convert from south-east-up to up-south-east convention
+    # (note: U is still in south-east-up)
+    M = change_basis(_vec_array(M), 5, 1)
+
+    return M
+
+
+def tt152cmt_array(*args):
+    """
+    Converts 2015 parameters to up-south-east moment tensors, for whole
+    arrays of parameter values at once
+
+    input: rho, v, w, kappa, sigma, h
+           (arrays of length N, or scalars, which are broadcast)
+
+    output: M: moment tensors with shape [N, 6]
+               in up-south-east (GCMT) convention
+    """
+    try:
+        rho, v, w, kappa, sigma, h = args
+    except:
+        rho, v, w, kappa, sigma, h =\
+            args[0].rho, args[0].v, args[0].w,\
+            args[0].kappa, args[0].sigma, args[0].h
+
+    rho, v, w, kappa, sigma, h = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(arg, dtype=float)) for arg in
+          (rho, v, w, kappa, sigma, h)])
+
+    theta = np.arccos(h)*DEG
+    M0 = rho/np.sqrt(2)
+    gamma, delta = rect2lune(v, w)
+    M = tt2cmt_array(gamma, delta, M0, kappa, theta, sigma)
+    return M
+
+
 
 ### eigenvalue-related functions
     
@@ -193,6 +272,9 @@ def lam2lune(lam):
 
 def lune2lam(gamma, delta, M0):
     """ Converts lune coordinates to moment tensor eigenvalues
+
+    Also accepts arrays of length N, in which case eigenvalues are returned
+    with shape [3, N]
     """
     beta = 90. - delta
 
@@ -239,6 +321,12 @@ def lune2rect(gamma, delta):
 
 
 def rect2lune(v, w):
+    """
+    Converts TT2015 rectilinear coordinates to lune coordinates
+
+    Also accepts arrays of length N, in which case all points are converted
+    at once
+    """
     u = 3.*PI/8. - w
 
     gamma = v2gamma(v)
@@ -444,6 +532,18 @@ def _mat(m):
                       [m[4], m[5], m[2]]]))
 
 
+def _vec_array(M):
+    """ Converts from stacked matrix to
+        stacked vector representation
+    """
+    return np.stack([M[:,0,0],
+                     M[:,1,1],
+                     M[:,2,2],
+                     M[:,0,1],
+                     M[:,0,2],
+                     M[:,1,2]], axis=-1)
+
+
 def _vec(M):
     """ Converts from matrix to
         vector representation
@@ -0,0 +1,165 @@
+
+import heapq
+import numpy as np
+
+
+class BestPoints(object):
+    """ Bounded-memory summary of misfit values over a grid
+
+    Keeps only the k lowest misfit values and corresponding grid indices,
+    along with running count, minimum, maximum, mean and, optionally, a
+    histogram. Memory use is O(k) regardless of grid size
+
+    Infinite values, which mark points abandoned before their misfit 
+    evaluation finished, are counted separately in nabandoned and are 
+    excluded from the k best points and from the statistics
+
+    param k: number of lowest misfit values to keep
+    param bins: optional histogram bin edges
+
+
+    EXAMPLE
+
+    To find the 100 best-fitting moment tensors in a grid:
+        best = BestPoints(100)
+        for start, stop, mt_block in grid.iter_blocks(1000):
+            best.update(np.arange(start, stop), misfit(mt_block))
+        best.indices, best.values
+
+    """
+    def __init__(self, k, bins=None):
+        self.k = k
+
+        # max-heap of (-value, -index) pairs, so that the worst of the k best
+        # points is always at the top
+        self._heap = []
+
+        # running statistics
+        self.count = 0
+        self.nabandoned = 0
+        self.sum = 0.
+        self.min = np.inf
+        self.max = -np.inf
+
+        if bins is not None:
+            self.bins = np.asarray(bins, dtype=float)
+            self.histogram = np.zeros(len(self.bins)-1, dtype=int)
+        else:
+            self.bins = None
+            self.histogram = None
+
+
+    def update(self, indices, values):
+        """ Adds misfit values at the given grid indices
+        """
+        indices = np.asarray(indices).ravel()
+        values = np.asarray(values, dtype=float).ravel()
+
+        finite = np.isfinite(values)
+        if not finite.all():
+            self.nabandoned += np.sum(~finite)
+            indices, values = indices[finite], values[finite]
+
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.sum += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        if self.bins is not None:
+            self.histogram += np.histogram(values, self.bins)[0]
+
+        self._update_heap(indices, values)
+
+
+    def merge(self, other):
+        """ Combines another BestPoints object into this one
+        """
+        self.count += other.count
+        self.nabandoned += other.nabandoned
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        if self.bins is not None:
+            self.histogram += other.histogram
+
+        self._update_heap(other.indices, other.values)
+
+
+    def reduce_mpi(self, comm=None):
+        """ Merges BestPoints from all MPI processes through a binary tree
+        reduction
+
+        Returns the merged result on rank 0 and None on all other ranks
+        """
+        if comm is None:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+
+        rank, size = comm.rank, comm.size
+
+        step = 1
+        while step < size:
+            if rank % (2*step) == step:
+                comm.send(self, dest=rank-step)
+                return None
+            elif rank+step < size:
+                self.merge(comm.recv(source=rank+step))
+            step *= 2
+
+        return self
+
+
+    def _update_heap(self, indices, values):
+        # only the k smallest incoming values can possibly enter the heap
+        if values.size > self.k:
+            keep = np.argpartition(values, self.k-1)[:self.k]
+            indices, values = indices[keep], values[keep]
+
+        for index, value in zip(indices, values):
+            item = (-float(value), -int(index))
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, item)
+            elif item > self._heap[0]:
+                heapq.heapreplace(self._heap, item)
+
+
+    @property
+    def threshold(self):
+        """ Misfit value a point must beat to enter the k best, or infinity
+        if fewer than k points have been seen
+        """
+        if len(self._heap) < self.k:
+            return np.inf
+        return -self._heap[0][0]
+
+
+    @property
+    def indices(self):
+        """ Grid indices of the best points, sorted by misfit
+        """
+        return np.array([-item[1] for item in sorted(self._heap,
+            reverse=True)], dtype=int)
+
+
+    @property
+    def values(self):
+        """ Misfit values of the best points, in ascending order
+        """
+        return np.array([-item[0] for item in sorted(self._heap,
+            reverse=True)], dtype=float)
+
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return np.nan
+        return self.sum/self.count
+
+
+    def __len__(self):
+        return len(self._heap)
+
@@ -1,9 +1,11 @@
 
-from os.path import abspath, join
+from os.path import abspath, exists, join
 from retry import retry
 
 import copy
 import csv
+import os
+import shutil
 import time
 import numpy as np
 import obspy
@@ -122,10 +124,39 @@ def unzip(filename):
         dirname = filename
         filename += '.zip'
 
+    # a marker file next to the directory is created once extraction is
+    # complete, so that directories left by an interrupted extraction or
+    # created some other way are not mistaken for complete ones
+    marker = dirname+'.complete'
+
+    # already extracted?
+    if exists(marker) and exists(dirname):
+        return dirname
+
+    # extracted under a temporary name and renamed into place
+    temp = '%s.tmp%d' % (dirname, os.getpid())
     zip_ref = zipfile.ZipFile(filename, 'r')
-    zip_ref.extractall(dirname)
+    zip_ref.extractall(temp)
     zip_ref.close()
 
+    if exists(dirname) and not exists(marker):
+        # incomplete directory, which is moved aside rather than deleted in
+        # place, in case another process replaces it meanwhile
+        stale = '%s.stale%d' % (dirname, os.getpid())
+        try:
+            os.rename(dirname, stale)
+            shutil.rmtree(stale)
+        except OSError:
+            pass
+
+    try:
+        os.rename(temp, dirname)
+    except OSError:
+        # extracted by another process meanwhile
+        shutil.rmtree(temp)
+
+    open(marker, 'a').close()
+
     return dirname
 
 
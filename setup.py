@@ -49,7 +49,7 @@ setup(
     ],
     python_requires='~=2.7',
     install_requires=[
-        "numpy", "scipy", "obspy", "h5py", "retry",
+        "numpy", "scipy", "obspy", "h5py", "requests", "retry",
         "flake8>=3.0", "pytest", "nose"
     ]
 )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Checks that the MPI grid search with dynamic load balancing gives the same
+results as the serial grid search
+
+Must be run under MPI, for example
+
+    mpirun -n 3 python mpi_grid_search.py
+
+and exits with a nonzero status on any rank if the results differ. Called
+by unittest_grid_search.py
+"""
+
+import traceback
+import numpy as np
+from mpi4py import MPI
+from mtuq.grid_search import DoubleCoupleGridRandom, grid_search_mpi,\
+    grid_search_serial
+from unittest_grid_search import get_data_greens_misfit
+
+
+def main(comm):
+    # every rank must generate the same data and grid
+    np.random.seed(0)
+    data, greens, misfit = get_data_greens_misfit()
+    grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+    results = grid_search_serial(data, greens, misfit, grid, batch_size=5)
+
+    # rank 0 returns all results and the other ranks empty arrays
+    grid.index = grid.start
+    results_dynamic = grid_search_mpi(data, greens, misfit, grid,
+        batch_size=3, load_balancing='dynamic')
+
+    gathered = np.concatenate(comm.allgather(results_dynamic))
+    assert gathered.size == grid.size
+    assert np.allclose(gathered, results)
+
+    # the merged best points are returned on rank 0
+    grid.index = grid.start
+    best = grid_search_mpi(data, greens, misfit, grid,
+        batch_size=3, load_balancing='dynamic', topk=4)
+
+    if comm.rank == 0:
+        assert np.all(best.indices == np.argsort(results)[:4])
+        assert np.allclose(best.values, np.sort(results)[:4])
+    else:
+        assert best is None
+
+
+if __name__=='__main__':
+    comm = MPI.COMM_WORLD
+
+    try:
+        main(comm)
+    except:
+        # otherwise the other ranks would wait for this one indefinitely
+        traceback.print_exc()
+        comm.Abort(1)
+
+    comm.Barrier()
+    if comm.rank == 0:
+        print ' Dynamic load balancing OK on %d processes' % comm.size
+
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import io
+import threading
+import time
+import zipfile
+import numpy as np
+import obspy
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from mtuq.greens_tensor.syngine import GREENS_TENSOR_FILENAMES
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ Answers every GET request with the server's canned zip file
+    """
+    # keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.nconnections += 1
+
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.nrequests += 1
+            fail = self.server.nrequests <= self.server.fail_first
+
+        time.sleep(self.server.delay)
+
+        if fail:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """ Local stand-in for the syngine web service
+
+    Serves the same zip file in response to any query, after an optional
+    delay imitating network latency, and counts connections and requests.
+    The first fail_first requests are answered with 503 Service Unavailable
+
+    EXAMPLE
+
+        server = Server(make_greens_tensor_zip())
+        server.start()
+        factory = GreensTensorFactory(model, base_url=server.url)
+        ...
+        server.stop()
+
+    """
+    daemon_threads = True
+
+    def __init__(self, body, port=0, delay=0., fail_first=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.body = body
+        self.delay = delay
+        self.fail_first = fail_first
+
+        self.lock = threading.Lock()
+        self.nconnections = 0
+        self.nrequests = 0
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/query' % self.server_address[1]
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def make_greens_tensor_zip(npts=501, delta=0.1, starttime=0., seed=0):
+    """ Returns a zip file, as a string, holding random Green's functions
+        named and formatted as in syngine downloads
+    """
+    random = np.random.RandomState(seed)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for filename in GREENS_TENSOR_FILENAMES:
+            trace = obspy.Trace(random.normal(0., 1., npts).astype(np.float32),
+                header={'delta': delta,
+                        'starttime': obspy.UTCDateTime(starttime)})
+            sac = io.BytesIO()
+            trace.write(sac, format='SAC')
+            archive.writestr(filename, sac.getvalue())
+
+    return buffer.getvalue()
+
+
+if __name__=='__main__':
+    """
+    Runs the stand-in server in the foreground, for benchmarking downloads
+    offline
+
+    usage: syngine_server.py [port [delay]]
+    """
+    import sys
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.
+
+    server = Server(make_greens_tensor_zip(), port, delay)
+    print ' Serving syngine stand-in at %s' % server.url
+    server.serve_forever()
+
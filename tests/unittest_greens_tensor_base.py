@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import time
+import warnings
+import numpy as np
+import unittest
+import obspy.core
+from mtuq.greens_tensor import base
+from mtuq.util.util import AttribDict
+
+
+class test_greens_tensor_factory(unittest.TestCase):
+    def test_threads(self):
+        """ Checks that Green's tensors read concurrently are returned in
+            station order
+        """
+        stations = get_stations(8)
+        factory = Factory()
+
+        greens1 = factory(stations, get_origin())
+        greens2 = factory(stations, get_origin(), nthreads=4)
+
+        assert [g.id for g in greens1] == [s.id for s in stations]
+        assert [g.id for g in greens2] == [s.id for s in stations]
+        for g1, g2 in zip(greens1, greens2):
+            assert np.all(g1[0].data == g2[0].data)
+
+
+    def test_failures(self):
+        """ Checks that failures at some stations are reported without
+            aborting the others
+        """
+        stations = get_stations(6)
+        factory = Factory(fail=[stations[1].id, stations[4].id])
+
+        for nthreads in [1, 3]:
+            # the original exception is raised again
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                with self.assertRaises(IOError) as context:
+                    factory(stations, get_origin(), nthreads=nthreads)
+            assert stations[1].id in str(context.exception)
+            assert stations[4].id in str(caught[0].message)
+
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                greens = factory(stations, get_origin(), nthreads=nthreads,
+                    on_error='warn')
+            assert len(caught) == 1
+
+            assert [g.id for g in greens] ==\
+                [stations[_i].id for _i in [0, 2, 3, 5]]
+            assert [(_i, id) for _i, id, _ in greens.failures] ==\
+                [(1, stations[1].id), (4, stations[4].id)]
+            assert isinstance(greens.failures[0][2], IOError)
+
+
+class test_greens_tensor(unittest.TestCase):
+    def test_dtype(self):
+        """ Checks that single precision is used only if all time series
+            are single precision
+        """
+        station, origin = get_stations(1)[0], get_origin()
+
+        def greens_tensor(*dtypes):
+            return base.GreensTensor([obspy.core.Trace(
+                data=np.ones(10, dtype=dtype),
+                header={'channel': 'ZSS', 'delta': 0.1})
+                for dtype in dtypes], station, origin)
+
+        assert greens_tensor(np.float32)._get_dtype() == np.float32
+        assert greens_tensor(np.float32, np.float64)._get_dtype() ==\
+            np.float64
+
+        # for example, after all traces have been removed
+        empty = greens_tensor(np.float32)
+        empty.traces = []
+        assert empty._get_dtype() == np.float64
+
+
+### utility functions
+
+class Factory(base.GreensTensorFactory):
+    """ Creates Green's tensors from deterministic time series, taking a
+        random amount of time and failing for selected stations
+    """
+    def __init__(self, fail=[]):
+        self.fail = fail
+
+
+    def get_greens_tensor(self, station, origin):
+        time.sleep(np.random.uniform(0., 0.02))
+
+        if station.id in self.fail:
+            raise IOError('Missing Green\'s functions: %s' % station.id)
+
+        trace = obspy.core.Trace(data=station.distance*np.ones(10),
+            header={'channel': 'ZSS', 'delta': 0.1})
+        return base.GreensTensor([trace], station, origin)
+
+
+def get_stations(nsta):
+    stations = []
+    for _i in range(nsta):
+        station = AttribDict()
+        station.id = 'XX.STA%d..' % _i
+        station.latitude = float(_i)
+        station.longitude = 1.
+        stations += [station]
+    return stations
+
+
+def get_origin():
+    origin = AttribDict()
+    origin.latitude = 0.
+    origin.longitude = 0.
+    return origin
+
+
+if __name__=='__main__':
+    unittest.main()
+
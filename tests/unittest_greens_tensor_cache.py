@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import unittest
+import obspy.core
+from obspy.core import UTCDateTime
+from mtuq.greens_tensor import base, fk
+from mtuq.greens_tensor.cache import GreensTensorCache
+from mtuq.util.util import AttribDict
+
+
+class test_greens_tensor_cache(unittest.TestCase):
+    def test_cache(self):
+        """ Checks that cached Green's tensors match newly processed ones and
+            that entries are reused only for the same processing parameters
+        """
+        path = tempfile.mkdtemp()
+        try:
+            factory = Factory()
+            stations = get_stations()
+            origin = get_origin()
+
+            cache = GreensTensorCache(path)
+            greens1 = cache(factory, stations, origin, Process(2.))
+            assert factory.ncalls == len(stations)
+
+            # a new cache object reads the same files back
+            greens2 = GreensTensorCache(path)(factory, stations, origin,
+                Process(2.))
+            assert factory.ncalls == len(stations)
+
+            assert len(greens1) == len(greens2) == len(stations)
+            for g1, g2 in zip(greens1, greens2):
+                assert type(g1) == type(g2)
+                assert g1.id == g2.id
+                for t1, t2 in zip(g1, g2):
+                    assert t1.stats.channel == t2.stats.channel
+                    assert t1.stats.delta == t2.stats.delta
+                    assert np.all(t1.data == t2.data)
+
+            # different processing parameters give different entries
+            cache(factory, stations, origin, Process(3.))
+            assert factory.ncalls == 2*len(stations)
+
+            cache.clear()
+            cache(factory, stations, origin, Process(2.))
+            assert factory.ncalls == 3*len(stations)
+
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_eviction(self):
+        """ Checks that least recently used entries are deleted once the
+            size limit is exceeded
+        """
+        path = tempfile.mkdtemp()
+        try:
+            factory = Factory()
+            stations = get_stations(nsta=1)
+            origin = get_origin()
+
+            cache = GreensTensorCache(path)
+            cache(factory, stations, origin, Process(1.))
+            size = sum([os.path.getsize(os.path.join(path, filename))
+                for filename in os.listdir(path)])
+
+            # room for two entries
+            cache = GreensTensorCache(path, max_bytes=2*size)
+            cache(factory, stations, origin, Process(2.))
+            cache(factory, stations, origin, Process(1.))
+            cache(factory, stations, origin, Process(3.))
+            assert len(cache._store.keys()) == 2
+
+            ncalls = factory.ncalls
+            cache(factory, stations, origin, Process(1.))
+            assert factory.ncalls == ncalls
+            cache(factory, stations, origin, Process(2.))
+            assert factory.ncalls == ncalls+1
+
+        finally:
+            shutil.rmtree(path)
+
+
+
+### utility functions
+
+class Factory(base.GreensTensorFactory):
+    """ Creates fk Green's tensors from random time series, counting how
+        many are created
+    """
+    def __init__(self, npts=101, delta=0.1):
+        self.npts = npts
+        self.delta = delta
+        self.ncalls = 0
+        self.random = np.random.RandomState(0)
+
+
+    def get_greens_tensor(self, station, origin):
+        self.ncalls += 1
+
+        traces = []
+        for channel in [
+            'TSS', 'TDS',
+            'REP', 'RSS', 'RDS', 'RDD',
+            'ZEP', 'ZSS', 'ZDS', 'ZDD']:
+            traces += [obspy.core.Trace(
+                data=self.random.normal(0., 1., self.npts),
+                header={'channel': channel, 'delta': self.delta})]
+        return fk.GreensTensor(traces, station, origin)
+
+
+class Process(object):
+    """ Stand-in for a data processing function
+    """
+    def __init__(self, scale):
+        self.scale = scale
+
+
+    def __call__(self, traces):
+        processed = []
+        for trace in traces:
+            trace = trace.copy()
+            trace.data *= self.scale
+            processed += [trace]
+        return processed
+
+
+def get_stations(nsta=3):
+    stations = []
+    for _i in range(nsta):
+        station = AttribDict()
+        station.id = 'XX.STA%d..' % _i
+        station.latitude = 10.*_i
+        station.longitude = 20.
+        station.starttime = UTCDateTime(0.)
+        station.endtime = UTCDateTime(10.)
+        station.delta = 0.1
+        stations += [station]
+    return stations
+
+
+def get_origin():
+    origin = AttribDict()
+    origin.latitude = 0.
+    origin.longitude = 0.
+    origin.depth = 10000.
+    origin.time = UTCDateTime(0.)
+    return origin
+
+
+if __name__=='__main__':
+    unittest.main()
+
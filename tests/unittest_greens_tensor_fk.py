@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
 
+import os
+import shutil
+import tempfile
 import numpy as np
 import unittest
 import obspy.core
-from mtuq.dataset.base import DatasetBase as Dataset
+from obspy.core import UTCDateTime
+from mtuq.dataset.base import Dataset
+from mtuq.greens_tensor import fk
 from mtuq.misfit import cap
 from mtuq.util.util import AttribDict
 from mtuq.util.wavelets import Gaussian
@@ -24,10 +29,109 @@ class TestFK(unittest.TestCase):
         """
         pass
 
-       
+
+
+    def test_pack_database(self):
+        """ Checks that Green's tensors read from a packed database match
+            those read from the original fk directory tree
+        """
+        path = tempfile.mkdtemp()
+        try:
+            write_fk_tree(path, 'model', depths=[5, 10],
+                distances=[100, 101, 150])
+            filename = os.path.join(path, 'model.h5')
+            fk.pack_database(os.path.join(path, 'model'), filename)
+
+            factory1 = fk.GreensTensorFactory(os.path.join(path, 'model'))
+            factory2 = fk.GreensTensorFactory(filename)
+            assert factory2.model == 'model'
+
+            origin = obspy.core.AttribDict({
+                'latitude': 0., 'longitude': 0., 'depth': 10000.,
+                'time': UTCDateTime(0.)})
+
+            for longitude in [0.9, 1.345]:
+                station = obspy.core.AttribDict({
+                    'id': 'XX.STA..', 'latitude': 0., 'longitude': longitude,
+                    'starttime': UTCDateTime(-10.), 'endtime': UTCDateTime(40.),
+                    'delta': 0.5})
+
+                greens1 = factory1(station, origin)[0]
+                greens2 = factory2(station, origin)[0]
+                for trace1, trace2 in zip(greens1, greens2):
+                    assert trace1.stats.channel == trace2.stats.channel
+                    assert np.all(trace1.data == trace2.data)
+
+            database = fk.open_database(filename)
+            assert database.get_picks(10, 150) == (15., 25.)
+            assert fk.open_database(filename) is database
+
+            with self.assertRaises(IOError):
+                database.get_trace(20, 100, '0')
+
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_cache(self):
+        """ Checks that stations mapping to the same depth and distance share
+            raw Green's functions instead of reading them again
+        """
+        path = tempfile.mkdtemp()
+        try:
+            write_fk_tree(path, 'model', depths=[10], distances=[101])
+            factory = fk.GreensTensorFactory(os.path.join(path, 'model'))
+
+            origin = obspy.core.AttribDict({
+                'latitude': 0., 'longitude': 0., 'depth': 10000.,
+                'time': UTCDateTime(0.)})
+
+            stations = []
+            for _i, longitude in enumerate([0.9, 0.902, 0.904]):
+                stations += [obspy.core.AttribDict({
+                    'id': 'XX.STA%d..' % _i, 'latitude': 0.,
+                    'longitude': longitude, 'starttime': UTCDateTime(-10.),
+                    'endtime': UTCDateTime(40.), 'delta': 0.5})]
+
+            greens = factory(stations, origin)
+            assert factory._cache.misses == len(fk.EXTENSIONS)
+            assert factory._cache.hits == 2*len(fk.EXTENSIONS)
+
+            for trace1, trace2 in zip(greens[0], greens[2]):
+                assert np.all(trace1.data == trace2.data)
+
+            # a cache too small for even one trace still gives correct results
+            uncached = fk.GreensTensorFactory(os.path.join(path, 'model'),
+                cache_bytes=0)(stations, origin)
+            for trace1, trace2 in zip(greens[1], uncached[1]):
+                assert np.all(trace1.data == trace2.data)
+
+        finally:
+            shutil.rmtree(path)
+
+
 
 ### utility functions
 
+def write_fk_tree(path, model, depths, distances):
+    """ Writes an fk directory tree of random Green's functions, with trace
+        length, start time and picks varying with distance
+    """
+    for depth in depths:
+        dirname = os.path.join(path, model, '%s_%d' % (model, depth))
+        os.makedirs(dirname)
+        for distance in distances:
+            for ext in fk.EXTENSIONS:
+                trace = obspy.core.Trace(
+                    data=np.random.normal(0., 1., distance).astype(np.float32),
+                    header={'delta': 0.5,
+                        'starttime': UTCDateTime(distance/10.)})
+                trace.stats.sac = obspy.core.AttribDict({
+                    't1': distance/10., 't2': distance/10.+10.})
+                trace.write(os.path.join(dirname, '%d.grn.%s' %
+                    (distance, ext)), format='SAC')
+
+
 def Stream(*args, **kwargs):
     """ Overloads obspy Stream by seeting the "id" attribute, which 
         mtuq expects (normally this is done by dataset.reader)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import unittest
+import instaseis
+from copy import deepcopy
+from obspy import UTCDateTime
+from mtuq.greens_tensor.instaseis import GreensTensorFactory
+from mtuq.util.util import AttribDict
+
+
+class test_greens_tensor_factory(unittest.TestCase):
+    def test_distance_bins(self):
+        """ Checks that Green's functions are extracted once per distance bin
+            and shared by the stations in it
+        """
+        path = get_path()
+        delta, npts = get_sampling(path)
+
+        # three stations within a few km of each other, and one far away
+        stations = []
+        for _i, latitude in enumerate([20., 20.01, 20.02, 30.]):
+            station = AttribDict()
+            station.id = 'XX.STA%d..' % _i
+            station.latitude = latitude
+            station.longitude = 0.
+            station.starttime = UTCDateTime(-2*delta)
+            station.endtime = UTCDateTime((npts+1)*delta)
+            station.delta = delta
+            stations += [station]
+
+        factory = GreensTensorFactory(path, distance_tolerance=10.)
+        greens = factory(stations, get_origin())
+
+        assert factory._cache.misses == 2
+        assert [g.id for g in greens] == [s.id for s in stations]
+        for trace0, trace2, trace3 in zip(greens[0], greens[2], greens[3]):
+            assert np.all(trace0.data == trace2.data)
+            assert not np.all(trace0.data == trace3.data)
+
+        # without a tolerance, every distance is extracted
+        factory = GreensTensorFactory(path)
+        factory(stations, get_origin())
+        assert factory._cache.misses == 4
+
+        # Green's functions are shared between events at the same depth, and
+        # shifted to each origin time
+        origin = get_origin()
+        origin.time += 10.
+        shifted = deepcopy(stations)
+        for station in shifted:
+            station.starttime += 10.
+            station.endtime += 10.
+
+        for g1, g2 in zip(factory(stations, get_origin()),
+                          factory(shifted, origin)):
+            for trace1, trace2 in zip(g1, g2):
+                assert np.allclose(trace1.data, trace2.data)
+        assert factory._cache.misses == 4
+
+        # reads from the shared database are serialized
+        factory = GreensTensorFactory(path)
+        greens1 = factory(stations, get_origin(), nthreads=4)
+        greens2 = GreensTensorFactory(path)(stations, get_origin())
+        for g1, g2 in zip(greens1, greens2):
+            for trace1, trace2 in zip(g1, g2):
+                assert np.all(trace1.data == trace2.data)
+
+        # the database is opened only once for a given buffer size
+        assert factory.db is GreensTensorFactory(path).db
+        assert factory.db is not GreensTensorFactory(path,
+            buffer_size_in_mb=10).db
+
+
+
+### utility functions
+
+def get_path():
+    """ Returns the path to a small reciprocal database shipped with
+        instaseis
+    """
+    return os.path.join(os.path.dirname(instaseis.__file__),
+        'tests', 'data', '100s_db_bwd_displ_only')
+
+
+def get_sampling(path):
+    stream = instaseis.open_db(path).get_greens_function(
+        epicentral_distance_in_degree=20., source_depth_in_m=10000.,
+        origin_time=UTCDateTime(0.), kind='displacement',
+        definition=u'seiscomp')
+    return stream[0].stats.delta, stream[0].stats.npts
+
+
+def get_origin():
+    origin = AttribDict()
+    origin.latitude = 0.
+    origin.longitude = 0.
+    origin.depth = 10000.
+    origin.time = UTCDateTime(0.)
+    return origin
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 
 
+import os
+import shutil
+import tempfile
 import numpy as np
 import unittest
 
 from os.path import join
+from obspy import UTCDateTime
 from mtuq.dataset.sac import\
     reader
 from mtuq.greens_tensor.syngine import\
     download_greens_tensor, download_synthetics,\
-    GreensTensor, GreensTensorFactory
+    Client, GreensTensor, GreensTensorFactory
 from mtuq.grid_search import FullMomentTensorGridRandom, FullMomentTensorGridRegular
 from mtuq.util.util import AttribDict, path_mtuq, unzip
+from syngine_server import Server, make_greens_tensor_zip
 
  
 class greens_tensor_syngine(unittest.TestCase):
@@ -89,7 +94,148 @@ class greens_tensor_syngine(unittest.TestCase):
             self._data = data
         return self._data
 
-       
+
+
+
+class syngine_client(unittest.TestCase):
+    """ Tests against a local stand-in for the syngine web service
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def test_factory(self):
+        """ Checks that Green's tensors for all stations are downloaded over
+            a bounded number of persistent connections, and only once
+        """
+        server = Server(make_greens_tensor_zip(), delay=0.01)
+        server.start()
+        try:
+            factory = GreensTensorFactory('ak135f_2s', max_connections=3,
+                base_url=server.url, cache_path=self.path)
+
+            stations = self.get_stations(8)
+            greens = factory(stations, self.get_origin())
+
+            assert [g.id for g in greens] == [s.id for s in stations]
+            assert server.nrequests == len(stations)
+            assert server.nconnections <= 3
+
+            factory(stations, self.get_origin())
+            assert server.nrequests == len(stations)
+
+        finally:
+            server.stop()
+
+
+    def test_cache(self):
+        """ Checks that Green's tensors are unpacked once and read back
+            without the server, and that the cache stays within its quota
+        """
+        server = Server(make_greens_tensor_zip())
+        server.start()
+        try:
+            stations = self.get_stations(4)
+            factory = GreensTensorFactory('ak135f_2s', base_url=server.url,
+                cache_path=self.path)
+            greens1 = factory(stations, self.get_origin())
+            size = os.path.getsize(join(self.path,
+                factory.client.cache.keys()[0]+'.npy'))
+
+        finally:
+            server.stop()
+
+        # no server is needed once Green's tensors are cached
+        greens2 = factory(stations, self.get_origin())
+        for g1, g2 in zip(greens1, greens2):
+            for t1, t2 in zip(g1, g2):
+                assert t1.stats.channel == t2.stats.channel
+                assert np.all(t1.data == t2.data)
+
+        server = Server(make_greens_tensor_zip())
+        server.start()
+        try:
+            # room for two entries
+            factory = GreensTensorFactory('ak135f_2s', base_url=server.url,
+                cache_path=self.path, max_bytes=2*size+1000)
+            factory(self.get_stations(6), self.get_origin())
+            assert len(factory.client.cache.keys()) == 2
+
+        finally:
+            server.stop()
+
+
+    def test_retry(self):
+        """ Checks that failed requests are retried
+        """
+        server = Server(make_greens_tensor_zip(), fail_first=2)
+        server.start()
+        try:
+            client = Client(server.url, retries=3, backoff=0.,
+                cache_path=self.path)
+            filename = client.get(server.url, join(self.path, 'test.zip'))
+
+            assert server.nrequests == 3
+            with open(filename, 'rb') as file:
+                assert file.read() == server.body
+
+        finally:
+            server.stop()
+
+
+    def test_legacy_downloads(self):
+        """ Checks that zip files saved by the download functions are kept
+            apart from cache entries
+        """
+        server = Server(make_greens_tensor_zip())
+        server.start()
+        try:
+            client = Client(server.url, cache_path=self.path, max_bytes=1)
+            station = self.get_stations(1)[0]
+            station.distance = 1000.
+
+            filename = download_greens_tensor('ak135f_2s', station,
+                self.get_origin(), client)
+            assert filename.startswith(client.download_path)
+            assert os.path.exists(filename+'.zip')
+            assert len(os.listdir(unzip(filename))) == 10
+
+            # not counted toward, or evicted by, the cache
+            assert client.cache.keys() == []
+            client.cache.evict()
+            assert os.path.exists(filename+'.zip')
+
+        finally:
+            server.stop()
+
+
+    def get_stations(self, nsta):
+        stations = []
+        for _i in range(nsta):
+            station = AttribDict()
+            station.id = 'XX.STA%d..' % _i
+            station.station = 'STA%d' % _i
+            station.latitude = 10.+_i
+            station.longitude = 0.
+            station.starttime = UTCDateTime(-10.)
+            station.endtime = UTCDateTime(60.)
+            station.delta = 0.1
+            stations += [station]
+        return stations
+
+
+    def get_origin(self):
+        origin = AttribDict()
+        origin.latitude = 0.
+        origin.longitude = 0.
+        origin.depth = 10000.
+        origin.time = UTCDateTime(0.)
+        return origin
+
 
 
 if __name__=='__main__':
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import unittest
+import obspy.core
+from distutils.spawn import find_executable
+from mtuq.dataset.base import Dataset
+from mtuq.grid_search import DoubleCoupleGridRandom, DoubleCoupleGridRegular
+from mtuq.grid_search import grid_search_adaptive, grid_search_magnitude,\
+    grid_search_multiprocessing, grid_search_serial, grid_search_variants
+from mtuq.misfit import cap
+from mtuq.util.util import AttribDict
+
+
+class test_grid_search(unittest.TestCase):
+    def test_batched(self):
+        """ Checks that the batched grid search gives the same result as the
+            point-by-point grid search
+        """
+        data, greens, misfit = get_data_greens_misfit()
+
+        for grid in [
+            DoubleCoupleGridRandom(Mw=4.5, npts=23),
+            DoubleCoupleGridRegular(Mw=4.5, npts_per_axis=3)]:
+
+            results1 = grid_search_serial(data, greens, misfit, grid)
+            results2 = grid_search_serial(data, greens, misfit, grid,
+                batch_size=5)
+
+            assert results1.size == results2.size == grid.size
+            assert np.allclose(results1, results2)
+
+
+    def test_mpi_dynamic(self):
+        """ Checks that dynamic load balancing on a single process falls back
+            to the serial grid search
+        """
+        from mtuq.grid_search import grid_search_mpi
+
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results1 = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+
+        grid.index = grid.start
+        results2 = grid_search_mpi(data, greens, misfit, grid,
+            batch_size=4, load_balancing='dynamic')
+        assert np.allclose(results1, results2)
+
+        grid.index = grid.start
+        best = grid_search_mpi(data, greens, misfit, grid,
+            batch_size=4, load_balancing='dynamic', topk=4)
+        assert np.all(best.indices == np.argsort(results1)[:4])
+
+
+    @unittest.skipIf(find_executable('mpirun') is None, 'requires mpirun')
+    def test_mpi_dynamic_mpirun(self):
+        """ Checks that dynamic load balancing on several processes gives the
+            same results as the serial grid search (see mpi_grid_search.py)
+        """
+        command = ['mpirun', '-n', '3']
+
+        env = dict(os.environ)
+        if 'Open MPI' in subprocess.check_output(['mpirun', '--version'],
+                stderr=subprocess.STDOUT):
+            command += ['--oversubscribe']
+            env['OMPI_ALLOW_RUN_AS_ROOT'] = '1'
+            env['OMPI_ALLOW_RUN_AS_ROOT_CONFIRM'] = '1'
+
+        path = os.path.dirname(os.path.abspath(__file__))
+        command += [sys.executable, os.path.join(path, 'mpi_grid_search.py')]
+
+        process = subprocess.Popen(command, cwd=path, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        assert process.returncode == 0, output
+
+
+    def test_multiprocessing(self):
+        """ Checks that the multiprocessing grid search gives the same result
+            as the serial grid search
+        """
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results1 = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+        results2 = grid_search_multiprocessing(data, greens, misfit, grid,
+            nproc=2, batch_size=4)
+
+        assert np.allclose(results1, results2)
+
+
+    def test_records(self):
+        """ Checks that per-station records written during the grid search
+            add up to the misfit values
+        """
+        from mtuq.misfit.cap import allocate_records
+
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        for batch_size in [5, None]:
+            grid.index = grid.start
+            records = dict([(key, allocate_records(grid.size, len(data[key])))
+                for key in data])
+            results = grid_search_serial(data, greens, misfit, grid,
+                batch_size=batch_size, records=records)
+
+            total = 0.
+            for key in data:
+                # unit weights, L1 norm
+                total += np.nansum(records[key]['sum_residuals'], axis=(1,2))
+            assert np.allclose(total, results)
+
+            # body-wave misfit uses Z and R components only
+            time_shifts = records['body_waves']['time_shift']
+            assert np.all(np.abs(time_shifts[:,:,:2]) <= 1.)
+            assert np.all(np.isnan(time_shifts[:,:,2]))
+
+
+    def test_topk(self):
+        """ Checks that the bounded-memory top-k reduction finds the same
+            best points as a search that keeps all misfit values
+        """
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+
+        for kwargs in [{'batch_size': 5}, {'batch_size': None}]:
+            grid.index = grid.start
+            best = grid_search_serial(data, greens, misfit, grid,
+                topk=4, **kwargs)
+
+            assert np.all(best.indices == np.argsort(results)[:4])
+            assert np.allclose(best.values, np.sort(results)[:4])
+            assert best.count == grid.size
+
+        best = grid_search_multiprocessing(data, greens, misfit, grid,
+            nproc=2, batch_size=4, topk=4)
+        assert np.all(best.indices == np.argsort(results)[:4])
+
+
+    def test_early_abandon(self):
+        """ Checks that abandoning points that cannot enter the top k does
+            not change the best points found
+        """
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+
+        for kwargs in [{'batch_size': 5}, {'batch_size': None}]:
+            grid.index = grid.start
+            best = grid_search_serial(data, greens, misfit, grid,
+                topk=4, early_abandon=True, **kwargs)
+
+            assert np.all(best.indices == np.argsort(results)[:4])
+            assert np.allclose(best.values, np.sort(results)[:4])
+            assert best.count + best.nabandoned == grid.size
+
+        best = grid_search_multiprocessing(data, greens, misfit, grid,
+            nproc=2, batch_size=4, topk=4, early_abandon=True)
+        assert np.all(best.indices == np.argsort(results)[:4])
+
+
+
+    def test_adaptive_convergence(self):
+        """ Checks that the adaptive search converges to a known minimum 
+            lying between grid points
+        """
+        source = {'kappa': 123.4, 'sigma': 17.3, 'h': 0.5222}
+        mt = get_grid(**dict((key, [value])
+            for key, value in source.items())).get(0)
+        data, greens, misfit = get_data_greens_misfit(mt=mt,
+            time_shift_max=0., norm_order=2)
+
+        grid = get_grid(
+            kappa=np.arange(0., 360., 45.),
+            sigma=[-60., -30., 0., 30., 60.],
+            h=[0.1, 0.3, 0.5, 0.7, 0.9])
+
+        nlevels = 6
+        points, results = grid_search_adaptive(data, greens, misfit, grid,
+            nlevels=nlevels, refinement=3, nbest=2)
+        values = points.get_values(0, points.size)
+        best = results.argmin()
+
+        # the misfit, which vanishes at the source, drops by more than an
+        # order of magnitude, and the best point lies within a few points of
+        # the finest level from the source
+        coarse = results[:grid.size]
+        assert results[best] < 5.e-2*coarse.min()
+
+        for key, spacing in [('kappa', 45.), ('sigma', 30.), ('h', 0.2)]:
+            assert abs(values[key][best] - source[key]) <=\
+                4.*spacing/3.**(nlevels-1)
+
+
+    def test_checkpoint(self):
+        """ Checks that a grid search resumed from a checkpoint file skips
+            completed chunks and fills in the rest
+        """
+        from mtuq.util.checkpoint import Checkpoint
+
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'misfit.h5')
+
+            # simulate a job killed after two chunks
+            checkpoint = Checkpoint(filename, grid, 5)
+            for start, stop in checkpoint.chunks()[:2]:
+                checkpoint.update(start, -np.ones(stop-start))
+
+            resumed = grid_search_serial(data, greens, misfit, grid,
+                batch_size=5, checkpoint=filename)
+            assert np.all(resumed[:10] == -1.)
+            assert np.allclose(resumed[10:], results[10:])
+
+            resumed = grid_search_multiprocessing(data, greens, misfit, grid,
+                nproc=2, batch_size=5, checkpoint=filename)
+            assert np.all(resumed[:10] == -1.)
+            assert np.allclose(resumed[10:], results[10:])
+        finally:
+            shutil.rmtree(path)
+
+
+
+    def test_checkpoint_interrupted(self):
+        """ Checks that a multiprocessing grid search interrupted partway
+            through has written the chunks finished so far, and that resuming
+            it evaluates only the remaining points
+        """
+        data, greens, misfit = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        results = grid_search_serial(data, greens, misfit, grid,
+            batch_size=5)
+
+        # fails on the chunk beginning at grid index 15
+        failing = grid.get_block(15, 16)[0]
+        def fail(mt_block):
+            if np.allclose(mt_block[0], failing):
+                raise RuntimeError('Interrupted')
+
+        evaluated = []
+        def count(mt_block):
+            evaluated.append(len(mt_block))
+
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'misfit.h5')
+
+            with self.assertRaises(RuntimeError):
+                grid_search_multiprocessing(data, greens,
+                    wrap_misfit(misfit, fail), grid,
+                    nproc=2, batch_size=5, checkpoint=filename)
+
+            resumed = grid_search_serial(data, greens,
+                wrap_misfit(misfit, count), grid,
+                batch_size=5, checkpoint=filename)
+
+            # each category is evaluated once per remaining chunk
+            assert sum(evaluated) == len(data)*(grid.size-15)
+            assert np.allclose(resumed, results)
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_magnitude(self):
+        """ Checks that the analytic magnitude search recovers the magnitude
+            of noise-free data and finds the lowest misfit over scale factors
+        """
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=5)
+
+        for norm_order in [1, 2]:
+            data, greens, misfit = get_data_greens_misfit(
+                mt=2.*grid.get(0), norm_order=norm_order, time_shift_max=0.)
+
+            results, magnitudes = grid_search_magnitude(
+                data, greens, misfit, grid)
+
+            assert np.isclose(magnitudes[0], 4.5 + 2./3.*np.log10(2.))
+            assert results[0] < 1.e-6*results[1:].min()
+
+            for _i in range(1, grid.size):
+                scale = 10.**(1.5*(magnitudes[_i] - 4.5))
+                values = [sum([misfit[key](data[key], greens[key],
+                    factor*scale*grid.get(_i)) for key in data])
+                    for factor in [1., 0.99, 1.01]]
+                assert np.isclose(results[_i], values[0])
+                assert values[0] <= min(values[1:])
+
+            # splitting blocks to limit memory use gives the same results
+            split = grid_search_magnitude(
+                data, greens, misfit, grid, max_bytes=1)
+            assert np.allclose(split[0], results)
+            assert np.allclose(split[1], magnitudes)
+
+
+
+    def test_variants(self):
+        """ Checks that evaluating several misfit functions in one pass gives
+            the same results as separate grid searches
+        """
+        data, greens, _ = get_data_greens_misfit()
+        grid = DoubleCoupleGridRandom(Mw=4.5, npts=23)
+
+        parameters = [
+            (1, ['ZRT']), (2, ['ZRT']), (1, ['ZR','T']), (2, ['ZR','T'])]
+
+        misfits = []
+        for norm_order, time_shift_groups in parameters:
+            misfits += [dict([(key, cap.Misfit(
+                norm_order=norm_order,
+                time_shift_groups=time_shift_groups,
+                time_shift_max=1.)) for key in data])]
+
+        variants = dict([(key, cap.MisfitVariants(
+            [misfit[key] for misfit in misfits])) for key in data])
+
+        results = grid_search_variants(data, greens, variants, grid,
+            batch_size=5)
+
+        assert results.shape == (grid.size, len(parameters))
+        for _v, misfit in enumerate(misfits):
+            assert np.allclose(results[:,_v],
+                grid_search_serial(data, greens, misfit, grid, batch_size=5))
+
+
+    def test_adaptive(self):
+        """ Checks that the adaptive search evaluates each point once and
+            moves toward the source, including across strike 0/360
+        """
+        for kappa in [100., 350.]:
+            source = {'kappa': kappa, 'sigma': 20., 'h': 0.55}
+            mt = get_grid(**dict((key, [value])
+                for key, value in source.items())).get(0)
+            data, greens, misfit = get_data_greens_misfit(mt=mt,
+                time_shift_max=0., norm_order=2)
+
+            grid = get_grid(
+                kappa=np.arange(0., 360., 45.),
+                sigma=[-60., -30., 0., 30., 60.],
+                h=[0.1, 0.3, 0.5, 0.7, 0.9])
+            coarse = grid_search_serial(data, greens, misfit, grid,
+                batch_size=50)
+
+            points, results = grid_search_adaptive(data, greens, misfit,
+                grid, nlevels=3, refinement=3, nbest=3)
+            values = points.get_values(0, points.size)
+
+            assert results.size == points.size
+            assert points.size < (8*9)*(5*9)*(5*9)
+
+            # no point is evaluated twice
+            rounded = np.round(np.column_stack([values['kappa'],
+                values['sigma'], values['h']]), 6)
+            assert len(set(map(tuple, rounded))) == points.size
+
+            # strike is wrapped rather than clipped
+            assert np.all((0. <= values['kappa']) & (values['kappa'] < 360.))
+
+            # the optimum moves toward the source
+            assert results.min() < coarse.min()
+            assert np.linalg.norm(points.get(results.argmin()) - mt) <\
+                np.linalg.norm(grid.get(coarse.argmin()) - mt)
+
+
+
+### utility functions
+
+class CallbackMisfit(object):
+    """ Misfit function that calls callback with each block of moment
+        tensors before evaluating it
+    """
+    def __init__(self, misfit, callback):
+        self.misfit = misfit
+        self.callback = callback
+
+
+    def evaluate_batch(self, data, greens, mt_block, *args, **kwargs):
+        self.callback(mt_block)
+        return self.misfit.evaluate_batch(data, greens, mt_block,
+            *args, **kwargs)
+
+
+    def __getattr__(self, name):
+        return getattr(self.misfit, name)
+
+
+def wrap_misfit(misfit, callback):
+    return dict([(key, CallbackMisfit(val, callback))
+        for key, val in misfit.items()])
+
+
+def get_grid(**axes):
+    """ Double-couple grid with the given strike, slip and dip axes
+    """
+    from mtuq.grid_search import callback
+    from mtuq.util.grid import Grid
+
+    M0 = 10.**(1.5*4.5 + 9.1)
+    return Grid({
+        'rho': np.array([M0*np.sqrt(2.)]),
+        'v': np.array([0.]),
+        'w': np.array([0.]),
+        'kappa': np.array(axes['kappa'], dtype=float),
+        'sigma': np.array(axes['sigma'], dtype=float),
+        'h': np.array(axes['h'], dtype=float)},
+        callback=callback)
+
+
+def get_data_greens_misfit(nsta=3, npts=201, delta=0.1, time_shift_max=1.,
+        mt=None, norm_order=1):
+    """ Generates body- and surface-wave data and Green's tensors from random
+        time series, along with corresponding misfit functions
+
+        If a moment tensor is given, data are synthetics for that moment
+        tensor rather than random time series
+    """
+    from mtuq.greens_tensor import fk
+
+    channels = [
+        'TSS', 'TDS',
+        'REP', 'RSS', 'RDS', 'RDD',
+        'ZEP', 'ZSS', 'ZDS', 'ZDD',
+        ]
+
+    npts_padding = int(time_shift_max/delta)
+
+    data = {}
+    greens = {}
+    misfit = {}
+    for key in ['body_waves', 'surface_waves']:
+        data[key] = Dataset()
+        greens[key] = []
+        for _i in range(nsta):
+            station = AttribDict()
+            station.id = _i
+            station.azimuth = np.random.uniform(0., 360.)
+            station.npts = npts
+            station.delta = delta
+
+            stream = obspy.core.Stream()
+            stream.id = _i
+            for component in ['Z','R','T']:
+                trace = obspy.core.Trace(
+                    data=np.random.normal(0., 1.e-6, npts),
+                    header={'channel': component, 'delta': delta})
+                trace.weight = 1.
+                stream += trace
+
+            traces = []
+            for channel in channels:
+                traces += [obspy.core.Trace(
+                    data=np.random.normal(0., 1.e-21, npts+2*npts_padding),
+                    header={'channel': channel, 'delta': delta})]
+            greens[key] += [fk.GreensTensor(traces, station, None)]
+
+            if mt is not None:
+                synthetics = greens[key][-1].get_synthetics_batch(mt)
+                for trace, s in zip(stream, synthetics):
+                    trace.data = s[npts_padding:npts_padding+npts, 0].copy()
+
+            data[key] += stream
+
+    misfit['body_waves'] = cap.Misfit(
+        norm_order=norm_order,
+        time_shift_max=time_shift_max,
+        time_shift_groups=['ZR'])
+
+    misfit['surface_waves'] = cap.Misfit(
+        norm_order=norm_order,
+        time_shift_max=time_shift_max,
+        time_shift_groups=['ZR','T'])
+
+    return data, greens, misfit
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 
+import weakref
 import numpy as np
 import unittest
 import obspy.core
 from mtuq.dataset.base import Dataset
-from mtuq.misfit import cap
+from mtuq.misfit import cap, polarity
 from mtuq.util.util import AttribDict
 from mtuq.util.wavelets import Gaussian
 
@@ -117,8 +118,423 @@ class test_misfit_cap(unittest.TestCase):
         assert misfit1(dat, syn) <= misfit2(dat, syn)
 
 
+    def test_evaluate_batch(self):
+        """ Checks that evaluating a block of moment tensors at once gives
+            the same result as evaluating them one at a time
+        """
+        for norm_order in [1, 2]:
+            data, greens = get_data_greens(time_shift_max=1.)
+
+            misfit = cap.Misfit(
+                norm_order=norm_order,
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T'])
+
+            mt_block = np.random.normal(0., 1., (10, 6))
+            results = misfit.evaluate_batch(data, greens, mt_block)
+
+            for _k, mt in enumerate(mt_block):
+                assert np.isclose(results[_k], misfit(data, greens, mt))
+
+            # scratch arrays are reused for smaller and larger blocks
+            assert np.allclose(misfit.evaluate_batch(
+                data, greens, mt_block[:3]), results[:3])
+            assert np.allclose(misfit.evaluate_batch(
+                data, greens, np.tile(mt_block, (2, 1))),
+                np.tile(results, 2))
+
+        # synthetics are written to preallocated arrays if given
+        g = greens[0]
+        out = [np.empty((g[0].stats.npts, len(mt_block)))
+            for _ in g.components]
+        synthetics = g.get_synthetics_batch(mt_block, out=out)
+        for _i, expected in enumerate(g.get_synthetics_batch(mt_block)):
+            assert synthetics[_i] is out[_i]
+            assert np.allclose(out[_i], expected)
+
+
+    def test_time_shift_batch(self):
+        """ Checks that batched time-shift search gives the same lags and
+            peak values as searching one moment tensor at a time
+        """
+        data, greens = get_data_greens(time_shift_max=1.)
+        mt_block = np.random.normal(0., 1., (10, 6))
+
+        for d, g in zip(data, greens):
+            g.components = ['Z','R','T']
+            synthetics = g.get_synthetics_batch(mt_block)
+
+            for group in ['ZR', 'T', 'ZRT']:
+                lags, peaks = g.get_time_shift_batch(d, mt_block, group, 1.)
+                for _k, mt in enumerate(mt_block):
+                    cc = g.get_time_shift(d, mt, group, 1.)
+                    assert lags[_k] == cc.argmax()
+                    assert np.isclose(peaks[_k], cc.max())
+
+                    # cross-correlation of data with fk synthetics
+                    expected = 0.
+                    for trace, s in zip(d, synthetics):
+                        if trace.stats.channel[-1] in group:
+                            expected += np.correlate(trace.data, s[:,_k],
+                                'valid')
+                    assert np.allclose(cc, expected)
+
+
+    def test_gram(self):
+        """ Checks that the Gram-matrix engine gives the same result as
+            summing residuals sample by sample
+        """
+        data, greens = get_data_greens(time_shift_max=1.)
+
+        misfit1 = cap.Misfit(
+            norm_order=2,
+            time_shift_max=1.,
+            time_shift_groups=['ZR','T'])
+
+        misfit2 = cap.Misfit(
+            norm_order=2,
+            time_shift_max=1.,
+            time_shift_groups=['ZR','T'],
+            engine='gram')
+
+        mt_block = np.random.normal(0., 1., (10, 6))
+        results1 = misfit1.evaluate_batch(data, greens, mt_block)
+        results2 = misfit2.evaluate_batch(data, greens, mt_block)
+        assert np.allclose(results1, results2)
+
+        threshold = np.median(results1)
+        results2 = misfit2.evaluate_batch(data, greens, mt_block, threshold)
+        below = results1 <= threshold
+        assert np.allclose(results2[below], results1[below])
+        assert np.all(np.isinf(results2[~below]))
+
+        with self.assertRaises(ValueError):
+            cap.Misfit(norm_order=1, engine='gram')
+
+
+    def test_polarity(self):
+        """ Checks that polarity penalties are added to the waveform misfit
+            and that inconsistent moment tensors are rejected
+        """
+        data, greens = get_data_greens(time_shift_max=1.)
+        for stream in data:
+            stream.meta = AttribDict({
+                'takeoff_angle': np.random.uniform(0., 180.),
+                'catalog_azimuth': np.random.uniform(0., 360.),
+                'polarity': np.random.choice([-1, 1])})
+
+        misfit = cap.Misfit(
+            time_shift_max=1.,
+            time_shift_groups=['ZR','T'])
+
+        mt_block = np.random.normal(0., 1., (20, 6))
+        results = misfit.evaluate_batch(data, greens, mt_block)
+
+        mismatches = polarity.get_mismatches(mt_block,
+            polarity.get_coefficients(
+                polarity.get_takeoff_angles(data),
+                polarity.get_azimuths(data)),
+            polarity.get_polarities(data))
+
+        for weight in [0.5, np.inf]:
+            misfit = cap.Misfit(
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T'],
+                polarity_weight=weight)
+
+            results1 = misfit.evaluate_batch(data, greens, mt_block)
+            results2 = [misfit(data, greens, mt) for mt in mt_block]
+
+            if np.isinf(weight):
+                consistent = mismatches == 0
+                assert np.allclose(results1[consistent], results[consistent])
+                assert np.all(np.isinf(results1[~consistent]))
+            else:
+                assert np.allclose(results1, results + weight*mismatches)
+            assert np.allclose(results1, results2)
+
+
+    def test_records(self):
+        """ Checks that time shifts and sums of residuals written to record
+            arrays match the trace attributes written by __call__
+        """
+        data, greens = get_data_greens(time_shift_max=1.)
+
+        misfit = cap.Misfit(
+            time_shift_max=1.,
+            time_shift_groups=['ZR','T'])
+
+        mt_block = np.random.normal(0., 1., (5, 6))
+        records = cap.allocate_records(len(mt_block), len(data))
+        results = misfit.evaluate_batch(data, greens, mt_block,
+            records=records)
+
+        for _k, mt in enumerate(mt_block):
+            record = cap.allocate_records(1, len(data))[0]
+            assert np.isclose(misfit(data, greens, mt, records=record),
+                results[_k])
+            assert np.allclose(record['time_shift'],
+                records['time_shift'][_k])
+
+            assert np.isclose(misfit(data, greens, mt), results[_k])
+            for _i, d in enumerate(data):
+                for _j, trace in enumerate(d):
+                    assert np.isclose(trace.sum_residuals,
+                        records['sum_residuals'][_k, _i, _j])
+                    assert np.isclose(greens[_i]._synthetics[_j].time_shift,
+                        records['time_shift'][_k, _i, _j])
+
+
+    def test_single_precision(self):
+        """ Checks that misfit evaluated in single precision stays close to
+            misfit evaluated in double precision
+        """
+        import copy
+        data, greens = get_data_greens(time_shift_max=1.)
+
+        data32 = copy.deepcopy(data)
+        greens32 = copy.deepcopy(greens)
+        for stream in list(data32) + list(greens32):
+            for trace in stream:
+                trace.data = trace.data.astype(np.float32)
+
+        mt_block = np.random.normal(0., 1., (10, 6))
+        for norm_order in [1, 2]:
+            misfit = cap.Misfit(
+                norm_order=norm_order,
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T'])
+
+            results = misfit.evaluate_batch(data, greens, mt_block)
+            results32 = misfit.evaluate_batch(data32, greens32, mt_block)
+            assert np.allclose(results32, results, rtol=1.e-4)
+
+            for _k, mt in enumerate(mt_block):
+                assert np.isclose(misfit(data32, greens32, mt), results[_k],
+                    rtol=1.e-4)
+
+        assert greens32[0]._weighted_tensor[0].dtype == np.float32
+        assert greens32[0]._CCZ.dtype == np.float32
+        assert greens32[0]._synthetics[0].data.dtype == np.float32
+
+
+    def test_single_precision_gram(self):
+        """ Checks that the Gram-matrix engine in single precision stays 
+            close to double precision for a near-perfect fit, where the
+            expansion of the misfit is prone to cancellation
+        """
+        import copy
+        data, greens = get_data_greens()
+
+        greens32 = copy.deepcopy(greens)
+        for stream in greens32:
+            for trace in stream:
+                trace.data = trace.data.astype(np.float32)
+
+        # data are synthetics for mt
+        mt = np.random.normal(0., 1., 6)
+        for stream, greens_tensor in zip(data, greens):
+            synthetics = greens_tensor.get_synthetics_batch(mt)
+            for trace, s in zip(stream, synthetics):
+                trace.data = s[:, 0].copy()
+
+        data32 = copy.deepcopy(data)
+        for stream in data32:
+            for trace in stream:
+                trace.data = trace.data.astype(np.float32)
+
+        mt_block = mt*(1. + 1.e-4*np.random.normal(0., 1., (10, 6)))
+        misfit = cap.Misfit(norm_order=2, engine='gram')
+
+        results = misfit.evaluate_batch(data, greens, mt_block)
+        results32 = misfit.evaluate_batch(data32, greens32, mt_block)
+        assert np.allclose(results32, results, rtol=1.e-2)
+
+
+    def test_sum_residuals(self):
+        """ Checks that the allocation-free residual kernel is bit-compatible
+            with summing residuals directly
+        """
+        s = np.random.normal(0., 1., (101, 4))
+        d = np.random.normal(0., 1., (101, 1))
+
+        for norm_order in [1, 2, 3]:
+            misfit = cap.Misfit(norm_order=norm_order)
+
+            out = np.empty(101)
+            assert misfit._sum_residuals(s[:,0], d[:,0], out) ==\
+                np.sum(np.abs(s[:,0] - d[:,0])**norm_order)
+
+            out = np.empty(s.shape)
+            assert np.all(misfit._sum_residuals(s, d, out, axis=0) ==
+                np.sum(np.abs(s - d)**norm_order, axis=0))
+
+
+    def test_threshold(self):
+        """ Checks that early abandonment leaves misfit values below the
+            threshold unchanged and gives infinity for those above it
+        """
+        for norm_order in [1, 2]:
+            data, greens = get_data_greens(time_shift_max=1.)
+
+            misfit = cap.Misfit(
+                norm_order=norm_order,
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T'])
+
+            mt_block = np.random.normal(0., 1., (20, 6))
+            results = misfit.evaluate_batch(data, greens, mt_block)
+            threshold = np.median(results)
+
+            results1 = misfit.evaluate_batch(data, greens, mt_block,
+                threshold)
+            results2 = [misfit(data, greens, mt, threshold)
+                for mt in mt_block]
+
+            below = results <= threshold
+            assert np.allclose(results1[below], results[below])
+            assert np.allclose(np.array(results2)[below], results[below])
+            assert np.all(np.isinf(results1[~below]))
+            assert np.all(np.isinf(np.array(results2)[~below]))
+
+
+    def test_prepare(self):
+        """ Checks that plans are reused for the same dataset and that one
+            misfit function gives correct values across two datasets
+        """
+        data1, greens1 = get_data_greens(time_shift_max=1.)
+        data2, greens2 = get_data_greens(time_shift_max=1.)
+
+        misfit = cap.Misfit(
+            norm_order=2,
+            time_shift_max=1.,
+            time_shift_groups=['ZR','T'])
+
+        plan1 = misfit.prepare(data1, greens1)
+        assert misfit.prepare(data1, greens1) is plan1
+        assert misfit.prepare(data2, greens2) is not plan1
+
+        # alternating between datasets reuses their plans
+        plan2 = misfit.prepare(data2, greens2)
+        assert misfit.prepare(data1, greens1) is plan1
+        assert misfit.prepare(data2, greens2) is plan2
+
+        # trace weights are read when the plan is created
+        for station in plan1.stations:
+            assert np.all(station.weights ==
+                [trace.weight for trace in station.data])
+
+        # only the most recently used plans are kept, so that earlier
+        # datasets can be freed
+        data3, greens3 = get_data_greens(time_shift_max=1.)
+        reference = weakref.ref(data3)
+        misfit.prepare(data3, greens3)
+        for _ in range(misfit.max_plans):
+            misfit.prepare(*get_data_greens(time_shift_max=1.))
+        del data3, greens3
+        assert reference() is None
+
+        # data and Green's tensors must pair up station by station
+        with self.assertRaises(ValueError):
+            misfit.prepare(data1, greens1[:-1])
+
+        mt_block = np.random.normal(0., 1., (5, 6))
+        for data, greens in [(data1, greens1), (data2, greens2)]:
+            results = misfit.evaluate_batch(data, greens, mt_block)
+
+            expected = cap.Misfit(
+                norm_order=2,
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T']).evaluate_batch(
+                data, greens, mt_block)
+
+            assert np.allclose(results, expected)
+            assert np.allclose(results,
+                [misfit(data, greens, mt) for mt in mt_block])
+
+
+    def test_threads(self):
+        """ Checks that preparing a misfit function leaves nothing to be
+            computed on first use, and that the same dataset can then be
+            evaluated from several threads
+        """
+        from multiprocessing.pool import ThreadPool
+
+        for engine in ['waveform', 'gram']:
+            data, greens = get_data_greens(time_shift_max=1.)
+            mt_blocks = [np.random.normal(0., 1., (5, 6)) for _ in range(8)]
+
+            misfit = cap.Misfit(
+                norm_order=2,
+                time_shift_max=1.,
+                time_shift_groups=['ZR','T'],
+                engine=engine)
+
+            misfit.prepare(data, greens)
+            for g in greens:
+                assert hasattr(g, '_weighted_tensor')
+                assert hasattr(g, '_cross_correlation')
+                assert hasattr(g, '_autocorrelation') == (engine=='gram')
+
+            def evaluate(mt_block):
+                records = cap.allocate_records(len(mt_block), len(data))
+                return misfit.evaluate_batch(data, greens, mt_block,
+                    records=records)
+
+            pool = ThreadPool(4)
+            try:
+                results = pool.map(evaluate, mt_blocks)
+            finally:
+                pool.close()
+                pool.join()
+
+            for _k, mt_block in enumerate(mt_blocks):
+                assert np.allclose(results[_k],
+                    misfit.evaluate_batch(data, greens, mt_block))
+
+
 ### utility functions
 
+def get_data_greens(nsta=3, npts=201, delta=0.1, time_shift_max=0.):
+    """ Generates data and Green's tensors from random time series, with 
+        Green's tensors padded to allow time-shift corrections
+    """
+    from mtuq.greens_tensor import fk
+
+    channels = [
+        'TSS', 'TDS',
+        'REP', 'RSS', 'RDS', 'RDD',
+        'ZEP', 'ZSS', 'ZDS', 'ZDD',
+        ]
+
+    npts_padding = int(time_shift_max/delta)
+
+    data = Dataset()
+    greens = []
+    for _i in range(nsta):
+        station = AttribDict()
+        station.id = _i
+        station.azimuth = np.random.uniform(0., 360.)
+        station.npts = npts
+        station.delta = delta
+
+        stream = Stream()
+        stream.id = _i
+        for component in ['Z','R','T']:
+            stream += Trace(data=np.random.normal(0., 1., npts),
+                header={'channel': component, 'delta': delta})
+        data += stream
+
+        traces = []
+        for channel in channels:
+            traces += [obspy.core.Trace(
+                data=np.random.normal(0., 1., npts+2*npts_padding),
+                header={'channel': channel, 'delta': delta})]
+        greens += [fk.GreensTensor(traces, station, None)]
+
+    return data, greens
+
+
 def Stream(*args, **kwargs):
     """ Overloads obspy Stream by seeting the "id" attribute, which 
         mtuq expects (normally this is done by dataset.reader)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+
+import numpy as np
+import unittest
+from mtuq.misfit import polarity
+
+
+class test_polarity(unittest.TestCase):
+    def test_coefficients(self):
+        """ Checks radiation coefficients against the quadratic form 
+            g^T M g, with g the ray direction in up-south-east coordinates
+        """
+        takeoff_angles = np.random.uniform(0., 180., 10)
+        azimuths = np.random.uniform(0., 360., 10)
+        mt = np.random.normal(0., 1., 6)
+
+        M = np.array([
+            [mt[0], mt[3], mt[4]],
+            [mt[3], mt[1], mt[5]],
+            [mt[4], mt[5], mt[2]]])
+
+        coefficients = polarity.get_coefficients(takeoff_angles, azimuths)
+        for _i, (i, phi) in enumerate(zip(
+            np.deg2rad(takeoff_angles), np.deg2rad(azimuths))):
+            g = np.array([-np.cos(i), -np.sin(i)*np.cos(phi),
+                np.sin(i)*np.sin(phi)])
+            assert np.isclose(np.dot(coefficients[_i], mt),
+                np.dot(g, np.dot(M, g)))
+
+
+    def test_mismatches(self):
+        """ Checks predicted polarities for an explosion and a vertical
+            strike-slip fault
+        """
+        takeoff_angles = np.array([30., 90., 90., 150.])
+        azimuths = np.array([0., 45., 135., 270.])
+        coefficients = polarity.get_coefficients(takeoff_angles, azimuths)
+
+        # explosion: compressional first motions everywhere
+        explosion = np.array([1., 1., 1., 0., 0., 0.])
+        assert polarity.get_mismatches(explosion, coefficients,
+            np.array([1, 1, 1, 1])) == [0]
+        assert polarity.get_mismatches(explosion, coefficients,
+            np.array([-1, 0, -1, 1])) == [2]
+
+        # strike-slip on a north-south plane: compressional toward northeast
+        # and dilatational toward southeast
+        strike_slip = np.array([0., 0., 0., 0., 0., -1.])
+        assert polarity.get_mismatches(strike_slip, coefficients,
+            np.array([0, 1, -1, 0])) == [0]
+
+        # results for a block of moment tensors
+        mismatches = polarity.get_mismatches(
+            np.array([explosion, strike_slip]), coefficients,
+            np.array([0, 1, -1, 0]))
+        assert np.all(mismatches == [1, 0])
+
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -1 +1,61 @@
 #!/usr/bin/env python
+
+import numpy as np
+import unittest
+import obspy.core
+from mtuq.process_data.cap import ProcessData
+from mtuq.util.util import AttribDict
+
+
+class test_process_data_cap(unittest.TestCase):
+    def test_dtype(self):
+        """ Checks that processed traces are converted to the requested
+            precision, and otherwise left in double precision
+        """
+        for dtype, expected in [
+                (np.float32, np.float32),
+                ('float32', np.float32),
+                (None, np.float64)]:
+
+            parameters = {
+                'filter_type': 'Bandpass',
+                'freq_min': 0.1,
+                'freq_max': 1.,
+                'pick_type': 'from_sac_headers',
+                'window_type': 'cap_bw',
+                'window_length': 20.,
+                }
+            if dtype is not None:
+                parameters['dtype'] = dtype
+
+            processed = ProcessData(**parameters)(get_stream())
+
+            assert len(processed) == 3
+            for trace in processed:
+                assert trace.data.dtype == expected
+                assert trace.stats.npts == 200
+
+
+
+### utility functions
+
+def get_stream(npts=1000, delta=0.1):
+    """ Returns a three-component stream of random double-precision time
+        series, with the metadata and tags expected by ProcessData
+    """
+    stream = obspy.core.Stream()
+    for component in ['Z','R','T']:
+        stream += obspy.core.Trace(data=np.random.normal(0., 1., npts),
+            header={'channel': 'BH'+component, 'delta': delta})
+
+    stream.id = 'XX.STA..'
+    stream.tags = []
+    stream.meta = AttribDict()
+    stream.meta.delta = delta
+    stream.meta.catalog_origin_time = obspy.core.UTCDateTime(0.)
+    stream.meta.sac = AttribDict({'t5': 30., 't6': 50.})
+    return stream
+
+
+if __name__=='__main__':
+    unittest.main()
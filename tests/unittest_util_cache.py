@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import unittest
+import zipfile
+from multiprocessing import Process
+from mtuq.util import cache as cache_module
+from mtuq.util.cache import DiskCache, LRUCache
+from mtuq.util.util import unzip
+
+
+class test_cache(unittest.TestCase):
+    def test_lru(self):
+        """ Checks that least recently used values are dropped once the
+            size bound is exceeded
+        """
+        cache = LRUCache(3*80, sizeof=lambda array: array.nbytes)
+
+        for key in range(3):
+            cache.get(key, lambda: np.zeros(10))
+        assert len(cache) == 3
+        assert cache.nbytes == 3*80
+
+        # touch key 0, so that key 1 is dropped next
+        cache.get(0, fail)
+        cache.get(3, lambda: np.zeros(10))
+        assert 1 not in cache
+        assert 0 in cache and 2 in cache and 3 in cache
+        assert cache.hits == 1
+        assert cache.misses == 4
+
+
+    def test_oversized(self):
+        """ Checks that values larger than the size bound are returned but
+            not kept
+        """
+        cache = LRUCache(80, sizeof=lambda array: array.nbytes)
+        cache.get(0, lambda: np.zeros(10))
+
+        value = cache.get(1, lambda: np.ones(20))
+        assert np.all(value == 1.)
+        assert 1 not in cache
+        assert 0 in cache
+        assert cache.nbytes == 80
+
+
+    def test_disk_cache(self):
+        """ Checks that arrays and headers are read back as written and that
+            least recently used entries are evicted first
+        """
+        path = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(path)
+            cache.put('a', np.arange(10.), {'delta': 0.1})
+            array, header = cache.get('a')
+            assert np.all(array == np.arange(10.))
+            assert header == {'delta': 0.1}
+            assert cache.get('b') is None
+
+            size = sum([os.path.getsize(os.path.join(path, filename))
+                for filename in os.listdir(path)])
+
+            # room for two entries
+            cache = DiskCache(path, max_bytes=2*size)
+            cache.put('b', np.arange(10.), {'delta': 0.1})
+            cache.get('a')
+            cache.put('c', np.arange(10.), {'delta': 0.1})
+            assert sorted(cache.keys()) == ['a', 'c']
+
+            cache.clear()
+            assert cache.keys() == []
+
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_disk_cache_consistency(self):
+        """ Checks that arrays not matching their headers are treated as
+            missing, that lock files do not accumulate and that entries can
+            be read without write access
+        """
+        path = tempfile.mkdtemp()
+        try:
+            cache = DiskCache(path)
+            cache.put('a', np.arange(10.), {'delta': 0.1})
+
+            # interrupted after the array, but not the header, was replaced
+            with open(os.path.join(path, 'b.npy'), 'wb') as file:
+                np.save(file, np.arange(20.))
+            os.rename(os.path.join(path, 'b.npy'),
+                os.path.join(path, 'a.npy'))
+            assert cache.get('a') is None
+
+            with cache.lock('a'):
+                cache.put('a', np.arange(20.), {'delta': 0.05})
+            array, header = cache.get('a')
+            assert np.all(array == np.arange(20.))
+            assert header == {'delta': 0.05}
+            assert not os.path.exists(os.path.join(path, 'a.lock'))
+
+            # timestamps cannot be updated in a read-only directory
+            def utime(*args):
+                raise OSError(13, 'Permission denied')
+
+            original = cache_module.os.utime
+            cache_module.os.utime = utime
+            try:
+                assert cache.get('a') is not None
+            finally:
+                cache_module.os.utime = original
+
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_unzip(self):
+        """ Checks that directories not marked as completely extracted are
+            extracted again
+        """
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'archive.zip')
+            archive = zipfile.ZipFile(filename, 'w')
+            archive.writestr('a.txt', 'a')
+            archive.writestr('b.txt', 'b')
+            archive.close()
+
+            # left by an interrupted extraction
+            dirname = os.path.join(path, 'archive')
+            os.makedirs(dirname)
+            open(os.path.join(dirname, 'a.txt'), 'w').close()
+
+            assert unzip(filename) == dirname
+            assert sorted(os.listdir(dirname)) == ['a.txt', 'b.txt']
+            with open(os.path.join(dirname, 'a.txt')) as file:
+                assert file.read() == 'a'
+
+            # extracted only once
+            os.remove(os.path.join(dirname, 'b.txt'))
+            assert unzip(filename) == dirname
+            assert os.listdir(dirname) == ['a.txt']
+
+        finally:
+            shutil.rmtree(path)
+
+
+    def test_disk_cache_lock(self):
+        """ Checks that, of several processes trying to create the same
+            entry, only one does
+        """
+        path = tempfile.mkdtemp()
+        try:
+            processes = [Process(target=create, args=(path, 'a'))
+                for _ in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+
+            assert len(os.listdir(os.path.join(path, 'created'))) == 1
+            assert DiskCache(path).keys() == ['a']
+
+        finally:
+            shutil.rmtree(path)
+
+
+
+### utility functions
+
+def create(path, key):
+    """ Creates an entry unless another process already has, leaving a
+        marker for each entry created
+    """
+    cache = DiskCache(path)
+    with cache.lock(key):
+        if key not in cache:
+            if not os.path.exists(os.path.join(path, 'created')):
+                os.makedirs(os.path.join(path, 'created'))
+            open(os.path.join(path, 'created', str(os.getpid())), 'w').close()
+            cache.put(key, np.zeros(10), {})
+
+
+def fail():
+    raise Exception('Cached value was expected')
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import unittest
+
+from mtuq.util.checkpoint import Checkpoint
+from mtuq.util.grid import Grid
+
+
+class test_checkpoint(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+
+    def test_resume(self):
+        """ Checks that completed chunks are read back and skipped, and that
+            chunks not yet written are evaluated again
+        """
+        filename = os.path.join(self.path, 'misfit.h5')
+        grid = Grid({
+            'x': np.linspace(0., 1., 5),
+            'y': np.linspace(0., 1., 5)})
+
+        checkpoint = Checkpoint(filename, grid, 4, interval=2)
+        chunks = checkpoint.chunks()
+        assert len(chunks) == 7
+        assert chunks[-1] == (24, 25)
+
+        # the third chunk is never written, as if the job had been killed
+        for start, stop in chunks[:3]:
+            checkpoint.update(start, np.arange(start, stop))
+
+        checkpoint = Checkpoint(filename, grid, 4, interval=2)
+        assert checkpoint.chunks() == chunks[2:]
+        assert checkpoint.index == 8
+        assert np.all(checkpoint.results[:8] == np.arange(8))
+
+        for start, stop in checkpoint.chunks():
+            checkpoint.update(start, np.arange(start, stop))
+        checkpoint.flush()
+
+        checkpoint = Checkpoint(filename, grid, 4)
+        assert checkpoint.finished
+        assert checkpoint.index == grid.stop
+        assert np.all(checkpoint.results == np.arange(25))
+
+
+    def test_mismatch(self):
+        filename = os.path.join(self.path, 'misfit.h5')
+        grid = Grid({'x': np.linspace(0., 1., 10)})
+
+        Checkpoint(filename, grid, 4)
+        with self.assertRaises(ValueError):
+            Checkpoint(filename, grid, 5)
+
+        # same size, but regenerated axis values
+        with self.assertRaises(ValueError):
+            Checkpoint(filename, Grid({'x': np.random.uniform(0., 1., 10)}), 4)
+
+        with self.assertRaises(ValueError):
+            Checkpoint(filename, Grid({'y': np.linspace(0., 1., 10)}), 4)
+
+        Checkpoint(filename, Grid({'x': np.linspace(0., 1., 10)}), 4)
+
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+
+import numpy as np
+import unittest
+
+from mtuq.grid_search import DoubleCoupleGridRandom, DoubleCoupleGridRegular
+from mtuq.util.grid import Grid, UnstructuredGrid
+
+
+class test_grid(unittest.TestCase):
+    def test_get_values(self):
+        """ Checks that block access matches point-by-point access
+        """
+        grid = Grid({
+            'x': np.linspace(0., 1., 3),
+            'y': np.linspace(0., 1., 4),
+            'z': np.linspace(0., 1., 5)})
+
+        p = grid.get_values(7, 53)
+        for _i, i in enumerate(range(7, 53)):
+            q = grid.get(i)
+            for key in grid.keys:
+                assert p[key][_i] == q[key]
+
+
+    def test_get_block(self):
+        """ Checks that moment tensors obtained in blocks match those obtained
+            point by point
+        """
+        for grid in [
+            DoubleCoupleGridRandom(Mw=4.5, npts=50),
+            DoubleCoupleGridRandom(Mw=4.5, npts=50).decompose(3)[1],
+            DoubleCoupleGridRegular(Mw=4.5, npts_per_axis=4)]:
+
+            count = 0
+            for start, stop, mt_block in grid.iter_blocks(7):
+                assert mt_block.shape == (stop-start, 6)
+                for _i, i in enumerate(range(start, stop)):
+                    assert np.allclose(mt_block[_i], grid.get(i))
+                count += stop-start
+
+            assert count == grid.size
+
+
+    def test_unstructured_get_values(self):
+        grid = UnstructuredGrid({
+            'x': np.random.uniform(0., 1., 20),
+            'y': np.random.uniform(0., 1., 20)})
+
+        p = grid.get_values(5, 15)
+        for _i, i in enumerate(range(5, 15)):
+            q = grid.get(i)
+            for key in grid.keys:
+                assert p[key][_i] == q[key]
+
+
+
+if __name__=='__main__':
+    unittest.main()
+
@@ -4,7 +4,10 @@
 import unittest
 import numpy as np
 
-from mtuq.util.moment_tensor.tape2015 import cmt2tt, cmt2tt15, tt2cmt, tt152cmt
+from mtuq.util.moment_tensor.change_basis import change_basis
+from mtuq.util.moment_tensor.tape2015 import cmt2tt, cmt2tt15, tt2cmt, tt152cmt,\
+    tt2cmt_array, tt152cmt_array
+from mtuq.util.math import PI
 
 
 EPSVAL = 1.e-6
@@ -56,6 +59,58 @@ class TestMomentTensor(unittest.TestCase):
         pass
 
 
+    def test_Array_2012(self):
+        N = 100
+        gamma = np.random.uniform(-30., 30., N)
+        delta = np.random.uniform(-90., 90., N)
+        M0 = np.random.uniform(0.5, 2., N)
+        kappa = np.random.uniform(0., 360., N)
+        theta = np.random.uniform(0., 90., N)
+        sigma = np.random.uniform(-90., 90., N)
+
+        M1 = tt2cmt_array(gamma, delta, M0, kappa, theta, sigma)
+        assert M1.shape == (N, 6)
+
+        for _i in range(N):
+            M2 = tt2cmt(gamma[_i], delta[_i], M0[_i],
+                        kappa[_i], theta[_i], sigma[_i])
+            e = np.linalg.norm(M1[_i]-M2)
+            if e > EPSVAL:
+                print '||M1 - M2|| = %e' % e
+                raise Exception
+
+
+    def test_Array_Tape2015(self):
+        N = 100
+        rho = np.sqrt(2.)
+        v = np.random.uniform(-1./3., 1./3., N)
+        w = np.random.uniform(-3./8.*PI, 3./8.*PI, N)
+        kappa = np.random.uniform(0., 360., N)
+        sigma = np.random.uniform(-90., 90., N)
+        h = np.random.uniform(0., 1., N)
+
+        # scalar arguments are broadcast
+        M1 = tt152cmt_array(rho, v, w, kappa, sigma, h)
+        assert M1.shape == (N, 6)
+
+        for _i in range(N):
+            M2 = tt152cmt(rho, v[_i], w[_i], kappa[_i], sigma[_i], h[_i])
+            e = np.linalg.norm(M1[_i]-M2)
+            if e > EPSVAL:
+                print '||M1 - M2|| = %e' % e
+                raise Exception
+
+
+    def test_ChangeBasis_Array(self):
+        M = np.random.normal(0., 1., (10, 6))
+        for i1 in [1,2,3,4,5]:
+            for i2 in [1,2,3,4,5]:
+                M1 = change_basis(M, i1, i2)
+                for _i in range(10):
+                    M2 = change_basis(M[_i], i1, i2)
+                    assert np.all(M1[_i] == M2)
+
+
     def test_RandomFullMomentTensor_Tape2015(self):
         pass
 
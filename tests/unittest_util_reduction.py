@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+
+import numpy as np
+import unittest
+
+from mtuq.util.reduction import BestPoints
+
+
+class test_best_points(unittest.TestCase):
+    def test_update(self):
+        """ Checks that the k best points found block by block match those 
+            found by sorting all values at once
+        """
+        k = 10
+        values = np.random.uniform(0., 1., 1000)
+        bins = np.linspace(0., 1., 11)
+
+        best = BestPoints(k, bins)
+        for start in range(0, 1000, 64):
+            stop = min(start+64, 1000)
+            best.update(np.arange(start, stop), values[start:stop])
+
+        assert len(best) == k
+        assert np.all(best.indices == np.argsort(values)[:k])
+        assert np.all(best.values == np.sort(values)[:k])
+        assert best.threshold == np.sort(values)[k-1]
+
+        assert best.count == values.size
+        assert np.isclose(best.mean, values.mean())
+        assert best.min == values.min()
+        assert best.max == values.max()
+        assert np.all(best.histogram == np.histogram(values, bins)[0])
+
+
+    def test_merge(self):
+        """ Checks that merging partial results gives the same result as
+            processing all values at once
+        """
+        k = 5
+        values = np.random.uniform(0., 1., 100)
+
+        partial = []
+        for start in range(0, 100, 30):
+            stop = min(start+30, 100)
+            partial += [BestPoints(k)]
+            partial[-1].update(np.arange(start, stop), values[start:stop])
+
+        merged = partial[0]
+        for other in partial[1:]:
+            merged.merge(other)
+
+        assert np.all(merged.indices == np.argsort(values)[:k])
+        assert merged.count == values.size
+        assert np.isclose(merged.mean, values.mean())
+
+
+    def test_fewer_than_k(self):
+        best = BestPoints(10)
+        best.update([3, 1], [0.5, 0.25])
+
+        assert best.threshold == np.inf
+        assert np.all(best.indices == [1, 3])
+
+
+    def test_abandoned(self):
+        best = BestPoints(2)
+        best.update([0, 1, 2, 3], [0.5, np.inf, 0.25, np.inf])
+
+        assert best.count == 2
+        assert best.nabandoned == 2
+        assert best.max == 0.5
+        assert np.all(best.indices == [2, 0])
+
+
+
+if __name__=='__main__':
+    unittest.main()
+